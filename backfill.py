@@ -0,0 +1,121 @@
+"""
+Catch-up after downtime. Normally only the newest logs are read (today's
+and yesterday's LTQ logs, the newest Q Exactive log), so files closed
+during a longer outage would never be queued. Backfill finds all logs of
+an instrument that were not read to the end, back to the last closed file
+or at most a number of days (and the log that was active then), parses
+them in parallel in a process pool, and puts their events in the queue in
+timestamp order. The read positions are then stored, so normal
+incremental reading continues where backfill stopped.
+
+Enabled in transfer_config.json with {"backfill": {"enabled": true}}, it
+runs when a transferrer starts.
+"""
+
+import os, time, heapq, logging, datetime, multiprocessing
+
+import logparser
+from logtail import LogFollower
+
+log = logging.getLogger(__name__)
+
+DAYS = 14 # logs started earlier are only read when active since then
+
+
+def parse_log(job):
+    """Reads logfile from position (None to start at the beginning) in a
+    worker process. Returns (logfile, events, new position, bytes read,
+    error)."""
+    logfile, logdate, grammar, position = job
+    follower = LogFollower(None)
+    start = 0
+    if position is not None:
+        follower.positions[logfile] = dict(position)
+        start = position['offset']
+    try:
+        events = list(logparser.parse(follower.iter_new_lines(logfile),
+            grammar, logdate))
+    except (IOError, OSError) as e:
+        return logfile, [], None, 0, str(e)
+    position = follower.positions[logfile]
+    # a replaced logfile is read from the start
+    nbytes = position['offset'] - (start if position['offset'] >= start
+            else 0)
+    return logfile, events, position, nbytes, None
+
+
+def unread_logs(logs, positions, since):
+    """Logs of [(logfile, date)] that have not been read to the end
+    according to positions. A log is named with the date it was started
+    and can be written to for days after, so besides the logs dated since
+    or later, the newest log dated before since and older logs that were
+    partly read are included."""
+    logs = sorted(logs, key=lambda x: (x[1], x[0]))
+    earlier = [logfile for logfile, logdate in logs if logdate < since]
+    for logfile, logdate in logs:
+        position = positions.get(logfile)
+        if logdate < since and position is None and logfile != earlier[-1]:
+            continue
+        if position is not None:
+            try:
+                st = os.stat(logfile)
+            except OSError:
+                continue
+            if st.st_ino == position['inode'] and \
+                    st.st_size == position['offset']:
+                continue
+        yield logfile, logdate, position
+
+
+def backfill(transferrer, processes=None, days=DAYS):
+    """Parses the unread logs of transferrer and queues their events.
+    Returns the number of events."""
+    since = datetime.date.today() - datetime.timedelta(days)
+    lastclosed = transferrer.lastclosed_timestamp
+    if lastclosed is not None:
+        since = max(since, lastclosed.date())
+    jobs = [(logfile, logdate, transferrer.grammar, position) for logfile,
+            logdate, position in unread_logs(transferrer.historical_logs(),
+                transferrer.follower.positions, since)]
+    if not jobs:
+        log.info('Backfill of {0}: no unread logs since {1}'.format(
+            transferrer.name, since))
+        return 0
+    log.info('Backfill of {0}: parsing {1} logs since {2} with {3} '
+            'processes'.format(transferrer.name, len(jobs), since,
+                processes or multiprocessing.cpu_count()))
+    results, positions, nbytes = [], {}, 0
+    start = time.time()
+    pool = multiprocessing.Pool(processes)
+    try:
+        for number, (logfile, events, position, read, error) in enumerate(
+                pool.imap_unordered(parse_log, jobs), 1):
+            if error is not None:
+                log.warning('Backfill could not read {0}: {1}'.format(logfile,
+                    error))
+            else:
+                results.append(events)
+                positions[logfile] = position
+                nbytes += read
+            seconds = max(time.time() - start, 1e-6)
+            log.info('Backfill of {0}: {1}/{2} logs, {3:.1f} MB, {4:.1f} '
+                    'MB/s, {5} events'.format(transferrer.name, number,
+                        len(jobs), nbytes / 1e6, nbytes / 1e6 / seconds,
+                        sum(len(x) for x in results)))
+        pool.close()
+    except Exception:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    # events of each log are in order already
+    events = list(heapq.merge(*[[(x.timestamp, x) for x in events] for
+        events in results]))
+    # files opened in the oldest log, which may predate since, are queued
+    oldest = min(min(x[1] for x in jobs), since)
+    transferrer.catch_up([x[1] for x in events], positions,
+            (datetime.date.today() - oldest).days + 1)
+    log.info('Backfill of {0} finished, queued {1} events from {2} logs in '
+            '{3:.1f} s'.format(transferrer.name, len(events), len(positions),
+                time.time() - start))
+    return len(events)
@@ -0,0 +1,102 @@
+"""
+Benchmark of logparser on synthetic instrument logs, compared to the
+previous way of parsing (split and strptime on every line).
+
+Usage:
+    python benchmarks/bench_logparser.py [number_of_lines]
+
+"""
+
+import os, sys, time, datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..'))
+import logparser
+
+ACQUISITION_EVERY = 5000 # lines
+
+
+def ltq_lines(nlines):
+    start = datetime.datetime(2014, 3, 12)
+    for i in xrange(nlines):
+        stamp = (start + datetime.timedelta(seconds=i * 0.02)).strftime(
+                '%H:%M:%S.%f')[:12]
+        if i % ACQUISITION_EVERY == 0:
+            text = 'Raw file created, actual name = C:\\Xcalibur\\data\\' \
+                    'run_{0}.raw'.format(i)
+        elif i % ACQUISITION_EVERY == ACQUISITION_EVERY - 1:
+            text = 'Closed raw file'
+        else:
+            text = 'Scan {0} stored, TIC {1}'.format(i, i * 7)
+        yield '{0}:  {1}'.format(stamp, text)
+
+
+def qexactive_lines(nlines):
+    start = datetime.datetime(2014, 3, 12)
+    for i in xrange(nlines):
+        stamp = (start + datetime.timedelta(seconds=i * 0.02)).strftime(
+                '%Y-%m-%d %H:%M:%S.%f')[:24]
+        if i % ACQUISITION_EVERY == 0:
+            text = 'Starting acquisition: Xcalibur will write C:\\Xcalibur\\' \
+                    'data\\run_{0}.raw (and may add date/time to the ' \
+                    'name)'.format(i)
+        elif i % ACQUISITION_EVERY == ACQUISITION_EVERY - 2:
+            text = 'Stopping acquisition'
+        elif i % ACQUISITION_EVERY == ACQUISITION_EVERY - 1:
+            text = 'Storing acquisition scan'
+        else:
+            text = 'Scan {0} acquired, injection time {1}'.format(i, i % 50)
+        yield '[Time={0}+01:00] {1}'.format(stamp, text)
+
+
+def old_ltq(lines):
+    events = 0
+    for line in lines:
+        logline = line.split(':  ')
+        datetime.datetime.strptime('20140312 ' + logline[0],
+                '%Y%m%d %H:%M:%S.%f')
+        if 'Raw file created' in logline[1] or logline[1] == 'Closed raw file':
+            events += 1
+    return events
+
+
+def old_qexactive(lines):
+    events = 0
+    for line in lines:
+        linetime = line[1:line.index(']')].split('=')[1].split('+')[0]
+        datetime.datetime.strptime(linetime, '%Y-%m-%d %H:%M:%S.%f')
+        if 'Starting acquisition' in line or 'Stopping acquisition' in line \
+                or 'Storing acquisition scan' in line:
+            events += 1
+    return events
+
+
+def new_parser(grammar, logdate=None):
+    def parse(lines):
+        return sum(1 for event in logparser.parse(lines, grammar, logdate))
+    return parse
+
+
+def timed(parse, lines):
+    start = time.time()
+    events = parse(lines)
+    return events, time.time() - start
+
+
+def main(nlines):
+    benchmarks = [('LTQ', ltq_lines, old_ltq,
+        new_parser(logparser.LTQ, datetime.date(2014, 3, 12))),
+        ('Q Exactive', qexactive_lines, old_qexactive,
+            new_parser(logparser.QEXACTIVE))]
+    for name, generate, old, new in benchmarks:
+        # generate lines up front, so only parsing is timed
+        lines = list(generate(nlines))
+        for method, parse in [('split/strptime', old), ('logparser', new)]:
+            events, seconds = timed(parse, lines)
+            print '{0:12} {1:16} {2:>10} lines {3:>6} events {4:8.2f} s ' \
+                    '{5:>12.0f} lines/s'.format(name, method, nlines, events,
+                            seconds, nlines / seconds)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000000)
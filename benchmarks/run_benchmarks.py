@@ -0,0 +1,381 @@
+"""
+Benchmarks of the transfer daemon paths on synthetic data, so they can run
+without an instrument PC or servers: log parsing (with rotation and
+incremental following), finding the newest of many logfiles, queue
+updates, restarting from saved state, the chunked transfer backend to a
+local directory and to a loopback SSH stand-in, the metadata client
+against a stub server, and compression codecs and levels. Results are
+printed as JSON, to compare versions.
+
+Compression is benchmarked by its effective throughput over a link of
+--link bytes per second: compressing and sending overlap, so the slower of
+the two sets the rate at which the original data arrives.
+
+Usage:
+    python benchmarks/run_benchmarks.py [--lines N] [--files N]
+        [--size BYTES] [--link BYTES] [--only NAME [NAME ...]]
+        [--output FILE]
+
+"""
+
+import os, sys, glob, json, time, shutil, argparse, datetime, platform
+import tempfile, threading, urlparse, subprocess
+import BaseHTTPServer, SocketServer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+import logparser, transfer_backends, compression, logindex
+from logtail import LogFollower
+from filequeue import FileQueue
+from queuestore import QueueStore
+from scheduler import percentile
+import synthetic
+
+
+def latency_stats(values):
+    values = sorted(values)
+    return {'count': len(values), 'mean': sum(values) / len(values),
+            'p50': percentile(values, 0.5), 'p95': percentile(values, 0.95),
+            'max': values[-1]}
+
+
+def parse_files(follower, logs, grammar):
+    lines, events = [0], 0
+    def counted(iterator):
+        for line in iterator:
+            lines[0] += 1
+            yield line
+    for fn, logdate in logs:
+        for event in logparser.parse(counted(follower.iter_new_lines(fn)),
+                grammar, logdate):
+            events += 1
+    return lines[0], events
+
+
+def bench_parse_ltq(workdir, options):
+    logs = synthetic.ltq_logs(workdir, options.lines)
+    follower = LogFollower(os.path.join(workdir, 'positions.json'))
+    start = time.time()
+    lines, events = parse_files(follower, logs, logparser.LTQ)
+    seconds = time.time() - start
+    return {'lines': lines, 'events': events, 'seconds': seconds,
+            'lines_per_second': lines / seconds}
+
+
+def bench_parse_qexactive(workdir, options):
+    logs = synthetic.qexactive_logs(workdir, options.lines,
+            max(options.lines // 4, 1))
+    follower = LogFollower(os.path.join(workdir, 'positions.json'))
+    start = time.time()
+    lines, events = parse_files(follower, [(fn, None) for fn in logs],
+            logparser.QEXACTIVE)
+    seconds = time.time() - start
+    return {'lines': lines, 'events': events, 'logfiles': len(logs),
+            'seconds': seconds, 'lines_per_second': lines / seconds}
+
+
+def bench_follow(workdir, options):
+    """Latency of noticing a closed file in a growing log, which is rotated
+    (replaced by a new file) halfway"""
+    fn = os.path.join(workdir, 'LTQ_20140312.LOG')
+    synthetic.write_lines(fn, synthetic.ltq_lines(options.lines // 10))
+    follower = LogFollower(os.path.join(workdir, 'positions.json'))
+    logdate = datetime.date(2014, 3, 12)
+    for event in logparser.parse(follower.iter_new_lines(fn), logparser.LTQ,
+            logdate):
+        pass
+    latencies = []
+    appends = 200
+    for number in range(appends):
+        if number == appends // 2:
+            os.rename(fn, fn + '.old')
+        batch = ['10:00:{0:02d}.000:  Scan {1} stored'.format(x % 60, x)
+                for x in range(99)] + ['10:01:00.000:  Closed raw file']
+        synthetic.write_lines(fn, batch, 'a')
+        start = time.time()
+        events = list(logparser.parse(follower.iter_new_lines(fn),
+            logparser.LTQ, logdate))
+        latencies.append(time.time() - start)
+        assert events and events[-1].kind == logparser.CLOSED
+    return {'appends': appends, 'latency': latency_stats(latencies)}
+
+
+def bench_logindex(workdir, options):
+    """Finding the newest of a directory of Q Exactive logs (a few per day
+    for years) by globbing and parsing all names, and with the index"""
+    start = datetime.datetime(2010, 1, 1)
+    nlogs = 4000
+    for number in range(nlogs):
+        stamp = (start + datetime.timedelta(hours=number * 8)).strftime(
+                '%Y-%m-%d_%H-%M-%S')
+        open(os.path.join(workdir, 'Thermo Exactive--{0}.log'.format(stamp)),
+                'w').close()
+    # directory changes this close to a listing are not trusted by the index
+    past = time.time() - 60
+    os.utime(workdir, (past, past))
+    lookups = 100
+    before = time.time()
+    for number in range(lookups):
+        newest = max(glob.glob(os.path.join(workdir, 'Thermo Exactive--*')),
+                key=lambda x: datetime.datetime.strptime(os.path.basename(
+                    x)[17:27], '%Y-%m-%d'))
+    globbing = (time.time() - before) / lookups
+    index = logindex.LogIndex(workdir, logindex.QEXACTIVE)
+    before = time.time()
+    index.refresh()
+    first = time.time() - before
+    before = time.time()
+    for number in range(lookups):
+        newest = index.newest()
+    return {'logfiles': nlogs, 'glob_seconds': globbing,
+            'index_first_seconds': first,
+            'index_seconds': (time.time() - before) / lookups}
+
+
+def bench_queue(workdir, options):
+    store = QueueStore(os.path.join(workdir, 'queue.sqlite'),
+            os.path.join(workdir, 'queue.json'))
+    queue = FileQueue(store.load(), datefield='closedate')
+    nfiles = max(options.lines // 100, 100)
+    start = time.time()
+    saves = []
+    now = datetime.datetime.now()
+    for number in range(nfiles):
+        key = now - datetime.timedelta(seconds=number)
+        queue.add(key, file='run_{0}.raw'.format(number), status='open',
+                openeddate=key.date())
+        queue.update(key, status='closed', closedate=key)
+        queue.update(key, status='done', transferred='20140312')
+        if number % 100 == 99:
+            before = time.time()
+            store.save(queue)
+            saves.append(time.time() - before)
+    queue.expired(now)
+    seconds = time.time() - start
+    return {'files': nfiles, 'updates_per_second': nfiles * 3 / seconds,
+            'save_latency': latency_stats(saves)}
+
+
+def bench_startup(workdir, options):
+    """Time to reopen the queue database and get the queue, timestamps and
+    log positions back, after a history of queue entries and state
+    changes"""
+    dbfile = os.path.join(workdir, 'queue.sqlite')
+    store = QueueStore(dbfile, os.path.join(workdir, 'queue.json'))
+    queue = FileQueue(datefield='closedate')
+    follower = LogFollower(os.path.join(workdir, 'positions.json'),
+            store.state)
+    now = datetime.datetime.now()
+    nfiles = max(options.lines // 100, 100)
+    for number in range(nfiles):
+        key = now - datetime.timedelta(seconds=number)
+        queue.add(key, file='run_{0}.raw'.format(number), status='done',
+                closedate=key)
+        store.state.set('timestamps', 'last_closed', key)
+        follower.positions['log_{0}'.format(number % 100)] = {'inode': 1,
+                'size': number, 'mtime': 0, 'offset': number, 'partial': '',
+                'head': ''}
+        follower.save()
+        if number % 100 == 99:
+            store.save(queue)
+    store.save(queue)
+    store.db.close()
+    start = time.time()
+    store = QueueStore(dbfile, os.path.join(workdir, 'queue.json'))
+    follower = LogFollower(os.path.join(workdir, 'positions.json'),
+            store.state)
+    assert store.state.section('timestamps')['last_closed'] == key
+    state_seconds = time.time() - start
+    start = time.time()
+    queue = FileQueue(store.load(), datefield='closedate')
+    return {'files': nfiles, 'logfiles': len(follower.positions),
+            'state_seconds': state_seconds,
+            'queue_seconds': time.time() - start}
+
+
+def transfer(backend, files):
+    latencies = []
+    start = time.time()
+    for fn in files:
+        before = time.time()
+        backend.transfer(fn)
+        latencies.append(time.time() - before)
+    seconds = time.time() - start
+    nbytes = sum(os.path.getsize(fn) for fn in files)
+    return {'files': len(files), 'bytes': nbytes, 'seconds': seconds,
+            'megabytes_per_second': nbytes / seconds / 1e6,
+            'latency': latency_stats(latencies)}
+
+
+def bench_backend_local(workdir, options):
+    files = synthetic.sparse_raw_files(workdir, options.files, options.size)
+    target = os.path.join(workdir, 'target')
+    os.mkdir(target)
+    return transfer(transfer_backends.ChunkedBackend(
+        transfer_backends.LocalDirectoryRemote(target)), files)
+
+
+def bench_backend_ssh(workdir, options):
+    """Loopback: the remote commands run in a local shell"""
+    files = synthetic.sparse_raw_files(workdir, options.files, options.size)
+    target = os.path.join(workdir, 'target')
+    os.mkdir(target)
+    remote = transfer_backends.SSHRemote('localhost:{0}'.format(target),
+            ssh=['sh', '-c'])
+    return transfer(transfer_backends.ChunkedBackend(remote), files)
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Kantele login page and rawstatus view, answers that every file is
+    archived"""
+    protocol_version = 'HTTP/1.1'
+
+    def _send(self, body, ctype):
+        self.send_response(200)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._send('<html><form><input name="csrfmiddlewaretoken" '
+                'value="benchmark"></form></html>', 'text/html')
+
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers['Content-Length']))
+        files = urlparse.parse_qs(data).get('fn', [])
+        self._send(json.dumps(dict((fn, ['done', '2014-03-12']) for fn in
+            files)), 'application/json')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def bench_metadata(workdir, options):
+    import metadata_querying # needs lxml
+    server = StubServer(('127.0.0.1', 0), StubHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    base = 'http://127.0.0.1:{0}'.format(server.server_address[1])
+    client = metadata_querying.MetadataClient(base + '/rawstatus',
+            base + '/login')
+    nfiles = max(options.lines // 10, 1000)
+    files = ['run_{0}.raw'.format(x) for x in range(nfiles)]
+    latencies = []
+    try:
+        start = time.time()
+        for batch in client.batches(files):
+            before = time.time()
+            client.query_batch(batch)
+            latencies.append(time.time() - before)
+        sequential = time.time() - start
+        start = time.time()
+        client.query_server(files)
+        concurrent = time.time() - start
+    finally:
+        server.shutdown()
+    return {'files': nfiles, 'batch_latency': latency_stats(latencies),
+            'files_per_second': nfiles / sequential,
+            'concurrent_files_per_second': nfiles / concurrent}
+
+
+COMPRESSION_LEVELS = {'zlib': [1, 6, 9], 'bz2': [1, 9], 'lz4': [0, 9],
+        'zstd': [1, 3, 9, 19]}
+
+
+def bench_compression(workdir, options):
+    data = synthetic.spectrum_data(min(options.size, 64 * 1024 * 1024))
+    results = {'bytes': len(data), 'link_bytes_per_second': options.link,
+            'codecs': {'none': {'ratio': 1.0,
+                'effective_megabytes_per_second': options.link / 1e6}}}
+    for codec in compression.available():
+        for level in COMPRESSION_LEVELS[codec]:
+            compressor = compression.Compressor(codec, level, adaptive=False)
+            start = time.time()
+            compressed = compressor.compress(data, codec)
+            compress_seconds = time.time() - start
+            start = time.time()
+            assert compression.decompress(compressed, codec) == data
+            decompress_seconds = time.time() - start
+            compressor.pool.close()
+            send_seconds = len(compressed) / options.link
+            results['codecs']['{0}-{1}'.format(codec, level)] = {
+                    'ratio': len(compressed) / float(len(data)),
+                    'compress_megabytes_per_second': len(data) /
+                        compress_seconds / 1e6,
+                    'decompress_megabytes_per_second': len(data) /
+                        decompress_seconds / 1e6,
+                    'effective_megabytes_per_second': len(data) /
+                        max(compress_seconds, send_seconds) / 1e6,
+                    'cpu_bound': compress_seconds > send_seconds}
+    return results
+
+
+BENCHMARKS = [
+    ('parse_ltq', bench_parse_ltq),
+    ('parse_qexactive', bench_parse_qexactive),
+    ('follow', bench_follow),
+    ('logindex', bench_logindex),
+    ('queue', bench_queue),
+    ('startup', bench_startup),
+    ('backend_local', bench_backend_local),
+    ('backend_ssh', bench_backend_ssh),
+    ('metadata', bench_metadata),
+    ('compression', bench_compression),
+    ]
+
+
+def version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always',
+            '--dirty'], cwd=HERE, stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmarks of the file '
+            'transfer daemons on synthetic data')
+    parser.add_argument('--lines', type=int, default=2000000,
+            help='loglines to generate')
+    parser.add_argument('--files', type=int, default=5,
+            help='raw files to transfer')
+    parser.add_argument('--size', type=int, default=256 * 1024 * 1024,
+            help='size of raw files in bytes')
+    parser.add_argument('--link', type=float, default=125e6,
+            help='network bytes per second for the compression benchmark')
+    parser.add_argument('--only', nargs='+', choices=[x[0] for x in
+        BENCHMARKS], help='benchmarks to run, default all')
+    parser.add_argument('--output', help='write JSON here instead of stdout')
+    options = parser.parse_args(argv)
+    results = {'version': version(), 'python': platform.python_version(),
+            'platform': platform.platform(), 'time': time.time(),
+            'options': {'lines': options.lines, 'files': options.files,
+                'size': options.size, 'link': options.link},
+            'benchmarks': {}}
+    for name, benchmark in BENCHMARKS:
+        if options.only and name not in options.only:
+            continue
+        workdir = tempfile.mkdtemp(prefix='bench_{0}_'.format(name))
+        try:
+            results['benchmarks'][name] = benchmark(workdir, options)
+        except ImportError as e:
+            results['benchmarks'][name] = {'skipped': str(e)}
+        finally:
+            shutil.rmtree(workdir)
+        sys.stderr.write('{0} done\n'.format(name))
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as fp:
+            fp.write(output)
+    else:
+        print output
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,82 @@
+"""
+Synthetic instrument data for the benchmarks: LTQ day logs
+(LTQ_YYYYMMDD.LOG), Q Exactive logs rotated into several
+Thermo Exactive--* files, sparse raw files, which take no disk space
+but read like files of their full size, and spectrum-like data to
+compress.
+"""
+
+import os, random, struct, datetime
+
+from bench_logparser import ltq_lines, qexactive_lines
+
+START = datetime.datetime(2014, 3, 12)
+
+
+def write_lines(fn, lines, mode='w'):
+    count = 0
+    with open(fn, mode) as fp:
+        for line in lines:
+            fp.write(line)
+            fp.write('\r\n')
+            count += 1
+    return count
+
+
+def ltq_logs(directory, nlines, days=2):
+    """Writes nlines spread over a logfile per day, returns the files with
+    the date of each"""
+    logs = []
+    for day in range(days):
+        date = (START + datetime.timedelta(day)).date()
+        fn = os.path.join(directory, 'LTQ_{0}.LOG'.format(
+            date.strftime('%Y%m%d')))
+        write_lines(fn, ltq_lines(nlines // days))
+        logs.append((fn, date))
+    return logs
+
+
+def qexactive_logs(directory, nlines, rotate_every=500000):
+    """Writes nlines to Q Exactive logs, starting a new file every
+    rotate_every lines as the instrument software does"""
+    logs = []
+    lines = qexactive_lines(nlines)
+    for number in range(0, nlines, rotate_every):
+        stamp = (START + datetime.timedelta(hours=number // rotate_every)
+                ).strftime('%Y-%m-%d_%H-%M-%S')
+        fn = os.path.join(directory, 'Thermo Exactive--{0}.log'.format(stamp))
+        write_lines(fn, (next(lines) for x in xrange(min(rotate_every,
+            nlines - number))))
+        logs.append(fn)
+    return logs
+
+
+def sparse_raw_files(directory, count, size):
+    """count raw files of size bytes without using disk space, each starts
+    with a small header so files differ"""
+    files = []
+    for number in range(count):
+        fn = os.path.join(directory, 'run_{0:04d}.raw'.format(number))
+        with open(fn, 'wb') as fp:
+            fp.write('synthetic raw file {0}\n'.format(number))
+            if size > fp.tell():
+                fp.seek(size - 1)
+                fp.write('\0')
+        files.append(fn)
+    return files
+
+
+def spectrum_data(size, seed=0):
+    """size bytes that compress about like raw files: scans of increasing
+    m/z values as floats with noisy intensities and zero padding"""
+    rnd = random.Random(seed)
+    scans, length = [], 0
+    while length < size:
+        peaks = rnd.randint(50, 500)
+        mz = [400.0 + x * rnd.uniform(0.5, 4) for x in range(peaks)]
+        intensity = [int(rnd.expovariate(1e-4)) for x in range(peaks)]
+        scan = struct.pack('<{0}d{0}I'.format(peaks), *(mz + intensity)) + \
+                '\0' * rnd.randint(0, 4096)
+        scans.append(scan)
+        length += len(scan)
+    return ''.join(scans)[:size]
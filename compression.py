@@ -0,0 +1,158 @@
+"""
+Compression of data sent by the chunked transfer backend. Chunks are split
+in blocks that are compressed by several threads at once (zlib, bz2 and the
+optional lz4 and zstandard release the GIL), and sent as frames of
+(compressed flag, length, raw length, payload). Blocks that do not
+compress are sent stored. The receiving side decompresses frames before
+appending them to the partial file, so the checksum comparison of the
+backend verifies the decompressed file against the original.
+
+In adaptive mode compression is switched off for a while when compressing
+a chunk takes longer than sending it, i.e. when the CPU and not the
+network is the bottleneck.
+
+The receiving side (transfer box) runs this file:
+    python compression.py codecs
+    python compression.py append CODEC PARTIALFILE < frames
+"""
+
+import sys, zlib, bz2, struct, logging, StringIO
+from multiprocessing.pool import ThreadPool
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+log = logging.getLogger(__name__)
+
+BLOCK_SIZE = 1024 * 1024
+THREADS = 4
+LEVEL = 1
+STORE_RATIO = 0.98 # blocks compressing worse than this are sent stored
+PAUSE_CHUNKS = 8 # chunks sent uncompressed before compressing is tried again
+FRAME = struct.Struct('>BII')
+STORED, COMPRESSED = 0, 1
+
+CODECS = {
+    'zlib': (lambda data, level: zlib.compress(data, level), zlib.decompress),
+    'bz2': (lambda data, level: bz2.compress(data, level), bz2.decompress),
+    }
+if lz4 is not None:
+    CODECS['lz4'] = (lambda data, level: lz4.frame.compress(data,
+        compression_level=level), lz4.frame.decompress)
+if zstandard is not None:
+    CODECS['zstd'] = (lambda data, level: zstandard.ZstdCompressor(
+        level=level).compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data))
+# fastest first, used when the codec is 'auto'
+PREFERENCE = ['zstd', 'lz4', 'zlib', 'bz2']
+
+
+def available():
+    return [x for x in PREFERENCE if x in CODECS]
+
+
+def negotiate(wanted, remote):
+    """Codec to use given the wanted one ('auto' for the first available
+    in PREFERENCE) and those the receiving side supports. None means send
+    uncompressed."""
+    candidates = available() if wanted == 'auto' else [wanted]
+    for codec in candidates:
+        if codec in CODECS and codec in remote:
+            return codec
+    return None
+
+
+def frame(flag, payload, rawlength):
+    return FRAME.pack(flag, len(payload), rawlength) + payload
+
+
+class Compressor(object):
+    def __init__(self, codec='auto', level=LEVEL, threads=THREADS,
+            blocksize=BLOCK_SIZE, adaptive=True):
+        self.codec = codec
+        self.level = level
+        self.blocksize = blocksize
+        self.adaptive = adaptive
+        self.pool = ThreadPool(threads)
+        self.paused = 0
+
+    def _block(self, args):
+        codec, data = args
+        compressed = CODECS[codec][0](data, self.level)
+        if len(compressed) >= len(data) * STORE_RATIO:
+            return frame(STORED, data, len(data))
+        return frame(COMPRESSED, compressed, len(data))
+
+    def compress(self, data, codec):
+        """Frames of data, blocks compressed in parallel with codec"""
+        blocks = [data[i:i + self.blocksize] for i in range(0, len(data),
+            self.blocksize)]
+        if self.paused:
+            self.paused -= 1
+            return ''.join(frame(STORED, x, len(x)) for x in blocks)
+        return ''.join(self.pool.imap(self._block, [(codec, x) for x in
+            blocks]))
+
+    def account(self, compress_seconds, send_seconds):
+        """Called with the time it took to compress and to send a chunk"""
+        if self.adaptive and not self.paused and \
+                compress_seconds > send_seconds:
+            log.info('Compressing ({0:.2f} s) is slower than sending ({1:.2f} '
+                    's), pausing compression for {2} chunks'.format(
+                        compress_seconds, send_seconds, PAUSE_CHUNKS))
+            self.paused = PAUSE_CHUNKS
+
+
+def iter_frames(fp):
+    """Generator of (flag, payload, raw length) read from a file object"""
+    while True:
+        header = fp.read(FRAME.size)
+        if not header:
+            return
+        if len(header) < FRAME.size:
+            raise IOError('Truncated frame header')
+        flag, length, rawlength = FRAME.unpack(header)
+        payload = fp.read(length)
+        if len(payload) < length:
+            raise IOError('Truncated frame')
+        yield flag, payload, rawlength
+
+
+def decompress_frames(fp, codec):
+    """Generator of the original data of the frames in file object fp"""
+    decompress = CODECS[codec][1] if codec else None
+    for flag, payload, rawlength in iter_frames(fp):
+        data = payload if flag == STORED else decompress(payload)
+        if len(data) != rawlength:
+            raise IOError('Decompressed block has {0} bytes instead of '
+                    '{1}'.format(len(data), rawlength))
+        yield data
+
+
+def decompress(data, codec):
+    return ''.join(decompress_frames(StringIO.StringIO(data), codec))
+
+
+def append(codec, fn, stream=None):
+    """Decompresses frames from stream (stdin) and appends them to fn"""
+    stream = stream or sys.stdin
+    with open(fn, 'ab') as fp:
+        for data in decompress_frames(stream, codec):
+            fp.write(data)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['codecs']:
+        print ' '.join(available())
+    elif sys.argv[1:2] == ['append'] and len(sys.argv) == 4:
+        append(sys.argv[2], sys.argv[3])
+    else:
+        print __doc__
+        sys.exit(1)
@@ -0,0 +1,86 @@
+"""
+Frees disk space by deleting raw files that are confirmed to be archived,
+only when needed: once free space drops below the low watermark, files are
+evicted until the high watermark is free again. Candidates are ranked
+oldest first and, at equal age, largest first. Archive status is asked
+for in rank order, one batch at a time, so only as many files are checked
+as are needed to free enough space.
+"""
+
+import os, logging, datetime, collections, ctypes
+
+log = logging.getLogger(__name__)
+
+LOW_WATERMARK = 10 # percent free
+HIGH_WATERMARK = 20
+BATCH_SIZE = 500
+
+# key identifies the file to the caller, date is when it was closed or
+# archived
+Candidate = collections.namedtuple('Candidate', 'key path size date')
+
+
+def disk_usage(path):
+    """(free bytes, total bytes) of the disk path is on"""
+    if os.name == 'nt':
+        free, total = ctypes.c_ulonglong(), ctypes.c_ulonglong()
+        if not ctypes.windll.kernel32.GetDiskFreeSpaceExW(
+                ctypes.c_wchar_p(path), ctypes.byref(free),
+                ctypes.byref(total), None):
+            raise ctypes.WinError()
+        return free.value, total.value
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize, st.f_blocks * st.f_frsize
+
+
+class Watermarks(object):
+    def __init__(self, low=LOW_WATERMARK, high=HIGH_WATERMARK):
+        """low and high in percent of the disk that is free"""
+        if low > high:
+            raise ValueError('Low watermark {0} is above high watermark '
+                    '{1}'.format(low, high))
+        self.low = low
+        self.high = high
+
+    def to_free(self, path):
+        """Bytes to delete from the disk of path, 0 while above the low
+        watermark"""
+        free, total = disk_usage(path)
+        if free * 100.0 / total >= self.low:
+            return 0
+        needed = int(total * self.high / 100.0 - free)
+        log.info('{0:.1f}% of disk of {1} is free, below low watermark of '
+                '{2}%, freeing {3} bytes'.format(free * 100.0 / total, path,
+                    self.low, needed))
+        return needed
+
+
+def rank(candidates):
+    """Oldest first, then largest first"""
+    return sorted(candidates, key=lambda x: (x.date, -x.size))
+
+
+def select(candidates, needed, archived, min_age=0, batchsize=BATCH_SIZE):
+    """Returns the archived candidates to evict to free needed bytes.
+    archived(paths) returns those of paths that are confirmed archived.
+    Files younger than min_age days are kept."""
+    limit = datetime.datetime.now() - datetime.timedelta(min_age)
+    ranked = [x for x in rank(candidates) if x.date <= limit]
+    selected, freed = [], 0
+    for start in range(0, len(ranked), batchsize):
+        if freed >= needed:
+            break
+        batch = ranked[start:start + batchsize]
+        confirmed = set(archived([x.path for x in batch]))
+        for candidate in batch:
+            if freed >= needed:
+                break
+            if candidate.path in confirmed:
+                selected.append(candidate)
+                freed += candidate.size
+    if freed < needed:
+        log.warning('Evicting all {0} archived files frees {1} bytes, {2} '
+                'bytes short of high watermark'.format(len(selected), freed,
+                    needed - freed))
+    return selected
+
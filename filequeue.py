@@ -0,0 +1,115 @@
+"""
+In-memory file queue with indexes, so finding files to transfer or old
+files to remove does not need a scan over the whole queue.
+"""
+
+import bisect, collections
+
+
+class FileQueue(object):
+    """Behaves like the old {key: {'file': fn, 'status': ..}} dict for
+    reading. Entries must be changed with add/update/remove, which keep
+    the indexes (status -> keys, date-sorted finished entries) and the list
+    of changes for the queue store up to date.
+
+    datefield is the entry field used for expiry, entries in expirystatus
+    are kept sorted on it. Values have to be comparable, e.g. datetimes or
+    YYYYMMDD strings.
+    """
+    def __init__(self, entries=None, datefield='date', expirystatus='done'):
+        self.datefield = datefield
+        self.expirystatus = expirystatus
+        self.entries = {}
+        self.by_status = collections.defaultdict(set)
+        self.by_date = [] # sorted [(date, key)] of entries in expirystatus
+        self.changed = set()
+        self.removed = set()
+        for key, entry in (entries or {}).items():
+            self._add(key, dict(entry))
+        self.changed = set()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __getitem__(self, key):
+        return self.entries[key]
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def items(self):
+        return self.entries.items()
+
+    def keys(self):
+        return self.entries.keys()
+
+    def _date_item(self, key):
+        entry = self.entries[key]
+        if entry.get('status') == self.expirystatus and \
+                entry.get(self.datefield):
+            return (entry[self.datefield], key)
+        return None
+
+    def _index(self, key):
+        self.by_status[self.entries[key].get('status')].add(key)
+        item = self._date_item(key)
+        if item:
+            bisect.insort(self.by_date, item)
+
+    def _unindex(self, key):
+        self.by_status[self.entries[key].get('status')].discard(key)
+        item = self._date_item(key)
+        if item:
+            del(self.by_date[bisect.bisect_left(self.by_date, item)])
+
+    def _add(self, key, entry):
+        self.entries[key] = entry
+        self._index(key)
+        self.changed.add(key)
+        self.removed.discard(key)
+
+    def add(self, key, **fields):
+        if key in self.entries:
+            raise KeyError('{0} already in queue'.format(key))
+        self._add(key, fields)
+
+    def update(self, key, **fields):
+        self._unindex(key)
+        self.entries[key].update(fields)
+        self._index(key)
+        self.changed.add(key)
+
+    def remove(self, key):
+        self._unindex(key)
+        del(self.entries[key])
+        self.changed.discard(key)
+        self.removed.add(key)
+
+    def with_status(self, status):
+        """Keys of entries with status, as a list so the queue may be
+        changed while looping over it"""
+        return list(self.by_status[status])
+
+    def count(self, status):
+        return len(self.by_status[status])
+
+    def newest_with_status(self, status):
+        """Highest key with status, keys are opening timestamps for the
+        Orbitrap queues"""
+        keys = self.by_status[status]
+        return max(keys) if keys else None
+
+    def expired(self, before):
+        """Keys of entries in expirystatus with date before before"""
+        end = bisect.bisect_left(self.by_date, (before,))
+        return [key for date, key in self.by_date[:end]]
+
+    def pop_changes(self):
+        """Returns ({key: entry} changed, [keys] removed) since last call"""
+        changed = dict((key, self.entries[key]) for key in self.changed)
+        removed = list(self.removed)
+        self.changed, self.removed = set(), set()
+        return changed, removed
@@ -0,0 +1,213 @@
+"""
+Content fingerprints of raw files, to recognise a file after it has been
+renamed and to avoid sending the same content twice. The fingerprint is a
+hash of the size and the first and last block of a file, which takes two
+reads however large the file is. A full hash is computed in the background
+to confirm matches. Fingerprints are kept in an index with the size and
+mtime of each file, so unchanged files are not read again.
+
+On the transfer box, run on a folder to index it and list duplicates:
+    python fingerprint.py folder [index.sqlite]
+"""
+
+import os, sys, hashlib, logging, sqlite3, threading, Queue, collections
+
+log = logging.getLogger(__name__)
+
+INDEX_DB = 'fingerprints.sqlite'
+BLOCK_SIZE = 1024 * 1024
+BUFFER_SIZE = 4 * 1024 * 1024
+
+
+def partial_fingerprint(fn, blocksize=BLOCK_SIZE):
+    digest = hashlib.sha1()
+    with open(fn, 'rb') as fp:
+        fp.seek(0, os.SEEK_END)
+        size = fp.tell()
+        digest.update(str(size))
+        fp.seek(0)
+        digest.update(fp.read(blocksize))
+        if size > blocksize:
+            fp.seek(max(size - blocksize, blocksize))
+            digest.update(fp.read(blocksize))
+    return digest.hexdigest()
+
+
+def full_hash(fn):
+    digest = hashlib.sha1()
+    with open(fn, 'rb') as fp:
+        for data in iter(lambda: fp.read(BUFFER_SIZE), ''):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+class FingerprintIndex(object):
+    def __init__(self, dbfile=INDEX_DB):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(dbfile, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS files (path TEXT '
+                    'PRIMARY KEY, size INTEGER, mtime REAL, partial TEXT, '
+                    'full TEXT, sent INTEGER DEFAULT 0)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS files_partial ON '
+                    'files (partial)')
+
+    def fingerprint(self, path):
+        """Partial fingerprint of path, from the index when the file did
+        not change"""
+        st = os.stat(path)
+        with self.lock:
+            row = self.db.execute('SELECT size, mtime, partial FROM files '
+                    'WHERE path=?', (path,)).fetchone()
+        if row and row[0] == st.st_size and row[1] == st.st_mtime:
+            return row[2]
+        partial = partial_fingerprint(path)
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO files (path, size, mtime, '
+                    'partial, full, sent) VALUES (?, ?, ?, ?, NULL, 0)',
+                    (path, st.st_size, st.st_mtime, partial))
+        return partial
+
+    def full(self, path):
+        """Full hash of path if it has been computed"""
+        with self.lock:
+            row = self.db.execute('SELECT full FROM files WHERE path=?',
+                    (path,)).fetchone()
+        return row[0] if row else None
+
+    def set_full(self, path, digest):
+        with self.lock, self.db:
+            self.db.execute('UPDATE files SET full=? WHERE path=?', (digest,
+                path))
+
+    def find(self, partial):
+        """Paths with fingerprint partial"""
+        with self.lock:
+            return [x[0] for x in self.db.execute('SELECT path FROM files '
+                'WHERE partial=?', (partial,))]
+
+    def mark_sent(self, path):
+        with self.lock, self.db:
+            self.db.execute('UPDATE files SET sent=1 WHERE path=?', (path,))
+
+    def sent_copy(self, path):
+        """Another path with the same content as path that has already
+        been sent, or None. Partial matches are only trusted when both full
+        hashes are known and equal."""
+        partial, full = self.fingerprint(path), self.full(path)
+        if full is None:
+            return None
+        with self.lock:
+            row = self.db.execute('SELECT path FROM files WHERE partial=? AND '
+                    'full=? AND sent=1 AND path!=?', (partial, full,
+                        path)).fetchone()
+        return row[0] if row else None
+
+    def forget(self, path):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM files WHERE path=?', (path,))
+
+    def scan(self, directory, suffix=None):
+        """Indexes the files in directory, returns their paths"""
+        paths = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if suffix and not name.lower().endswith(suffix):
+                continue
+            if not os.path.isfile(path):
+                continue
+            try:
+                self.fingerprint(path)
+            except (IOError, OSError):
+                continue
+            paths.append(path)
+        return paths
+
+    def find_renamed(self, partial, directory, suffix=None, exclude=()):
+        """Path of a file in directory with fingerprint partial, e.g. the
+        new name of a file that was renamed after closing. Paths in
+        exclude (e.g. other known files with the same content) are
+        skipped."""
+        present = set(self.scan(directory, suffix)) - set(exclude)
+        for path in self.find(partial):
+            if path in present:
+                return path
+        return None
+
+    def duplicates(self):
+        """Groups of paths with the same full hash"""
+        with self.lock:
+            rows = self.db.execute('SELECT full, path FROM files WHERE full '
+                    'IS NOT NULL ORDER BY full').fetchall()
+        groups, last = [], None
+        for full, path in rows:
+            if full != last:
+                groups.append([])
+                last = full
+            groups[-1].append(path)
+        return [x for x in groups if len(x) > 1]
+
+
+class BackgroundHasher(object):
+    """Computes full hashes of files one at a time in a background thread.
+    on_hashed(path) is called after each file, also when it could not be
+    read."""
+    def __init__(self, index, on_hashed=None):
+        self.index = index
+        self.on_hashed = on_hashed
+        self.jobs = Queue.Queue()
+        self.thread = None
+        self.queued = collections.Counter()
+        self.lock = threading.Lock()
+
+    def submit(self, path):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._work,
+                    name='fingerprint-hasher')
+            self.thread.daemon = True
+            self.thread.start()
+        with self.lock:
+            self.queued[path] += 1
+        self.jobs.put(path)
+
+    def pending(self, path):
+        """True while path waits to be hashed"""
+        with self.lock:
+            return self.queued[path] > 0
+
+    def _work(self):
+        while True:
+            path = self.jobs.get()
+            try:
+                if self.index.full(path) is None:
+                    self.index.set_full(path, full_hash(path))
+            except (IOError, OSError) as e:
+                log.warning('Could not hash {0}: {1}'.format(path, e))
+            with self.lock:
+                self.queued[path] -= 1
+                if not self.queued[path]:
+                    del(self.queued[path])
+            if self.on_hashed is not None:
+                self.on_hashed(path)
+            self.jobs.task_done()
+
+    def join(self):
+        self.jobs.join()
+
+
+def main(directory, dbfile=INDEX_DB):
+    index = FingerprintIndex(dbfile)
+    hasher = BackgroundHasher(index)
+    for path in index.scan(directory):
+        hasher.submit(path)
+    hasher.join()
+    for group in index.duplicates():
+        print 'Same content: {0}'.format(', '.join(group))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3):
+        print __doc__
+        sys.exit()
+    main(*sys.argv[1:])
@@ -0,0 +1,94 @@
+"""
+Index of the logfiles in an instrument log directory, sorted on the
+timestamp in their names. The directory is only listed again when its
+mtime changed, i.e. when files were added or removed, and only names that
+are new since the last listing are parsed. Q Exactive log directories hold
+years of Thermo Exactive--* files, of which usually only the newest is
+needed.
+"""
+
+import os, re, time, bisect, datetime, logging
+
+log = logging.getLogger(__name__)
+
+# Thermo Exactive--2014-03-12_10-26-15.log, time may be missing
+QEXACTIVE = re.compile(r'^Thermo Exactive--(\d{4})-(\d{2})-(\d{2})'
+        r'(?:[_ ](\d{2})-(\d{2})-(\d{2}))?')
+# LTQ_20140312.LOG
+LTQ = re.compile(r'^LTQ_(\d{4})(\d{2})(\d{2})\.LOG$', re.IGNORECASE)
+# directory mtimes this close to the listing are not trusted, a file
+# created in the same clock tick would not change it again
+MTIME_SLACK = 2 # seconds
+
+
+def name_timestamp(pattern, name):
+    """Timestamp in a logfile name, None if it does not match pattern"""
+    match = pattern.match(name)
+    if match is None:
+        return None
+    try:
+        return datetime.datetime(*[int(x) for x in match.groups() if x is not
+            None])
+    except ValueError:
+        return None
+
+
+class LogIndex(object):
+    def __init__(self, directory, pattern):
+        self.directory = directory
+        self.pattern = pattern
+        self.logs = [] # sorted [(timestamp, name)]
+        self.names = {} # name -> timestamp, None for names not matching
+        self.mtime = None
+
+    def refresh(self):
+        """Updates the index if the directory changed"""
+        try:
+            mtime = os.stat(self.directory).st_mtime
+        except OSError:
+            if self.logs:
+                log.warning('Log directory {0} is gone'.format(
+                    self.directory))
+            self.logs, self.names, self.mtime = [], {}, None
+            return
+        if mtime == self.mtime:
+            return
+        present = set(os.listdir(self.directory))
+        for name in set(self.names) - present:
+            timestamp = self.names.pop(name)
+            if timestamp is not None:
+                self.logs.remove((timestamp, name))
+        for name in present - set(self.names):
+            timestamp = self.names[name] = name_timestamp(self.pattern, name)
+            if timestamp is not None:
+                bisect.insort(self.logs, (timestamp, name))
+        self.mtime = mtime if time.time() - mtime > MTIME_SLACK else None
+
+    def newest(self):
+        """(path, timestamp) of the newest log, or None"""
+        self.refresh()
+        if not self.logs:
+            return None
+        timestamp, name = self.logs[-1]
+        return os.path.join(self.directory, name), timestamp
+
+    def to_follow(self, positions):
+        """[(path, timestamp)] of the logs to read, oldest first: the
+        newest log that has a position in positions (a LogFollower's),
+        which may have been written to after it was rotated, and all newer
+        logs. Only the newest log when none has been read yet."""
+        self.refresh()
+        for timestamp, name in reversed(self.logs):
+            if os.path.join(self.directory, name) in positions:
+                return self.since(timestamp)
+        return [(os.path.join(self.directory, name), timestamp) for
+                timestamp, name in self.logs[-1:]]
+
+    def since(self, when=None):
+        """[(path, timestamp)] of logs named with a timestamp of when or
+        later, oldest first, all logs when is None"""
+        self.refresh()
+        start = 0 if when is None else bisect.bisect_left(self.logs,
+                (when, ''))
+        return [(os.path.join(self.directory, name), timestamp) for
+                timestamp, name in self.logs[start:]]
@@ -0,0 +1,105 @@
+"""
+Parses instrument logfiles into acquisition events. Each instrument type
+has a Grammar: precompiled patterns for its timestamps and for the lines
+that start, stop and close an acquisition. Lines are checked for their
+event text first with a substring test, so the timestamp is only parsed
+for the few lines that are events, and never with strptime.
+"""
+
+import re, datetime, collections
+
+START, STOP, CLOSED = 'start', 'stop', 'closed'
+
+# stamp is the timestamp as written in the log, filename is only set for
+# START events
+LogEvent = collections.namedtuple('LogEvent', 'kind timestamp stamp filename '
+        'line')
+
+
+class Grammar(object):
+    """name: instrument type
+    timestamp: regex matching at the start of a line, with groups
+    (year, month, day, hour, minute, second, fraction). Date groups may be
+    left out when the date comes from the logfile name.
+    events: [(kind, literal, regex)], literal is searched for first, regex
+    is searched for afterwards and its first group is the filename of
+    START events.
+    """
+    def __init__(self, name, timestamp, events, dated=True):
+        self.name = name
+        self.timestamp = re.compile(timestamp)
+        self.events = [(kind, literal, re.compile(pattern) if pattern else None)
+                for kind, literal, pattern in events]
+        self.dated = dated
+        self.dates = {} # cache of parsed date parts
+
+    def _date(self, year, month, day):
+        key = (year, month, day)
+        try:
+            return self.dates[key]
+        except KeyError:
+            self.dates[key] = date = (int(year), int(month), int(day))
+            return date
+
+    def parse_timestamp(self, line, logdate=None):
+        """Returns (datetime, stamp as written) or (None, None)"""
+        match = self.timestamp.match(line)
+        if match is None:
+            return None, None
+        if self.dated:
+            year, month, day, hour, minute, second, fraction = match.groups()
+            date = self._date(year, month, day)
+        else:
+            hour, minute, second, fraction = match.groups()
+            date = (logdate.year, logdate.month, logdate.day)
+        micro = int((fraction + '000000')[:6]) if fraction else 0
+        return datetime.datetime(date[0], date[1], date[2], int(hour),
+                int(minute), int(second), micro), line[match.start(1):match.end()]
+
+    def event(self, line, logdate=None):
+        """Returns LogEvent for line or None if it is not an event"""
+        for kind, literal, pattern in self.events:
+            if literal not in line:
+                continue
+            filename = None
+            if pattern is not None:
+                match = pattern.search(line)
+                if match is None:
+                    continue
+                filename = match.group(1).strip()
+            timestamp, stamp = self.parse_timestamp(line, logdate)
+            if timestamp is None:
+                return None
+            return LogEvent(kind, timestamp, stamp, filename, line)
+        return None
+
+
+# LTQ_YYYYMMDD.LOG, date comes from the logfile name:
+# 10:26:15.937:  Raw file created, actual name = C:\Xcalibur\data\x.raw
+LTQ = Grammar('LTQ Orbitrap',
+        r'\s*(\d{1,2}):?(\d{2}):?(\d{2})(?:[.,](\d+))?(?=:  )',
+        [(START, 'Raw file created', r'Raw file created, actual name\s*=(.*)'),
+            (CLOSED, 'Closed raw file', None),
+            ], dated=False)
+
+# Thermo Exactive--YYYY-MM-DD..., every line has its full date:
+# [Time=2014-03-12 10:26:15.9375+01:00] Starting acquisition: ...
+QEXACTIVE = Grammar('Q Exactive',
+        r'\[[^\]=]*=(\d{4})-(\d{2})-(\d{2}) (\d{2}):(\d{2}):(\d{2})(?:\.(\d+))?',
+        [(START, 'Starting acquisition', r'Starting acquisition: Xcalibur '
+            r'will write (.*?) \(and may add date/time to the name\)'),
+            (STOP, 'Stopping acquisition', None),
+            (STOP, 'MS acquisition end', None),
+            (CLOSED, 'Storing acquisition scan', None),
+            ])
+
+
+def parse(lines, grammar, logdate=None):
+    """Generator of LogEvents from an iterable of loglines, e.g.
+    LogFollower.iter_new_lines. logdate (a date) is needed for grammars
+    whose lines have no date."""
+    event = grammar.event
+    for line in lines:
+        parsed = event(line, logdate)
+        if parsed is not None:
+            yield parsed
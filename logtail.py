@@ -0,0 +1,164 @@
+"""
+Incremental reading of instrument logfiles. For every logfile we remember
+how far it has been read (byte offset, plus any unfinished last line), so
+each iteration only has to parse what the instrument wrote since the
+previous one. Positions are persisted so a restart does not re-read logs,
+in a JSON file or in the state store of the queue database.
+"""
+
+import os, json, logging, binascii
+
+log = logging.getLogger(__name__)
+
+POSITIONS_FILE = 'logpositions.json'
+READ_CHUNK = 1024 * 1024
+HEAD_LENGTH = 128 # bytes used to recognise a logfile that has been replaced
+STATE_SECTION = 'logpositions'
+
+
+def replace_file(tmpfn, fn):
+    """Rename tmpfn to fn. Windows does not allow renaming onto an existing
+    file, so remove the old one there first."""
+    try:
+        os.rename(tmpfn, fn)
+    except OSError:
+        os.remove(fn)
+        os.rename(tmpfn, fn)
+
+
+def encode_position(pos):
+    """Raw bytes of unfinished lines are stored hex encoded, JSON cannot
+    hold undecodable instrument output"""
+    return dict(pos, partial=binascii.hexlify(pos['partial']),
+            head=binascii.hexlify(pos['head']))
+
+
+def decode_position(pos):
+    return dict(pos, partial=binascii.unhexlify(pos['partial']),
+            head=binascii.unhexlify(pos['head']))
+
+
+class LogFollower(object):
+    """Keeps per-logfile read positions:
+    {logfile: {inode, size, mtime, offset, partial, head}}
+    With state (a queuestore.StateStore) positions are kept there, and
+    written with the next queue save, statefile is then only migrated.
+    Without statefile and state positions are only kept in memory.
+    """
+    def __init__(self, statefile=POSITIONS_FILE, state=None):
+        self.statefile = statefile
+        self.state = state
+        self.positions = {}
+        self.saved = {} # encoded positions as last given to state
+        self.load()
+
+    def load(self):
+        if self.state is None:
+            if self.statefile is not None:
+                self.load_file()
+            return
+        self.saved = dict(self.state.section(STATE_SECTION))
+        if not self.saved and os.path.exists(self.statefile):
+            self.load_file()
+            self.save()
+            os.rename(self.statefile, '{0}.migrated'.format(self.statefile))
+            log.info('Migrated logfile positions from {0}'.format(
+                self.statefile))
+            return
+        self.positions = dict((logfile, decode_position(pos)) for logfile,
+                pos in self.saved.items())
+
+    def load_file(self):
+        try:
+            with open(self.statefile) as fp:
+                self.positions = dict((logfile, decode_position(pos)) for
+                        logfile, pos in json.load(fp).items())
+        except IOError:
+            log.info('Could not open {0}, all logfiles will be read from '
+                    'the start.'.format(self.statefile))
+            self.positions = {}
+        except ValueError:
+            log.warning('Could not parse JSON from {0}, all logfiles will be '
+                    'read from the start.'.format(self.statefile))
+            self.positions = {}
+
+    def save(self):
+        if self.state is not None:
+            # only positions that changed go to the journal
+            for logfile, pos in self.positions.items():
+                encoded = encode_position(pos)
+                if self.saved.get(logfile) != encoded:
+                    self.state.set(STATE_SECTION, logfile, encoded)
+                    self.saved[logfile] = encoded
+            for logfile in set(self.saved) - set(self.positions):
+                self.state.delete(STATE_SECTION, logfile)
+                del self.saved[logfile]
+            return
+        if self.statefile is None:
+            return
+        tmpfn = '{0}.tmp'.format(self.statefile)
+        try:
+            positions = dict((logfile, encode_position(pos)) for logfile, pos
+                    in self.positions.items())
+            with open(tmpfn, 'w') as fp:
+                json.dump(positions, fp)
+            replace_file(tmpfn, self.statefile)
+        except (IOError, OSError):
+            log.error('Could not save logfile positions in {0}'.format(
+                self.statefile))
+            raise
+
+    def forget(self, logfile):
+        self.positions.pop(logfile, None)
+
+    def _read_head(self, logfile):
+        with open(logfile, 'rb') as fp:
+            return fp.read(HEAD_LENGTH)
+
+    def _start_position(self, logfile, stat):
+        """Returns stored position of logfile, or a fresh one when the file
+        is new, rotated or truncated."""
+        pos = self.positions.get(logfile)
+        head = self._read_head(logfile)
+        if pos is not None:
+            if pos['inode'] != stat.st_ino:
+                log.info('Logfile {0} has been replaced, reading it from '
+                        'the start'.format(logfile))
+            elif stat.st_size < pos['offset']:
+                log.info('Logfile {0} has been truncated, reading it from '
+                        'the start'.format(logfile))
+            elif not head.startswith(pos['head']) and \
+                    not pos['head'].startswith(head):
+                log.info('Logfile {0} has been rotated, reading it from '
+                        'the start'.format(logfile))
+            else:
+                pos['head'] = head
+                return pos
+        pos = {'inode': stat.st_ino, 'size': 0, 'mtime': 0, 'offset': 0,
+                'partial': '', 'head': head}
+        self.positions[logfile] = pos
+        return pos
+
+    def iter_new_lines(self, logfile):
+        """Generator yielding complete lines (without line ending) that were
+        appended to logfile since the last call. A trailing line without
+        newline is kept back until it is finished. Raises IOError/OSError
+        when the logfile cannot be read."""
+        stat = os.stat(logfile)
+        pos = self._start_position(logfile, stat)
+        if stat.st_size == pos['offset'] and stat.st_mtime == pos['mtime']:
+            return
+        with open(logfile, 'rb') as fp:
+            fp.seek(pos['offset'])
+            while True:
+                data = fp.read(READ_CHUNK)
+                if not data:
+                    break
+                pos['offset'] += len(data)
+                lines = (pos['partial'] + data).split('\n')
+                pos['partial'] = lines.pop()
+                for line in lines:
+                    yield line.rstrip('\r')
+        pos['size'] = pos['offset']
+        pos['mtime'] = stat.st_mtime
+        pos['inode'] = stat.st_ino
@@ -1,17 +1,221 @@
-import cookielib, urllib2, urllib, json
-from lxml import html
-
-def query_metadata_server(files, url, login=None):
-    data = [('fn',x) for x in files] 
-    if login:
-        cj = cookielib.CookieJar()
-        opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(cj))
-        urllib2.install_opener(opener)
-        
-        doc = urllib2.urlopen(login).read()
-        token = html.fromstring(doc).xpath('//input[@name="csrfmiddlewaretoken"]/@value')[0]
-        data.append(('csrfmiddlewaretoken', token))
-    
-    data = urllib.urlencode(data)
-    response = urllib2.urlopen(url, data).read()
-    return json.loads(response)
+import urllib, json, httplib, urlparse, Cookie, socket
+import threading, time, logging
+from lxml import etree, html
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+BATCH_SIZE = 500 # filenames per request
+WORKERS = 4 # concurrent requests
+RETRIES = 4
+BACKOFF = 1 # seconds, doubled for every retry
+TOKEN_LIFETIME = 3600 # seconds before a new CSRF token is fetched
+TIMEOUT = 60
+
+QUERY_SECONDS = metrics.histogram('metadata_query_seconds', 'Duration of '
+        'rawstatus requests, including retries')
+QUERY_RETRIES = metrics.counter('metadata_query_retries_total', 'Retried '
+        'rawstatus requests')
+QUERY_FILES = metrics.counter('metadata_query_files_total', 'Files asked for '
+        'by result: cached or sent to the server', ['source'])
+
+
+class MetadataError(Exception):
+    pass
+
+
+class MetadataClient(object):
+    """Queries the Kantele rawstatus view. Keeps a pool of keep-alive HTTP
+    connections, session cookies and the CSRF token between queries. Long
+    lists of files are sent in concurrent batches. With a
+    statuscache.StatusCache, only files without a cached answer are sent."""
+    def __init__(self, url, login=None, batchsize=BATCH_SIZE, workers=WORKERS,
+            retries=RETRIES, backoff=BACKOFF, token_lifetime=TOKEN_LIFETIME,
+            cache=None):
+        self.url = url
+        self.cache = cache
+        self.login = login
+        self.batchsize = batchsize
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.token_lifetime = token_lifetime
+        self.token = None
+        self.token_time = 0
+        self.cookies = {}
+        self.lock = threading.Lock()
+        self.idle = {} # (scheme, host) -> [idle connections]
+
+    def _connection(self, url):
+        """Takes an idle connection to the server of url from the pool, or
+        opens a new one. Returns (connection, poolkey, path)"""
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            connection = idle.pop() if idle else None
+        if connection is None:
+            if parts.scheme == 'https':
+                connection = httplib.HTTPSConnection(parts.netloc,
+                        timeout=TIMEOUT)
+            else:
+                connection = httplib.HTTPConnection(parts.netloc,
+                        timeout=TIMEOUT)
+        path = parts.path or '/'
+        if parts.query:
+            path = '{0}?{1}'.format(path, parts.query)
+        return connection, key, path
+
+    def _request(self, method, url, body=None):
+        """Returns (status, body) of a request over a persistent connection,
+        which is returned to the pool afterwards"""
+        connection, key, path = self._connection(url)
+        with self.lock:
+            cookie = '; '.join('{0}={1}'.format(k, v) for k, v in
+                    self.cookies.items())
+        headers = {'Connection': 'keep-alive', 'Referer': self.login or url}
+        if cookie:
+            headers['Cookie'] = cookie
+        if body is not None:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        try:
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            data = response.read()
+        except (httplib.HTTPException, socket.error):
+            connection.close()
+            raise
+        with self.lock:
+            self.idle[key].append(connection)
+        for header in response.msg.getheaders('set-cookie'):
+            jar = Cookie.SimpleCookie()
+            jar.load(header)
+            with self.lock:
+                self.cookies.update((k, v.value) for k, v in jar.items())
+        return response.status, data
+
+    def _get_token(self, force=False):
+        with self.lock:
+            if not force and self.token and \
+                    time.time() - self.token_time < self.token_lifetime:
+                return self.token
+        status, doc = self._request('GET', self.login)
+        if status != 200:
+            raise MetadataError('Login page returned HTTP {0}'.format(status))
+        try:
+            token = html.fromstring(doc).xpath(
+                    '//input[@name="csrfmiddlewaretoken"]/@value')[0]
+        except (IndexError, etree.ParserError):
+            raise MetadataError('No CSRF token on login page')
+        with self.lock:
+            self.token, self.token_time = token, time.time()
+        return token
+
+    @metrics.timed(QUERY_SECONDS)
+    def query_batch(self, files):
+        """Returns server response for a list of filenames, retries with
+        exponential backoff on connection problems and server errors, and
+        gets a new CSRF token when the old one is refused"""
+        force_token = False
+        for attempt in range(self.retries + 1):
+            try:
+                data = [('fn', x) for x in files]
+                if self.login:
+                    data.append(('csrfmiddlewaretoken',
+                        self._get_token(force_token)))
+                status, response = self._request('POST', self.url,
+                        urllib.urlencode(data))
+                if status == 200:
+                    try:
+                        answer = json.loads(response)
+                    except ValueError:
+                        answer = None
+                    if not isinstance(answer, dict):
+                        raise MetadataError('Server answer is not a JSON '
+                                'object')
+                    return answer
+                elif status == 403:
+                    force_token = True
+                    error = 'HTTP 403, CSRF token refused'
+                else:
+                    error = 'HTTP {0}'.format(status)
+            except (httplib.HTTPException, socket.error, MetadataError) as e:
+                error = e
+            if attempt < self.retries:
+                QUERY_RETRIES.inc()
+                wait = self.backoff * 2 ** attempt
+                log.warning('Metadata query failed ({0}), retrying in {1} '
+                        'seconds'.format(error, wait))
+                time.sleep(wait)
+        raise MetadataError('Metadata query failed after {0} tries: '
+                '{1}'.format(self.retries + 1, error))
+
+    def batches(self, files):
+        files = list(files)
+        for i in range(0, len(files), self.batchsize):
+            yield files[i:i + self.batchsize]
+
+    def query(self, files):
+        """Returns {filename: server answer} for all files, from the cache
+        or by querying batches concurrently. Raises MetadataError when a
+        batch fails."""
+        if self.cache is None:
+            files = list(files)
+            QUERY_FILES.labels('server').inc(len(files))
+            return self.query_server(files)
+        files = list(files)
+        results = self.cache.get(files)
+        misses = [fn for fn in files if fn not in results]
+        QUERY_FILES.labels('cache').inc(len(results))
+        QUERY_FILES.labels('server').inc(len(misses))
+        log.info('{0} of {1} files found in status cache'.format(len(results),
+            len(files)))
+        if misses:
+            response = self.query_server(misses)
+            self.cache.put(response)
+            results.update(response)
+        return results
+
+    def query_server(self, files):
+        batches = list(self.batches(files))
+        if len(batches) < 2:
+            return self.query_batch(batches[0]) if batches else {}
+        results, errors = {}, []
+        pending = list(reversed(batches))
+        def work():
+            while True:
+                with self.lock:
+                    if not pending or errors:
+                        return
+                    batch = pending.pop()
+                try:
+                    response = self.query_batch(batch)
+                except MetadataError as e:
+                    with self.lock:
+                        errors.append(e)
+                    return
+                with self.lock:
+                    results.update(response)
+        threads = [threading.Thread(target=work) for x in
+                range(min(self.workers, len(batches)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return results
+
+
+_clients = {}
+
+def get_client(url, login=None, cache=None):
+    """Shared client per server, so connections and token are reused"""
+    if (url, login) not in _clients:
+        _clients[(url, login)] = MetadataClient(url, login, cache=cache)
+    return _clients[(url, login)]
+
+
+def query_metadata_server(files, url, login=None, cache=None):
+    return get_client(url, login, cache).query(files)
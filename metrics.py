@@ -0,0 +1,312 @@
+"""
+Counters, gauges and histograms for the transfer daemons, exported in the
+Prometheus text format over a local HTTP endpoint and as a JSON file that
+is rewritten periodically. Metrics are defined at import time by the
+modules that use them, and do nothing until enable() is called, so the
+cost of instrumentation when disabled is a single flag check.
+
+    TRANSFERS = metrics.counter('transfers_total', 'Finished transfers',
+            ['instrument'])
+    TRANSFERS.labels('orbi').inc()
+    with PARSE_SECONDS.time():
+        parse()
+"""
+
+import time, json, bisect, logging, threading, functools
+import BaseHTTPServer
+
+from logtail import replace_file
+
+log = logging.getLogger(__name__)
+
+# seconds, for durations from parsing a few lines to transferring a run
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900,
+        3600, 4 * 3600)
+DUMP_INTERVAL = 60
+
+_enabled = False
+_metrics = {}
+_lock = threading.Lock()
+_started = set()
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def enabled():
+    return _enabled
+
+
+class _NoTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NO_TIMER = _NoTimer()
+
+
+class _Timer(object):
+    def __init__(self, metric):
+        self.metric = metric
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.metric.observe(time.time() - self.start)
+        return False
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        """Metric for one combination of label values"""
+        try:
+            return self.children[values]
+        except KeyError:
+            with self.lock:
+                return self.children.setdefault(values, self.child())
+
+    def samples(self):
+        """[(name suffix, {label: value}, value)]"""
+        result = []
+        for values, child in sorted(self.children.items()):
+            labels = dict(zip(self.labelnames, values))
+            for suffix, extra, value in child.samples():
+                merged = dict(labels)
+                merged.update(extra)
+                result.append((suffix, merged, value))
+        return result
+
+
+class CounterValue(object):
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        if not _enabled:
+            return
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        return [('', {}, self.value)]
+
+
+class GaugeValue(CounterValue):
+    def set(self, value):
+        if not _enabled:
+            return
+        self.value = value
+
+
+class HistogramValue(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        if not _enabled:
+            return
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        """Context manager observing the seconds its block takes"""
+        return _Timer(self) if _enabled else _NO_TIMER
+
+    def samples(self):
+        result, cumulative = [], 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            result.append(('_bucket', {'le': repr(float(bound))}, cumulative))
+        result.append(('_bucket', {'le': '+Inf'}, self.count))
+        result.append(('_sum', {}, self.sum))
+        result.append(('_count', {}, self.count))
+        return result
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def child(self):
+        return CounterValue()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def child(self):
+        return GaugeValue()
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=BUCKETS):
+        Metric.__init__(self, name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def child(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+
+def _register(cls, name, *args, **kwargs):
+    with _lock:
+        if name not in _metrics:
+            _metrics[name] = cls(name, *args, **kwargs)
+        return _metrics[name]
+
+
+def counter(name, help, labelnames=()):
+    return _register(Counter, name, help, labelnames)
+
+
+def gauge(name, help, labelnames=()):
+    return _register(Gauge, name, help, labelnames)
+
+
+def histogram(name, help, labelnames=(), buckets=BUCKETS):
+    return _register(Histogram, name, help, labelnames, buckets=buckets)
+
+
+def timed(metric):
+    """Decorator observing the duration of each call in a histogram (or a
+    labelled child of one)"""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with metric.time():
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for name, metric in sorted(_metrics.items()):
+        lines.append('# HELP {0} {1}'.format(name, metric.help))
+        lines.append('# TYPE {0} {1}'.format(name, metric.kind))
+        for suffix, labels, value in metric.samples():
+            if labels:
+                labeltext = '{{{0}}}'.format(','.join('{0}="{1}"'.format(k,
+                    str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                    for k, v in sorted(labels.items())))
+            else:
+                labeltext = ''
+            lines.append('{0}{1}{2} {3}'.format(name, suffix, labeltext,
+                repr(value) if isinstance(value, float) else value))
+    return '\n'.join(lines) + '\n'
+
+
+def snapshot():
+    """{name: [{'labels': {}, 'suffix': '', 'value': v}]} for JSON"""
+    return dict((name, [{'suffix': suffix, 'labels': labels, 'value': value}
+        for suffix, labels, value in metric.samples()])
+        for name, metric in _metrics.items())
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            body, ctype = render(), 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body, ctype = json.dumps(snapshot()), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+
+def serve(port, host='127.0.0.1'):
+    """Serves /metrics and /metrics.json from a background thread"""
+    server = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+    log.info('Serving metrics on http://{0}:{1}/metrics'.format(host, port))
+    return server
+
+
+def dump(fn):
+    tmpfn = '{0}.tmp'.format(fn)
+    with open(tmpfn, 'w') as fp:
+        json.dump({'time': time.time(), 'metrics': snapshot()}, fp)
+    replace_file(tmpfn, fn)
+
+
+def dump_periodically(fn, interval=DUMP_INTERVAL):
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                dump(fn)
+            except (IOError, OSError) as e:
+                log.warning('Could not write metrics to {0}: {1}'.format(fn,
+                    e))
+    thread = threading.Thread(target=run, name='metrics-dump')
+    thread.daemon = True
+    thread.start()
+
+
+def configure(config):
+    """Enables metrics as set in the metrics section of a transferconfig.
+    Server and dump are only started once per process, so transferrers of
+    a supervisor can all call this."""
+    if not config['enabled']:
+        return
+    enable()
+    with _lock:
+        if config['port'] and ('port', config['port']) not in _started:
+            _started.add(('port', config['port']))
+            serve(config['port'])
+        if config['dump'] and ('dump', config['dump']) not in _started:
+            _started.add(('dump', config['dump']))
+            dump_periodically(config['dump'], config['dump_interval'])
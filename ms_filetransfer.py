@@ -1,5 +1,18 @@
-import os, datetime, subprocess, logging, json, time, glob
-import metadata_querying
+import os, datetime, logging, json, time, Queue, threading
+import socket, httplib
+import metadata_querying, logparser, pipeline, tasks, scheduler, metrics
+import eviction, backfill, logindex
+from logtail import LogFollower
+from watcher import Watcher
+import transferconfig
+from transfer_backends import get_backend
+from transferpool import TransferPool
+from queuestore import QueueStore, TIMEFORMAT
+from filequeue import FileQueue
+from statuscache import StatusCache
+from syncengine import SyncEngine
+from ratelimit import TokenBucket, policy_from_config
+from fingerprint import FingerprintIndex, BackgroundHasher
 
 # prepare log
 log = logging.getLogger(__name__)
@@ -21,125 +34,398 @@ DATEFORMAT = '%Y%m%d'
 MAX_DAYS_IN_QUEUE = 5
 LOGIN = 'http://metadata.yourdomain.ex/kantele/login'
 URL = 'http://metadata.yourdomain.ex/kantele/rawstatus'
+METADATA_TIMEOUT = 600 # seconds, cleanup is given up on for this iteration
+PERSIST_INTERVAL = 60 # seconds between saving queue changes
+THROTTLE_INTERVAL = 60 # seconds between checks of time of day rate profiles
+BUMP_INTERVAL = 10 # seconds between checks for files bumped by an operator
+STATS_INTERVAL = 3600 # seconds between logging transfer wait times
+TIMESTAMPS = 'timestamps' # state section of last opened/closed timestamps
 
 keyfile = 'C:\Program Files\ssh\keys\orbi.ppk'
+READ_LOG_SECONDS = metrics.histogram('read_log_seconds', 'Time reading new '
+        'lines from instrument logs', ['instrument'])
+QUEUE_LOG_SECONDS = metrics.histogram('put_log_in_queue_seconds', 'Time '
+        'putting log events in the queue', ['instrument'])
+TRANSFER_FILES_SECONDS = metrics.histogram('transfer_files_seconds', 'Time '
+        'submitting closed files for transfer', ['instrument'])
+LOG_EVENTS = metrics.counter('log_events_total', 'Acquisition events read '
+        'from instrument logs', ['instrument', 'kind'])
+QUEUE_FILES = metrics.gauge('queue_files', 'Files in queue by status',
+        ['instrument', 'status'])
+TRANSFERS = metrics.counter('transfers_total', 'Finished transfers',
+        ['instrument', 'result'])
+CLOSE_TO_TRANSFER = metrics.histogram('close_to_transfer_seconds', 'Time '
+        'from closing of a raw file to its arrival on the server',
+        ['instrument'])
+QUEUE_STATUSES = ['open', 'acquisition stop', 'closed', 'done']
+
+RAW_SUFFIX = '.raw'
+
+# overridden by transfer_config.json
+TRANSFER_DEFAULTS = {'keyfile': keyfile,
+        'destination': 'orbi@130.229.48.246:/mnt/datadrive/'}
 
 class BaseFileTransferrer(object):
-    def __init__(self, name, interval, logdir, keyfile):
+    logpattern = None # logfile names, see logindex.py
+
+    def __init__(self, name, interval, logdir, keyfile=None, watch=False,
+            config=None, statedir=None, pool=None, metadata=None,
+            limiter=None):
+        """With watch, an iteration starts as soon as the instrument writes
+        to its logs, interval is then the maximum time between iterations.
+        config is a transferconfig dict, by default read from
+        transfer_config.json, keyfile overrides the keyfile in it.
+        statedir is where queue and log positions are kept, by default the
+        working directory. pool, metadata (a MetadataClient) and limiter
+        (a ratelimit.TokenBucket) can be shared with other transferrers."""
         self.name = name
         self.interval = interval
         self.logdir = logdir
+        self.statedir = statedir
+        if statedir and not os.path.isdir(statedir):
+            os.makedirs(statedir)
+        self.config = config or transferconfig.load_config(
+                defaults=TRANSFER_DEFAULTS)
+        if keyfile:
+            self.config['keyfile'] = keyfile
+        self.keyfile = self.config['keyfile']
+        metrics.configure(self.config['metrics'])
+        # queue, timestamps and log positions are in one database
+        self.store = QueueStore(self.state_path('filequeue.sqlite'),
+                self.state_path('filequeue.json'))
+        self.follower = LogFollower(self.state_path('logpositions.json'),
+                self.store.state)
+        # queue is shared by the tasks, change it only with the lock held
+        self.lock = threading.RLock()
+        self.transferring = set()
+        # failed files are not submitted again before this time
+        self.retry_after = {}
+        self.runtime = None
+        self.watcher = Watcher(self.watched_paths()) if watch else None
+        self.logindex = None
+        if self.logpattern is not None:
+            self.logindex = logindex.LogIndex(self.logdir, self.logpattern)
+        # throttled while acquiring and by time of day, and by the shared
+        # limiter
+        self.policy = policy_from_config(self.config['throttle'])
+        self.acquiring = False
+        self.throttle = None
+        if self.policy.enabled or limiter is not None:
+            self.throttle = TokenBucket(None, parent=limiter)
+            self.update_rate()
+        self.backend = get_backend(self.config, self.throttle)
+        self.pool = pool or TransferPool(self.config['workers'],
+                self.config['per_host'],
+                scheduler.policy_from_config(self.config['priority']))
+        # content fingerprints of closed files, to find them after a rename
+        # and to not send the same content twice
+        self.fingerprints = FingerprintIndex(self.state_path(
+            'fingerprints.sqlite'))
+        # with skip_duplicates, files are sent once their full hash is known
+        self.hasher = BackgroundHasher(self.fingerprints,
+                (lambda path: self.trigger('transfer')) if
+                self.config['skip_duplicates'] else None)
+        self.hash_requested = set()
+        self.metadata = metadata or metadata_querying.MetadataClient(URL,
+                LOGIN, cache=StatusCache())
+        self.pipeline = None
+        if self.config['pipeline']['enabled']:
+            self.start_pipeline()
+
+    def start_pipeline(self):
+        """Closed files go through the pipeline as soon as they are seen
+        in the log. Its stages report back through self.finished, the
+        queue itself is only changed by the transfer task."""
+        settings = self.config['pipeline']
+        self.finished = Queue.Queue()
+        self.in_pipeline = set()
+        engine = SyncEngine(settings['incoming'], settings['archive'],
+                self.state_path(settings['manifest']))
+        cleanup = None
+        if settings['remove_incoming']:
+            cleanup = lambda job: os.remove(job.path)
+        self.pipeline = pipeline.build_file_pipeline(self.backend,
+                settings['incoming'], engine, cleanup, self.pipeline_finished,
+                self.pipeline_failed, self.config['workers'])
+        self.pipeline.start()
+
+    def pipeline_finished(self, job):
+        self.finished.put(job)
+        self.trigger('transfer')
+
+    def pipeline_failed(self, job):
+        # not triggering, failed files wait for the next interval
+        self.finished.put(job)
+
+    def retry_later(self, timestamp):
+        """Call with self.lock held"""
+        self.retry_after[timestamp] = time.time() + self.interval
+
+    def state_path(self, fn):
+        return os.path.join(self.statedir, fn) if self.statedir else fn
 
     def run(self):
         log.info('Started automatic file transfer for {0}'.format(self.name))
-        while True:
-            self.load_queue()
-            self.lastclosed_timestamp = self.get_lastclosed_timestamp()
+        # queue is kept in memory, changes are written to the store
+        self.load_queue()
+        if self.config['backfill']['enabled']:
+            backfill.backfill(self, self.config['backfill']['processes'],
+                    self.config['backfill']['days'])
+        self.runtime = tasks.Runtime(self.tasks())
+        self.runtime.run()
+
+    def tasks(self):
+        """Log reading, transfers, metadata queries and saving the queue
+        run as separate tasks, so e.g. a missing logfile or a slow metadata
+        server does not delay the transfer of closed files. Subclasses can
+        add their own."""
+        return [tasks.Task('logs', self.follow_logs, self.interval,
+                    wait=self.wait if self.watcher else None),
+                tasks.Task('transfer', self.transfer_files, self.interval),
+                tasks.Task('metadata', self.query_metadata, self.interval,
+                    METADATA_TIMEOUT),
+                tasks.Task('persist', self.save_queue, PERSIST_INTERVAL),
+                tasks.Task('throttle', self.update_rate, THROTTLE_INTERVAL),
+                tasks.Task('bump', self.bump_files, BUMP_INTERVAL),
+                tasks.Task('stats', self.log_wait_stats, STATS_INTERVAL),
+                ]
+
+    def bump_files(self):
+        """An operator can have files transferred first by writing their
+        names, one per line, to bump.txt in the state directory"""
+        bumpfile = self.state_path('bump.txt')
+        try:
+            with open(bumpfile) as fp:
+                names = [x.strip() for x in fp if x.strip()]
+            os.remove(bumpfile)
+        except (IOError, OSError):
+            return
+        for fn in names:
+            log.info('Bumping {0} to front of transfer queue'.format(fn))
+            self.pool.bump(fn)
+
+    def log_wait_stats(self):
+        for cls, stats in sorted(self.pool.policy.wait_stats().items()):
+            log.info('Transfer wait of {0} files: {1} files, mean {2:.0f} s, '
+                    'p50 {3:.0f} s, p95 {4:.0f} s, max {5:.0f} s'.format(cls,
+                        stats['count'], stats['mean'], stats['p50'],
+                        stats['p95'], stats['max']))
+
+    def update_rate(self):
+        """Sets transfer rate for current time of day and acquisition"""
+        if self.throttle is None:
+            return
+        rate = self.policy.rate_at(datetime.datetime.now(), self.acquiring)
+        if rate != self.throttle.rate:
+            log.info('Transfer rate of {0} set to {1} bytes/s'.format(
+                self.name, 'unlimited' if rate is None else rate))
+            self.throttle.set_rate(rate)
+
+    def set_acquiring(self, acquiring):
+        if acquiring != self.acquiring:
+            log.info('Acquisition {0} on {1}'.format('started' if acquiring
+                else 'finished', self.name))
+            self.acquiring = acquiring
+            self.update_rate()
+
+    def trigger(self, task):
+        if self.runtime is not None:
+            self.runtime.trigger(task)
+
+    def follow_logs(self):
+        with READ_LOG_SECONDS.labels(self.name).time():
             self.read_log()
-            if self.machine_log:
-                self.put_log_in_queue()
-                self.remove_old_from_queue()
-                self.transfer_files()
-                self.update_queue_log_files()
-                log.info('Next iteration will be in {0} seconds'.format(self.interval))
-            else:
-                log.info('No logfile found, will try again at next '
-                'iteration, in {0} seconds.'.format(self.interval) )
-            time.sleep(self.interval)
+        if self.machine_log is False:
+            log.info('No logfile found, will try again in at most {0} '
+                    'seconds.'.format(self.interval))
+            return
+        if metrics.enabled():
+            for event in self.machine_log:
+                LOG_EVENTS.labels(self.name, event.kind).inc()
+        with self.lock, QUEUE_LOG_SECONDS.labels(self.name).time():
+            self.put_log_in_queue()
+        self.update_queue_log_files()
+        if self.machine_log:
+            self.trigger('transfer')
+
+    def wait(self, interval):
+        """Wait until the logs change or interval has passed"""
+        # log directory may have been created since start
+        self.watcher.watch(self.watched_paths())
+        if self.watcher.wait(interval):
+            log.info('Change in logs detected, reading logs')
+
+    def watched_paths(self):
+        """Closing of raw files is logged by the instrument, so watching
+        the logs is enough to notice them"""
+        return [self.logdir]
     
     def read_log(self):
         return True
+
+    def historical_logs(self):
+        """All logfiles of the instrument as [(logfile, date)], for
+        backfill"""
+        if self.logindex is None:
+            return []
+        return [(logfile, timestamp.date()) for logfile, timestamp in
+                self.logindex.since()]
+
+    def catch_up(self, events, positions, max_days):
+        """Queues events read by backfill, and stores the log positions
+        they were read to"""
+        with self.lock:
+            self.machine_log = events
+            self.put_log_in_queue(max_days)
+            self.follower.positions.update(positions)
+            self.update_queue_log_files()
+        if events:
+            self.trigger('transfer')
         
     def load_queue(self):
         """load queues
         queue = {file: {status:open/closed/done, date: date_of_logfile}, file2: ETC}
         """
-        try:
-            with open('filequeue.json') as fp:
-                self.queue = json.load(fp)
-        except IOError:
-            log.info('Could not open filequeue.json for queue reading. New empty queue generated.')
-            self.queue = {}
-        except ValueError:
-            log.error('Could not parse JSON from filequeue.json for queue reading')
-            raise
-        else:
-            log.info('Got queue from filequeue.json')
+        self.queue = FileQueue(self.store.load(), datefield='closedate')
+        self.migrate_logrec()
     
+    def save_queue(self):
+        # write changed queue entries to the queue database
+        with self.lock:
+            self.store.save(self.queue)
+            if metrics.enabled():
+                for status in QUEUE_STATUSES:
+                    QUEUE_FILES.labels(self.name, status).set(
+                            self.queue.count(status))
+
     def update_queue_log_files(self):
-        # write queues to file:
-        try:
-            with open('filequeue.json', 'w') as fp:
-                json.dump(self.queue, fp)
-        except IOError:
-            log.error('Could not open filequeu.json for queue reading')
-            raise
-        else:
-            log.info('Queue written to file.')
+        # log positions are written in the transaction that saves the queue
+        # entries read from the logs
+        self.follower.save()
+        self.save_queue()
 
     def update_queue_entry(self, timestamp, **kwargs):
-        for k in kwargs:
-            self.queue[timestamp][k] = kwargs[k]
+        self.queue.update(timestamp, **kwargs)
         
+    def query_metadata(self):
+        """Metadata task. An unreachable metadata server or a file that
+        cannot be deleted must not stop transfers, cleanup is tried again
+        next interval."""
+        try:
+            self.cleanup_old_files()
+        except (metadata_querying.MetadataError, httplib.HTTPException,
+                socket.error, IOError, OSError) as e:
+            log.warning('Could not clean up old files, will try again in {0} '
+                    'seconds: {1}'.format(self.interval, e))
+
     def cleanup_old_files(self):
+        if self.config['eviction']['enabled']:
+            self.evict_files()
+            return
         # Remove old files from queue
-        to_query = []
-        for timestamp in self.queue:
-            age = datetime.datetime.now() - self.queue[timestamp]['closedate']
-            if self.queue[timestamp]['status'] == 'done' and age.days > MAX_DAYS_IN_QUEUE:
-                to_query.append(timestamp)
+        maxdate = datetime.datetime.now() - datetime.timedelta(MAX_DAYS_IN_QUEUE)
+        to_query = {}
+        with self.lock:
+            for timestamp in self.queue.expired(maxdate):
+                to_query[os.path.basename(self.queue[timestamp]['file'])] = timestamp
+        if not to_query:
+            return
         
-        to_remove = self.check_files_metadata_archived(to_query)
+        # queue is not locked while waiting for the server
+        to_remove = self.check_files_metadata_archived(to_query.keys())
 
-        for timestamp in to_remove:
-            log.info('Removing old file {0} with date {1} from queue and '
-                    'deleting from disk.'.format(self.queue[timestamp]['file'],
-                            self.queue[timestamp]['closedate']))
-            os.remove(self.queue[timestamp]['file'])
-            del(self.queue[timestamp])
+        with self.lock:
+            for fn in to_remove:
+                timestamp = to_query[fn]
+                if timestamp not in self.queue:
+                    continue
+                log.info('Removing old file {0} with date {1} from queue and '
+                        'deleting from disk.'.format(self.queue[timestamp]['file'],
+                                self.queue[timestamp]['closedate']))
+                if os.path.exists(self.queue[timestamp]['file']):
+                    os.remove(self.queue[timestamp]['file'])
+                self.queue.remove(timestamp)
+        self.trigger('persist')
 
-    
-    def get_last_timestamps(self):
+    def evict_files(self):
+        """Deletes transferred and archived files, oldest first, when the
+        raw file disk is below the low watermark"""
+        settings = self.config['eviction']
+        candidates = []
+        with self.lock:
+            for timestamp in self.queue.with_status('done'):
+                entry = self.queue[timestamp]
+                try:
+                    size = os.path.getsize(entry['file'])
+                except OSError:
+                    continue
+                date = entry.get('closedate') or timestamp
+                candidates.append(eviction.Candidate(timestamp, entry['file'],
+                    size, date))
+        if not candidates:
+            return
+        directory = settings['directory'] or os.path.dirname(
+                candidates[0].path)
+        watermarks = eviction.Watermarks(settings['low'], settings['high'])
+        needed = watermarks.to_free(directory)
+        if not needed:
+            return
+        # queue is not locked while waiting for the server
+        selected = eviction.select(candidates, needed, self.archived_paths,
+                settings['min_age_days'])
+        with self.lock:
+            for candidate in selected:
+                log.info('Evicting {0} from queue and disk'.format(
+                    candidate.path))
+                if os.path.exists(candidate.path):
+                    os.remove(candidate.path)
+                if candidate.key in self.queue:
+                    self.queue.remove(candidate.key)
+        self.trigger('persist')
+
+    def archived_paths(self, paths):
+        names = dict((os.path.basename(x), x) for x in paths)
+        return [names[fn] for fn in self.check_files_metadata_archived(
+            names.keys()) if fn in names]
+
+    def migrate_logrec(self):
+        """Timestamps used to be kept in logrec.txt, move them to the state
+        store. It was often not written correctly, so may be unreadable."""
+        logrec = self.state_path('logrec.txt')
+        if self.store.state.section(TIMESTAMPS) or not os.path.exists(logrec):
+            return
         try:
-            with open('logrec.txt') as fp:
+            with open(logrec) as fp:
                 last = json.load(fp)
-        except IOError:
-            log.error('Could not load timestamps from logrec.txt. New empty '
-            'last timestamps generated.')
-            self.lastopened_timestamp  = {}
-            self.lastclosed_timestamp = {}
+            for key in ['last_opened', 'last_closed']:
+                self.store.state.set(TIMESTAMPS, key,
+                        datetime.datetime.strptime(last[key], TIMEFORMAT))
+        except (IOError, ValueError, KeyError) as e:
+            log.warning('Could not read timestamps from {0}: {1}'.format(
+                logrec, e))
         else:
-            self.lastopened_timestamp = datetime.datetime.strptime( \
-                    last['last_opened'], '%Y%m%d %H:%M:%S.%f')
-            self.lastclosed_timestamp = datetime.datetime.strptime( \
-                    last['last_closed'], '%Y%m%d %H:%M:%S.%f')
-            log.info('Read last open/close file timestamps')
-    
+            log.info('Migrated last open/close file timestamps from '
+                    '{0}'.format(logrec))
+        os.rename(logrec, '{0}.migrated'.format(logrec))
+
+    @property
+    def lastopened_timestamp(self):
+        return self.store.state.section(TIMESTAMPS).get('last_opened')
+
+    @property
+    def lastclosed_timestamp(self):
+        return self.store.state.section(TIMESTAMPS).get('last_closed')
+
     def set_lastopened_timestamp(self, timestamp):
-        self.lastopened_timestamp = timestamp
-        self.save_timestamps()
+        # written with the next queue save
+        self.store.state.set(TIMESTAMPS, 'last_opened', timestamp)
 
     def set_lastclosed_timestamp(self, timestamp):
-        self.lastclosed_timestamp = timestamp
-        self.save_timestamps()
-
-    def save_timestamps(self):
-        ts = {
-            'last_opened': self.lastopened_timestamp.strftime('%Y%m%d %H:%M:%S.%f'),
-            'last_closed': self.lastclosed_timestamp.strftime('%Y%m%d %H:%M:%S.%f')
-            }
-        try:
-            with open('logrec.txt', 'w') as fp:
-                json.dump(fp, ts)
-        except IOError:
-            log.error('Could not save timestamps in logrec.txt')
-            raise
-        else:
-            log.info('Read last checked logtime')
+        self.store.state.set(TIMESTAMPS, 'last_closed', timestamp)
     
-    def check_files_metadata_archived(files):
+    def check_files_metadata_archived(self, files):
         archived_meta = []
-        response = metadata_querying.query_rawfiles(files, URL, LOGIN)
+        response = self.metadata.query(files)
         for fn in response:
             if response[fn][0] == 'done':
                 archived_meta.append(fn)
@@ -147,154 +433,291 @@ class BaseFileTransferrer(object):
         return archived_meta
         	 
 
-    def put_log_in_queue(self):
+    def put_log_in_queue(self, max_days=MAX_DAYS_IN_QUEUE):
         """Updates file status in queue, open/closed -> ready for transfer.
         Current behaviour treats each opening timestamp individually. Finding
-        files with identical names will lead to overwriting them."""
+        files with identical names will lead to overwriting them. Files
+        opened more than max_days ago are not queued."""
 
-        for timestamp, logline in self.machine_log:
-            if self.acquisition_start in logline:
+        acquiring = self.acquiring
+        for lineno, event in enumerate(self.machine_log):
+            timestamp = event.timestamp
+            # transfers are throttled while the instrument acquires
+            acquiring = event.kind == logparser.START
+            if event.kind == logparser.START:
                 age = datetime.datetime.now() - timestamp
-                if age.days < MAX_DAYS_IN_QUEUE:
-                    fn = self.get_filename_from_logline(logline)
+                if age.days < max_days:
                     if timestamp not in self.queue:
                         self.set_lastopened_timestamp(timestamp)
-                        self.queue[timestamp] = {'file': fn}
-                        self.update_queue_entry(timestamp, status='open',
-                                openeddate=timestamp.date())
+                        self.queue.add(timestamp, file=event.filename,
+                                status='open', openeddate=timestamp.date())
 
-            elif self.acquisition_stop in logline:
+            elif event.kind == logparser.STOP:
                 if self.lastopened_timestamp in self.queue and \
                         self.queue[self.lastopened_timestamp]['status'] == 'open':
-                    self.update_queue_entry(timestamp, status='acquisition '
-                            'closed', stoppeddate=timestamp.date() )
+                    self.update_queue_entry(self.lastopened_timestamp,
+                            status='acquisition stop', stoppeddate=timestamp)
+
+            elif event.kind == logparser.CLOSED:
+                if self.lastopened_timestamp in self.queue and \
+                        self.queue[self.lastopened_timestamp]['status'] in \
+                        ['open', 'acquisition stop']:
+                    self.update_queue_entry(self.lastopened_timestamp,
+                            status='closed', closedate=timestamp)
                     self.set_lastclosed_timestamp(timestamp)
+                    self.record_fingerprint(self.lastopened_timestamp)
+                    if self.pipeline is not None:
+                        self.submit_to_pipeline(self.lastopened_timestamp)
                 
                 else:
-                    if not timestamp in self.machine_log[0]:
+                    if lineno != 0:
                         log.warning('Closing of file detected, but not no open file in queue. '
                             'Possible problem, check with administrator.')
                     else:
                         log.warning('First line of logfile was file closing. '
                                 'Ignoring.')
+        self.set_acquiring(acquiring)
 
-    def transfer_files(self, queue, currentdate):
-        transferred = False
-        for timestamp in queue:
-            fn = queue[timestamp]['file']
-            if queue[timestamp]['status'] == 'closed':
-                if not os.path.exists(fn):
-                    # for example, file name changed by user before we can transfer
+    def record_fingerprint(self, timestamp):
+        fn = self.queue[timestamp]['file']
+        try:
+            fingerprint = self.fingerprints.fingerprint(fn)
+        except (IOError, OSError) as e:
+            log.warning('Could not fingerprint {0}: {1}'.format(fn, e))
+            return
+        self.update_queue_entry(timestamp, fingerprint=fingerprint)
+        self.hasher.submit(fn)
+
+    def waiting_to_send(self, timestamp, now):
+        return timestamp not in self.transferring and \
+                self.retry_after.get(timestamp, 0) <= now
+
+    def missing_files(self):
+        """[(timestamp, file, fingerprint)] of closed files that are no
+        longer at their logged path, and the set of all queued paths. Call
+        with self.lock held."""
+        now = time.time()
+        missing = [(timestamp, self.queue[timestamp]['file'],
+            self.queue[timestamp].get('fingerprint')) for timestamp in
+            self.queue.with_status('closed') if
+            self.waiting_to_send(timestamp, now) and
+            not os.path.exists(self.queue[timestamp]['file'])]
+        if not missing:
+            return [], set()
+        return missing, set(self.queue[x]['file'] for x in self.queue.keys())
+
+    def find_renamed(self, fn, fingerprint, queued):
+        """New path of a closed file that is no longer at its logged path,
+        or None. Fingerprints the files in its directory, so call without
+        self.lock held."""
+        directory = os.path.dirname(fn)
+        if not fingerprint or not os.path.isdir(directory):
+            return None
+        return self.fingerprints.find_renamed(fingerprint, directory,
+                RAW_SUFFIX, queued)
+
+    def full_hash_pending(self, fn):
+        """With skip_duplicates, a file is only sent when its full hash is
+        known, to compare it with the files already sent. Returns True
+        while it is being computed, the hasher then triggers transfer."""
+        if not self.config['skip_duplicates']:
+            return False
+        # pending is checked first, the hasher stores the hash before the
+        # file stops being pending
+        pending = self.hasher.pending(fn)
+        if self.fingerprints.full(fn) is not None:
+            self.hash_requested.discard(fn)
+            return False
+        if pending:
+            return True
+        if fn in self.hash_requested:
+            return False # could not be hashed, sent without the check
+        try:
+            self.fingerprints.fingerprint(fn)
+        except (IOError, OSError):
+            return False
+        self.hash_requested.add(fn)
+        self.hasher.submit(fn)
+        return True
+
+    def submit_to_pipeline(self, timestamp):
+        """Returns False when the pipeline is full, the file is then
+        submitted again at a next iteration"""
+        if timestamp in self.in_pipeline:
+            return True
+        fn = self.queue[timestamp]['file']
+        if not self.pipeline.submit(pipeline.FileJob(timestamp, fn)):
+            log.info('Pipeline is full, {0} waits for next '
+                    'iteration'.format(fn))
+            return False
+        self.in_pipeline.add(timestamp)
+        return True
+
+    def collect_pipeline_results(self):
+        """Updates queue with files that passed or failed the pipeline since
+        last call. Failed files stay closed and are submitted again after
+        an interval."""
+        if self.pipeline is None:
+            return
+        currentdate = datetime.datetime.now().strftime(DATEFORMAT)
+        while True:
+            try:
+                job = self.finished.get_nowait()
+            except Queue.Empty:
+                break
+            self.in_pipeline.discard(job.key)
+            if job.error is not None:
+                log.warning('File {0} failed in pipeline stage {1}: '
+                        '{2}'.format(job.fn, job.stage, job.error))
+                self.retry_later(job.key)
+            elif job.key in self.queue:
+                self.retry_after.pop(job.key, None)
+                log.info('File {0} transferred and archived'.format(job.fn))
+                self.fingerprints.mark_sent(job.fn)
+                self.update_queue_entry(job.key, status='done',
+                        transferred=currentdate, checksum=job.checksum)
+
+    def transfer_files(self):
+        """Submits closed files for transfer in parallel, each queue entry
+        is updated as soon as its own transfer finishes"""
+        with TRANSFER_FILES_SECONDS.labels(self.name).time():
+            with self.lock:
+                self.collect_pipeline_results()
+                missing, queued = self.missing_files()
+            # scanning for renamed files reads part of every raw file,
+            # callbacks and the log task are not held up meanwhile
+            renames = dict((timestamp, self.find_renamed(fn, fingerprint,
+                queued)) for timestamp, fn, fingerprint in missing)
+            with self.lock:
+                self.submit_transfers(renames)
+        self.pool.raise_fatal()
+
+    def submit_transfers(self, renames):
+        """renames: {timestamp: new path or None} of closed files that were
+        not at their logged path"""
+        currentdate = datetime.datetime.now().strftime(DATEFORMAT)
+        transferring = False
+        now = time.time()
+        for timestamp in self.queue.with_status('closed'):
+            if not self.waiting_to_send(timestamp, now):
+                continue
+            fn = self.queue[timestamp]['file']
+            if not os.path.exists(fn):
+                if timestamp not in renames:
+                    continue # gone since the scan, looked for next time
+                # for example, file name changed by user before we can transfer
+                renamed = renames[timestamp]
+                if renamed is None:
                     log.warning('Closed file {0} not found on local computer. Removed from queue.'.format(fn) )
-                    queue[timestamp]['status'] = 'done'
-                    queue[timestamp]['transferred'] = False
+                    self.update_queue_entry(timestamp, status='done',
+                            transferred=False)
                     continue
-                try:
-                    subprocess.check_call(['C:\Program Files\ssh\pscp.exe', '-i',
-                    self.keyfile, fn,
-                            'orbi@130.229.48.246:/mnt/datadrive/'])
-                except OSError:
-                    log.error('Could not call pscp.exe in the specified location c:\program files. Exiting')
-                    raise
-                except subprocess.CalledProcessError:
-                    log.warning('Secure copying of file {0} to remote host failed.'.format(fn) )
-                else:
-                    transferred = True
-                    log.info('File {0} copied to remote server.'.format(fn) )
-                    queue[timestamp]['status'] = 'done'
-                    queue[timestamp]['transferred'] = currentdate
+                log.info('Closed file {0} was renamed to {1}'.format(fn,
+                    renamed))
+                self.update_queue_entry(timestamp, file=renamed,
+                        renamed_from=fn)
+                fn = renamed
+            if self.full_hash_pending(fn):
+                continue
+            duplicate = self.fingerprints.sent_copy(fn)
+            if duplicate is not None and self.config['skip_duplicates']:
+                log.info('File {0} has the same content as {1}, which was '
+                        'already transferred. Not sending it.'.format(fn,
+                            duplicate))
+                self.update_queue_entry(timestamp, status='done',
+                        transferred=False, duplicate_of=duplicate)
+                continue
+            transferring = True
+            if self.pipeline is not None:
+                if not self.submit_to_pipeline(timestamp):
+                    break
+                continue
+            self.transferring.add(timestamp)
+            self.pool.submit(fn, self.backend,
+                    self.transfer_finished(timestamp, currentdate), self.name)
         
-        if not transferred:
-            log.info('No files currently ready for transfer.')
-        return queue
+        if not transferring:
+            log.info('No new files currently ready for transfer.')
+
+    def transfer_finished(self, timestamp, currentdate):
+        """Returns callback for the transfer pool"""
+        def callback(fn, error):
+            with self.lock:
+                self.transferring.discard(timestamp)
+                if error:
+                    log.warning('Secure copying of file {0} to remote host '
+                            'failed: {1}'.format(fn, error) )
+                    TRANSFERS.labels(self.name, 'failed').inc()
+                    self.retry_later(timestamp)
+                    return
+                self.retry_after.pop(timestamp, None)
+                log.info('File {0} copied to remote server.'.format(fn) )
+                TRANSFERS.labels(self.name, 'done').inc()
+                self.fingerprints.mark_sent(fn)
+                if timestamp in self.queue:
+                    closedate = self.queue[timestamp].get('closedate')
+                    if isinstance(closedate, datetime.datetime):
+                        CLOSE_TO_TRANSFER.labels(self.name).observe(
+                            (datetime.datetime.now() - closedate).total_seconds())
+                    self.update_queue_entry(timestamp, status='done',
+                            transferred=currentdate)
+            self.trigger('persist')
+        return callback
 
 
 class OrbiFileTransferrer(BaseFileTransferrer):
-    def __init__(self, name, interval, logdir, keyfile):
-        super(OrbiFileTransferrer, self).__init__(name, interval, logdir)
-        self.acquisition_start = 'Raw file created, actual name'
-        self.acquisition_stop = 'Closed raw file'
-        self.keyfile = keyfile
+    grammar = logparser.LTQ
+    logpattern = logindex.LTQ
 
     def read_log(self):
-        """read today and yesterday's logfile"""
+        """read lines added to today and yesterday's logfile since the
+        last iteration"""
         self.machine_log = []
         currentdate = datetime.datetime.now().strftime(DATEFORMAT) #TODO 20120425
         # FIX DATE FORMAT?
         yesterday = (datetime.datetime.now() - datetime.timedelta(1)).strftime(DATEFORMAT)
-        # FIXME should we use only yester/today, or start from self.lastread ?
-        # First start would in latter case take all logfiles!
         for date_of_log in [yesterday, currentdate]:
             logfile = os.path.join(self.logdir, 'LTQ_{0}.LOG'.format(date_of_log) )
-            for tries in range(11):
-                try:
-                    with open(logfile) as fp:
-                        for line in fp:
-                            if line.strip():
-                                logline = line.split(':  ')
-                                timestamp = date_of_log + ' ' + logline[0]
-                                timestamp = datetime.datetime(timestamp,
-                                '%Y%m%d %H%M%S')
-                                if timestamp > self.lastread:
-                                    self.machine_log.append( (timestamp,logline[1]) )
-                                  
-                        log.info('Opened logfile for {0}, accumulated {1} '
-                        'lines.'.format(date_of_log, len(self.machine_log)))
-                except IOError:
-                    log.warning('Cannot open logfile for {0}, try {1}/10'.format(date_of_log, tries) )
-                    if tries == 10 and date_of_log == currentdate:
-                        self.machine_log = False # no log today yet
-                    elif tries == 10 and date_of_log == yesterday:
-                        break # there is no log from yesterday, maybe started
-                        # running today
-                    else:
-                        time.sleep(10)
-                else:
-                    break
-
-    def get_filename_from_logline(logline):
-        return logline.split('=')[1].strip()
+            logdate = datetime.datetime.strptime(date_of_log, DATEFORMAT).date()
+            try:
+                self.machine_log.extend(logparser.parse(
+                    self.follower.iter_new_lines(logfile), self.grammar,
+                    logdate))
+            except (IOError, OSError):
+                # not retried here, the next interval or change in the log
+                # directory tries again
+                if date_of_log == yesterday:
+                    continue # maybe started running today
+                log.warning('Cannot open logfile for {0}'.format(date_of_log))
+                # events read from yesterday's log are kept, the follower
+                # has moved past them
+                if not self.machine_log:
+                    self.machine_log = False
+            else:
+                log.info('Read new lines of logfile for {0}, accumulated '
+                '{1} events.'.format(date_of_log, len(self.machine_log)))
 
 
 class QExactiveFileTransferrer(BaseFileTransferrer):
-    def __init__(self, name, interval, logdir, keyfile):
-        super(QExactiveFileTransferrer, self).__init__(name, interval, logdir)
-        self.acquisition_start = 'Starting acquisition'
-        self.acquisition_stop = 'MS acquisition end. Accumulated MS size'
-        self.keyfile = keyfile
+    grammar = logparser.QEXACTIVE
+    logpattern = logindex.QEXACTIVE
 
     def read_log(self):
         self.machine_log = []
         for tries in range(11):
             log.info('Trying to find newest logfile, try {0}/10'.format(tries) )
-            logs = glob.glob(os.path.join(self.logdir, 'Thermo Exactive--*'))
+            logs = self.logindex.to_follow(self.follower.positions)
             if logs:
                 break
             elif tries == 10:
                 log.info('No logfiles for today found')
+                self.machine_log = False
                 return False
-        ages = {}
-        for logfile in logs:
-            fn = logfile[logfile.index('Thermo Exactive'):]
-            filedate = fn.replace('Thermo Exactive--', '')
-            filedate = filedate[:10] # length of Thermo date format! Hardcoded, I know, I know...
-            age = datetime.datetime.now() - \
-                datetime.datetime.strptime(filedate, '%Y-%m-%d')
-            ages[ age.days ] = logfile
-        
-        log.info('Newest logfile is {0} day(s) old - {1}'.format(min(ages),
-            ages[min(ages)] ) )
-        # found newest logfile. Now parse the unread lines from it.
-        with open(ages[min(ages)]) as fp:
-            for line in fp:
-                linetime = line[1:line.index(']')].split('=')[1].split('+')[0]
-                linetime = datetime.datetime.strptime(linetime, '%Y-%m-%d '
-                '%H:%M:%S.%f')
-                if linetime > self.lastclosed_timestamp:
-                    self.machine_log.append( (linetime, line) )
-
-    def get_filename_from_logline(logline):
-        return logline[logline.index('Starting acquisition: Xcalibur will write' \
-                    )+42: logline.index(' (and may add date/time to the name)')]
-
-                        
+        logfile, timestamp = logs[-1]
+        log.info('Newest logfile is {0} day(s) old - {1}'.format(
+            (datetime.datetime.now() - timestamp).days, logfile))
+        # parse the lines added since last read, logs that were rotated
+        # since are finished first
+        for logfile, timestamp in logs:
+            self.machine_log.extend(logparser.parse(
+                self.follower.iter_new_lines(logfile), self.grammar))
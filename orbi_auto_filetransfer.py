@@ -3,7 +3,15 @@ This script queries the logfiles of the MS machine, checks if there are new file
 and SCP's them to a server.
 """
 
-import os, datetime, subprocess, logging, json, time
+import os, sys, datetime, logging, time
+from logtail import LogFollower
+import logparser
+from watcher import Watcher
+import transferconfig, scheduler
+from transfer_backends import get_backend
+from transferpool import TransferPool
+from queuestore import QueueStore
+from filequeue import FileQueue
 
 # prepare log
 log = logging.getLogger(__name__)
@@ -21,151 +29,153 @@ PATH_TO_LOG = os.path.join('C:\\', 'Thermo', 'Instruments', 'LTQ', 'system', 'lo
 DATEFORMAT = '%Y%m%d'
 MAX_DAYS_IN_QUEUE = 5
 
-
-def main(interval):
+KEYFILE = 'C:\Program Files\ssh\keys\orbi.ppk'
+DESTINATION = 'orbi@130.229.48.246:/mnt/incoming/'
+
+follower = LogFollower()
+store = QueueStore()
+# KEYFILE and DESTINATION can be overridden in transfer_config.json
+config = transferconfig.load_config(defaults={'keyfile': KEYFILE,
+    'destination': DESTINATION})
+backend = get_backend(config)
+pool = TransferPool(config['workers'], config['per_host'],
+        scheduler.policy_from_config(config['priority']))
+
+def main(interval, watch=False):
+    """Runs an iteration every interval seconds. With watch, iterations
+    also start when the instrument writes to its logs."""
+    watcher = Watcher([PATH_TO_LOG]) if watch else None
     log.info('Started automatic file transfer for LTQ Orbitrap Velos.')
+    # queue is kept in memory, changes are written to the store
+    queue = get_queue()
     while True:
         currentdate = datetime.datetime.now().strftime(DATEFORMAT)
         yesterday = (datetime.datetime.now() - datetime.timedelta(1)).strftime(DATEFORMAT)
-        queue = get_queue()
         machine_log = get_logs(currentdate, yesterday)
-        if machine_log:
+        if machine_log is not False:
             queue = process_queue(machine_log, queue, currentdate)
             queue = transfer_files(queue, currentdate)
             update_queuefile(queue)
+            follower.save()
             log.info('Next iteration will be in {0} seconds'.format(interval))
         else:
             log.info('No logfile found for {0}, will try again at next iteration, in {1} seconds.'.format(currentdate, interval) )
-        time.sleep(interval)
+        if watcher is None:
+            time.sleep(interval)
+        elif watcher.wait(interval):
+            log.info('Change in logs detected, starting iteration')
 
 
 def get_queue():
     """load queues
     queue = {file: {status:open/closed/done, date: date_of_logfile}, file2: ETC}
     """
-    try:
-        with open('filequeue.json') as fp:
-            queue = json.load(fp)
-    except IOError:
-        log.info('Could not open filequeue.json for queue reading. New empty queue generated.')
-        return {}
-    except ValueError:
-        log.error('Could not parse JSON from filequeue.json for queue reading')
-        raise
-    else:
-        log.info('Got queue from filequeue.json')
-        return queue
+    return FileQueue(store.load(), datefield='transferred')
 
 
 def get_logs(currentdate, yesterday):
-    """read today and yesterday's logfile"""
-    
+    """parse events from lines added to today and yesterday's logfile since
+    last call"""
+
     machine_log = []
     for date_of_log in [yesterday, currentdate]:
         logfile = os.path.join(PATH_TO_LOG, 'LTQ_{0}.LOG'.format(date_of_log) )
 
-        for tries in range(11):
-            try:
-                with open(logfile) as fp:
-                    for line in fp:
-                        if line.strip():
-                            machine_log.append( '{0}--{1}'.format(date_of_log, line.strip()) )
-                    log.info('Opened logfile for {0}, accumulated {1} lines.'.format(date_of_log, len(machine_log)))
-            except IOError:
-                log.warning('Cannot open logfile for {0}, try {1}/10'.format(date_of_log, tries) )
-                if tries == 10 and date_of_log == currentdate:
-                    machine_log = False # no log today yet
-                elif tries == 10 and date_of_log == yesterday:
-                    break # there is no log from yesterday, machine may be new
-                else:
-                    time.sleep(10)
-            else:
-                break
+        logdate = datetime.datetime.strptime(date_of_log, DATEFORMAT).date()
+        try:
+            machine_log.extend(logparser.parse(follower.iter_new_lines(logfile), logparser.LTQ, logdate))
+        except (IOError, OSError):
+            # not retried here, the next iteration tries again
+            if date_of_log == yesterday:
+                continue # there is no log from yesterday, machine may be new
+            log.warning('Cannot open logfile for {0}'.format(date_of_log))
+            # events read from yesterday's log are kept, the follower has
+            # moved past them
+            if not machine_log:
+                machine_log = False
+        else:
+            log.info('Read new lines of logfile for {0}, accumulated {1} events.'.format(date_of_log, len(machine_log)))
     return machine_log
 
 
+def get_open_file(queue):
+    """Returns file and timestamp of the newest file still open in the queue,
+    logs are only read incrementally so it may have been opened in an
+    earlier iteration."""
+    current_time = queue.newest_with_status('open')
+    if current_time is None:
+        return None, None
+    return queue[current_time]['file'], current_time
+
+
 def process_queue(machine_log, queue, currentdate):
     """Loop through log and put files in correct queues.
     """
-    current_file, current_time = None, None
-    for logline in machine_log:
-        logline = logline.split(':  ')
-        timestamp = logline[0]
-        logdate = timestamp.split('--')[0]
-        logtext = logline[1]
-        if logtext == 'Closed raw file':
+    current_file, current_time = get_open_file(queue)
+    for lineno, event in enumerate(machine_log):
+        logdate = event.timestamp.strftime(DATEFORMAT)
+        timestamp = '{0}--{1}'.format(logdate, event.stamp)
+        if event.kind == logparser.CLOSED:
             if current_file and current_time:
-                queue[current_time]['status'] = 'closed'
-                queue[current_time]['closed'] = logdate
-            elif machine_log.index(':  '.join(logline)) == 0 and logdate == currentdate:
+                queue.update(current_time, status='closed', closed=logdate)
+            elif lineno == 0 and logdate == currentdate:
                 log.warning('First line in todays log is a file closing, but no log files for yesterday found. Date--time: {0}'.format(timestamp))
-            elif machine_log.index(':  '.join(logline)) == 0 and logdate != currentdate:
+            elif lineno == 0 and logdate != currentdate:
                 log.info('First line in yesterdays log was a file closing.')
             current_file = None
             current_time = None
     
-        elif 'Raw file created' in logtext:
+        elif event.kind == logparser.START:
             if timestamp not in queue: 
-                current_file = logtext.split('=')[1].strip()
+                current_file = event.filename
                 current_time = timestamp
-                queue[current_time] = {'file': current_file, 'status': 'open',
-                'opened': logdate }
+                queue.add(current_time, file=current_file, status='open',
+                        opened=logdate)
             elif queue[timestamp]['status'] == 'open':
-                current_file = logtext.split('=')[1].strip()
+                current_file = event.filename
                 current_time = timestamp
 
     # remove old files from 'done' queue. Old: > MAX_DAYS_IN_QUEUE
-    to_remove = []
-    for timestamp in queue:
-        if queue[timestamp]['status'] == 'done':
-            olddate = datetime.datetime.strptime(queue[timestamp]['transferred'], DATEFORMAT)
-            if olddate < datetime.datetime.strptime(currentdate, DATEFORMAT) - datetime.timedelta(MAX_DAYS_IN_QUEUE):
-                to_remove.append(timestamp)
-    for ts in to_remove:
-        del(queue[ts])
-        log.info('Removed old file with date {0} from the done queue.'.format(olddate))
+    olddate = datetime.datetime.strptime(currentdate, DATEFORMAT) - datetime.timedelta(MAX_DAYS_IN_QUEUE)
+    for ts in queue.expired(olddate.strftime(DATEFORMAT)):
+        log.info('Removed old file with date {0} from the done queue.'.format(queue[ts]['transferred']))
+        queue.remove(ts)
     return queue
 
 
 def transfer_files(queue, currentdate):
-    transferred = False
-    for timestamp in queue:
-        fn = queue[timestamp]['file']
-        if queue[timestamp]['status'] == 'closed':
-            if not os.path.exists(fn):
-                log.warning('Closed file {0} not found on local computer. Removed from queue.'.format(fn) )
-                queue[timestamp]['status'] = 'done'
-                continue
-            try:
-                subprocess.check_call(['C:\Program Files\ssh\pscp.exe', '-i', 'C:\Program Files\ssh\keys\orbi.ppk', fn, 'orbi@130.229.48.246:/mnt/incoming/'])
-            except OSError:
-                log.error('Could not call pscp.exe in the specified location c:\program files. Exiting')
-                raise
-            except subprocess.CalledProcessError:
+    """Transfers closed files in parallel, each queue entry is marked done
+    as soon as its own transfer finishes"""
+    def transfer_finished(timestamp):
+        def callback(fn, error):
+            if error:
                 log.warning('Secure copying of file {0} to remote host failed.'.format(fn) )
             else:
-                transferred = True
                 log.info('File {0} copied to remote server.'.format(fn) )
-                queue[timestamp]['status'] = 'done'
-                queue[timestamp]['transferred'] = currentdate
+                queue.update(timestamp, status='done', transferred=currentdate)
+                store.save(queue)
+        return callback
+
+    transferring = False
+    for timestamp in queue.with_status('closed'):
+        fn = queue[timestamp]['file']
+        if not os.path.exists(fn):
+            log.warning('Closed file {0} not found on local computer. Removed from queue.'.format(fn) )
+            queue.update(timestamp, status='done', transferred=currentdate)
+            continue
+        transferring = True
+        pool.submit(fn, backend, transfer_finished(timestamp))
     
-    if not transferred:
+    if not transferring:
         log.info('No files currently ready for transfer.')
+    pool.join()
     return queue
 
 
 def update_queuefile(queue):
-    # write queues to file:
-    try:
-        with open('filequeue.json', 'w') as fp:
-            json.dump(queue, fp)
-    except IOError:
-        log.error('Could not open or parse filequeue.json for queue reading')
-        raise
-    else:
-        log.info('Queue written to file.')
-
+    # write changed queue entries to the queue database
+    store.save(queue)
 
 
 if __name__  == '__main__':
-    main(1800)
+    main(1800, watch='--watch' in sys.argv[1:])
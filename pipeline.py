@@ -0,0 +1,166 @@
+"""
+Moves a closed raw file through transfer, verification, sync to the archive
+and cleanup as soon as each stage can take it, instead of every stage
+polling for the previous stage's output on its own timer. Stages are
+connected by bounded queues: when a stage falls behind (e.g. a slow archive
+mount), its queue fills up and the stages before it block, so files do not
+pile up on the transfer box.
+"""
+
+import os, time, hashlib, logging, threading, Queue
+
+from transfer_backends import TransferError
+from syncengine import NotMounted
+
+log = logging.getLogger(__name__)
+
+QUEUE_SIZE = 4 # files waiting per stage
+BUFFER_SIZE = 4 * 1024 * 1024
+MOUNT_RETRY = 60 # seconds between checks of an unmounted archive
+
+
+class FileJob(object):
+    """A file going through the pipeline. key is its queue key, stages
+    may set checksum and path (where the file is on the transfer box)."""
+    def __init__(self, key, fn):
+        self.key = key
+        self.fn = fn
+        self.checksum = None
+        self.path = None
+        self.error = None
+        self.stage = None
+
+
+class Stage(object):
+    def __init__(self, name, func, workers=1, maxsize=QUEUE_SIZE):
+        """func(job) does the work, raising on failure"""
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.inbox = Queue.Queue(maxsize)
+
+
+class Pipeline(object):
+    def __init__(self, stages, on_done=None, on_failed=None):
+        """on_done(job) and on_failed(job) are called from stage threads
+        when a job has passed all stages or failed in one, job.stage and
+        job.error tell where and why."""
+        self.stages = stages
+        self.on_done = on_done
+        self.on_failed = on_failed
+        self.threads = []
+
+    def start(self):
+        for index, stage in enumerate(self.stages):
+            following = self.stages[index + 1] if index + 1 < len(
+                self.stages) else None
+            for number in range(stage.workers):
+                thread = threading.Thread(target=self._work, args=(stage,
+                    following), name='{0}-{1}'.format(stage.name, number))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def stop(self):
+        """Lets running work finish and stops the stage threads"""
+        for stage in self.stages:
+            for number in range(stage.workers):
+                stage.inbox.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def submit(self, job, block=False, timeout=None):
+        """Puts job in the first stage. Returns False when the pipeline is
+        full and block is False (or timeout passed)."""
+        try:
+            self.stages[0].inbox.put(job, block, timeout)
+        except Queue.Full:
+            return False
+        return True
+
+    def _work(self, stage, following):
+        while True:
+            job = stage.inbox.get()
+            if job is None:
+                return
+            job.stage = stage.name
+            try:
+                stage.func(job)
+            except Exception as e:
+                job.error = e
+                log.warning('{0} of {1} failed: {2}'.format(stage.name,
+                    job.fn, e))
+                if self.on_failed:
+                    self.on_failed(job)
+                continue
+            if following is not None:
+                # blocks while the next stage is full, this is the
+                # backpressure
+                following.inbox.put(job)
+            elif self.on_done:
+                self.on_done(job)
+
+
+def file_checksum(fn):
+    digest = hashlib.sha1()
+    with open(fn, 'rb') as fp:
+        for data in iter(lambda: fp.read(BUFFER_SIZE), ''):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def transfer_stage(backend, workers=1):
+    def transfer(job):
+        job.checksum = backend.transfer(job.fn)
+    return Stage('transfer', transfer, workers)
+
+
+def verify_stage(incoming):
+    """Compares the file arrived in incoming (the transfer box directory the
+    backend writes to) to the source. Backends that checksum themselves
+    return the checksum from transfer, else the source is hashed here."""
+    def verify(job):
+        job.path = os.path.join(incoming, os.path.basename(job.fn))
+        if job.checksum is None:
+            job.checksum = file_checksum(job.fn)
+        if file_checksum(job.path) != job.checksum:
+            os.remove(job.path)
+            raise TransferError('Checksum of arrived file {0} does not '
+                    'match'.format(job.path))
+    return Stage('verify', verify)
+
+
+def sync_stage(engine):
+    """Copies the file to the archive with a syncengine.SyncEngine whose
+    source is the incoming directory. While the archive is not mounted the
+    stage waits, so the stages before it stop when its queue is full."""
+    def sync(job):
+        stat = os.stat(job.path)
+        while True:
+            try:
+                engine.sync_file(os.path.relpath(job.path, engine.src),
+                        stat.st_size, stat.st_mtime, False)
+            except NotMounted as e:
+                log.warning('{0}, waiting {1} seconds before syncing '
+                        '{2}'.format(e, MOUNT_RETRY, job.path))
+                time.sleep(MOUNT_RETRY)
+            else:
+                break
+        engine.flush()
+    return Stage('sync', sync)
+
+
+def cleanup_stage(cleanup):
+    """cleanup(job) removes what is no longer needed once the file is
+    archived"""
+    return Stage('cleanup', cleanup)
+
+
+def build_file_pipeline(backend, incoming, engine, cleanup=None, on_done=None,
+        on_failed=None, transfer_workers=1):
+    stages = [transfer_stage(backend, transfer_workers),
+            verify_stage(incoming), sync_stage(engine)]
+    if cleanup is not None:
+        stages.append(cleanup_stage(cleanup))
+    return Pipeline(stages, on_done, on_failed)
@@ -1,4 +1,13 @@
-import os, json, glob, datetime, logging, time, subprocess
+import os, sys, datetime, logging, time
+from logtail import LogFollower
+from logindex import LogIndex, QEXACTIVE
+import logparser
+from watcher import Watcher
+import transferconfig, scheduler
+from transfer_backends import get_backend
+from transferpool import TransferPool
+from queuestore import QueueStore
+from filequeue import FileQueue
 
 # prepare log
 log = logging.getLogger(__name__)
@@ -18,165 +27,159 @@ DATEFORMAT = '%Y%m%d'
 MAX_DAYS_IN_QUEUE = 14 # should be more than 1
 MAX_AGE_LOGFILE_DAYS = 200
 
+KEYFILE = 'C:\Program Files\ssh\keys\qexact.ppk'
+DESTINATION = 'qexact@130.229.48.246:/mnt/incoming/'
+
+follower = LogFollower()
+# newest logfile is found without listing the log directory every time
+log_index = LogIndex(LOG_DIR, QEXACTIVE)
+store = QueueStore()
+# KEYFILE and DESTINATION can be overridden in transfer_config.json
+config = transferconfig.load_config(defaults={'keyfile': KEYFILE,
+    'destination': DESTINATION})
+backend = get_backend(config)
+pool = TransferPool(config['workers'], config['per_host'],
+        scheduler.policy_from_config(config['priority']))
+
 def _change_queue_file(queue, fn, status, date):
-    queue[fn]['status'] = status
-    queue[fn]['date'] = date
+    queue.update(fn, status=status, date=date)
     return queue
 
-def main(interval):
+def main(interval, watch=False):
+    """Runs an iteration every interval seconds. With watch, iterations
+    also start when the instrument writes to its logs."""
+    watcher = Watcher([LOG_DIR]) if watch else None
     log.info('Started automatic file transfer for LTQ Orbitrap Velos.')
+    # queue is kept in memory, changes are written to the store
+    queue = get_queue()
     while True:
         currentdate = datetime.datetime.now().strftime(DATEFORMAT)
-        queue = get_queue()
         logs = get_logs()
         if logs:
-            queue = process_queue(logs, queue, currentdate)
-            if queue:
+            if process_queue(logs, queue, currentdate) is not False:
                 queue = transfer_files(queue, currentdate)
                 update_queuefile(queue)
+                follower.save()
             log.info('Next iteration will be in {0} seconds'.format(interval))
         else:
             log.info('No logfile found for {0}, will try again at next iteration, in {1} seconds.'.format(currentdate, interval) )
-        time.sleep(interval)
+        if watcher is None:
+            time.sleep(interval)
+        elif watcher.wait(interval):
+            log.info('Change in logs detected, starting iteration')
 
 
 def get_queue():
     """load queues
     queue = {file: {status:open/closed/done, date: date_of_logfile}, file2: ETC}
     """
-    try:
-        with open('filequeue.json') as fp:
-            queue = json.load(fp)
-    except IOError:
-        log.info('Could not open filequeue.json for queue reading. New empty queue generated.')
-        return {}
-    except ValueError:
-        log.error('Could not parse JSON from filequeue.json for queue reading')
-        raise
-    else:
-        log.info('Got queue from filequeue.json')
-        return queue
+    return FileQueue(store.load(), datefield='date')
 
 
 def get_logs():
     for tries in range(11):
         log.info('Trying to find newest logfile, try {0}/10'.format(tries) )
-        logs = glob.glob(os.path.join(LOG_DIR, 'Thermo Exactive--*'))
+        logs = log_index.to_follow(follower.positions)
         if logs:
             break
         elif tries == 10:
             log.info('No logfiles for today found')
             return False
-    ages = {}
-    for logfile in logs:
-        fn = logfile[logfile.index('Thermo Exactive'):]
-        filedate = fn.replace('Thermo Exactive--', '')
-        filedate = filedate[:10] # length of Thermo date format! Hardcoded, I know, I know...
-        age = datetime.datetime.now() - \
-            datetime.datetime.strptime(filedate, '%Y-%m-%d')
-        ages[ age.days ] = logfile
-
-    log.info('Newest logfile is {0} day(s) old - {1}'.format(min(ages),
-        ages[min(ages)] ) )
-    return ages[min(ages)]
-
-
-def process_queue(logfile, queue, currentdate):
-    fn = None # the file we are currently treating
+    logfile, timestamp = logs[-1]
+    log.info('Newest logfile is {0} day(s) old - {1}'.format(
+        (datetime.datetime.now() - timestamp).days, logfile))
+    # logs that were rotated since the last read are finished first
+    return [x[0] for x in logs]
+
+
+def get_current_file(queue):
+    """Logs are read incrementally, so the file we are treating may have
+    been started in an earlier iteration. Returns the most recently opened
+    one, aborted acquisitions can leave older entries behind, or None."""
+    files = queue.with_status('acquisition stop') + queue.with_status('open')
+    if not files:
+        return None
+    # entries from before opening times were stored have none
+    return max(files, key=lambda fn: queue[fn].get('opened',
+        datetime.datetime.min))
+
+
+def iter_events(logfiles):
+    for logfile in logfiles:
+        for event in logparser.parse(follower.iter_new_lines(logfile),
+                logparser.QEXACTIVE):
+            yield event
+
+
+def process_queue(logfiles, queue, currentdate):
+    fn = get_current_file(queue) # the file we are currently treating
     try:
-        with open(logfile) as fp:
-            for logline in fp:
-                if 'Starting acquisition' in logline:
-                    age = logline[logline.index('=')+1:logline.index(' ')]
-                    age = datetime.datetime.now() - \
-                            datetime.datetime.strptime(age, '%Y-%m-%d')
-                    if age.days < MAX_DAYS_IN_QUEUE:
-                        fn = logline[logline.index('Starting acquisition: Xcalibur will write ')+42: logline.index(' (and may add date/time to the name)')]
-                        if fn not in queue:
-                            queue[fn] = {}
-                            queue = _change_queue_file(queue, fn, 'open', currentdate)
+        for event in iter_events(logfiles):
+            if event.kind == logparser.START:
+                age = datetime.datetime.now() - event.timestamp
+                if age.days < MAX_DAYS_IN_QUEUE:
+                    fn = event.filename
+                    if fn not in queue:
+                        queue.add(fn, status='open', date=currentdate,
+                                opened=event.timestamp)
     
-                elif 'Stopping acquisition' in logline:
-                    if fn in queue and queue[fn]['status'] == 'open':
-                        queue = _change_queue_file(queue, fn, 'acquisition stop', currentdate)
-#                    else: # first logfile did not start with opening, search
-#                          # queue for open files
-#                        for filename in queue:
-#                            if queue[filename]['status'] == 'open':
-#                                queue = _change_queue_file(queue, filename, 'acquisition \
-#                                    stop', currentdate)
+            elif event.kind == logparser.STOP:
+                if fn in queue and queue[fn]['status'] == 'open':
+                    queue = _change_queue_file(queue, fn, 'acquisition stop', currentdate)
     
-                elif 'Storing acquisition scan' in logline:
-                    # if there is a file for which acq has stopped, it is closed
-                    # here, I think
-                    if fn in queue and queue[fn]['status'] == 'acquisition stop':
-                        queue = _change_queue_file(queue, fn, 'closed', currentdate)
-                        fn = None
-#                    else:
-#                        for filename in queue:
-#                            if queue[filename]['status'] == 'acquisition stop':
-#                                queue = _change_queue_file(queue, filename, 'closed', currentdate)
-    except IOError:
-        log.error('Cannot open found logfile {0}. Something may be wrong. \
+            elif event.kind == logparser.CLOSED:
+                # if there is a file for which acq has stopped, it is closed
+                # here, I think
+                if fn in queue and queue[fn]['status'] == 'acquisition stop':
+                    queue = _change_queue_file(queue, fn, 'closed', currentdate)
+                    fn = None
+    except (IOError, OSError):
+        log.error('Cannot open found logfile. Something may be wrong. \
             Skipping this iteration.')
         return False
     
     # Remove old files from queue
-    to_remove = []
-    for fn in queue:
-        age = datetime.datetime.strptime(queue[fn]['date'], DATEFORMAT) - \
-             datetime.datetime.now()
-        if queue[fn]['status'] == 'done' and age.days > MAX_DAYS_IN_QUEUE:
-            to_remove.append(fn)
-    for fn in to_remove:
+    olddate = datetime.datetime.now() - datetime.timedelta(MAX_DAYS_IN_QUEUE)
+    for fn in queue.expired(olddate.strftime(DATEFORMAT)):
         log.info('Removing old file with date {0} from the done \
           queue.'.format(queue[fn]['date']))
-        del(queue[fn])
+        queue.remove(fn)
     
     return queue
 
 
 def transfer_files(queue, currentdate):
-    transferred = False
-    for fn in queue:
-        if queue[fn]['status'] == 'closed':
-            if not os.path.exists(fn):
-                log.warning('Closed file {0} not found on local computer. \
-                    Marked as closed in queue.'.format(fn) )
-                queue[fn]['status'] = 'done'
-                continue
-            try:
-                subprocess.check_call(['C:\Program Files\ssh\pscp.exe', '-i',
-                'C:\Program Files\ssh\keys\qexact.ppk', fn, 'qexact@130.229.48.246:/mnt/incoming/'])
-            except OSError:
-                log.error('Could not call pscp.exe in the specified location \
-                c:\Program Files\ssh. Exiting')
-                raise
-            except subprocess.CalledProcessError:
-                log.warning('Secure copying of file {0} to remote host failed. \
-                    Will try again at next iteration'.format(fn) )
-            else:
-                transferred = True
-                log.info('File {0} copied to remote server.'.format(fn) )
-                queue[fn]['status'] = 'done'
-                queue[fn]['date'] = currentdate
+    """Transfers closed files in parallel, each queue entry is marked done
+    as soon as its own transfer finishes"""
+    def transfer_finished(fn, error):
+        if error:
+            log.warning('Secure copying of file {0} to remote host failed. \
+                Will try again at next iteration'.format(fn) )
+        else:
+            log.info('File {0} copied to remote server.'.format(fn) )
+            _change_queue_file(queue, fn, 'done', currentdate)
+            store.save(queue)
+
+    transferring = False
+    for fn in queue.with_status('closed'):
+        if not os.path.exists(fn):
+            log.warning('Closed file {0} not found on local computer. \
+                Marked as closed in queue.'.format(fn) )
+            _change_queue_file(queue, fn, 'done', currentdate)
+            continue
+        transferring = True
+        pool.submit(fn, backend, transfer_finished)
     
-    if not transferred:
+    if not transferring:
         log.info('No files currently ready for transfer.')
+    pool.join()
     return queue
 
 
 def update_queuefile(queue):
-    # write queues to file:
-    try:
-        with open('filequeue.json', 'w') as fp:
-            json.dump(queue, fp)
-    except IOError:
-        log.error('Could not open or parse filequeue.json for queue reading')
-        raise
-    else:
-        log.info('Queue written to file.')
+    # write changed queue entries to the queue database
+    store.save(queue)
 
 
 if __name__  == '__main__':
-    main(1800)
+    main(1800, watch='--watch' in sys.argv[1:])
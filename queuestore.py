@@ -0,0 +1,201 @@
+"""
+Durable storage of the file queue in an SQLite database. Every queue entry
+is a row, so a status change is a single row write in a transaction instead
+of rewriting the whole queue, and a crash during writing can not corrupt
+it. An existing filequeue.json is migrated on first use.
+
+The rest of the daemon state (last opened and closed timestamps, logfile
+read positions) is kept in the same database by StateStore, as a versioned
+snapshot per section plus a journal of changes since the snapshot. Sections
+are only read when first used, and changes are written in the transaction
+that saves the queue, so queue and log positions can not get out of step.
+"""
+
+import os, json, time, datetime, logging, sqlite3, threading
+
+log = logging.getLogger(__name__)
+
+QUEUE_DB = 'filequeue.sqlite'
+QUEUE_JSON = 'filequeue.json'
+TIMEFORMAT = '%Y%m%d %H:%M:%S.%f'
+STATE_VERSION = 1 # snapshots of another version are discarded
+COMPACT_EVERY = 1000 # journal entries before they are folded into snapshots
+
+
+class QueueEncoder(json.JSONEncoder):
+    """Queue keys and entries can contain dates, keep them as such"""
+    def default(self, obj):
+        if isinstance(obj, datetime.datetime):
+            return {'__datetime__': obj.strftime(TIMEFORMAT)}
+        elif isinstance(obj, datetime.date):
+            return {'__date__': obj.strftime('%Y%m%d')}
+        return json.JSONEncoder.default(self, obj)
+
+
+def decode_dates(obj):
+    if '__datetime__' in obj:
+        return datetime.datetime.strptime(obj['__datetime__'], TIMEFORMAT)
+    elif '__date__' in obj:
+        return datetime.datetime.strptime(obj['__date__'], '%Y%m%d').date()
+    return obj
+
+
+def encode(obj):
+    return json.dumps(obj, cls=QueueEncoder, sort_keys=True)
+
+
+def decode(text):
+    return json.loads(text, object_hook=decode_dates)
+
+
+class QueueStore(object):
+    def __init__(self, dbfile=QUEUE_DB, jsonfile=QUEUE_JSON):
+        self.dbfile = dbfile
+        # transfer callbacks write from worker threads
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(dbfile, check_same_thread=False)
+        # the journal makes sqlite roll back half written transactions when
+        # opening the database after a crash
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=FULL')
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS queue (key TEXT '
+                    'PRIMARY KEY, status TEXT, updated REAL, entry TEXT)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS queue_status ON '
+                    'queue (status)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS queue_updated ON '
+                    'queue (updated)')
+        self.state = StateStore(self.db, self.lock)
+        if os.path.exists(jsonfile):
+            self.migrate_json(jsonfile)
+
+    def migrate_json(self, jsonfile):
+        """One-time import of the old JSON queue file, which is renamed
+        afterwards so it will not be imported again"""
+        try:
+            with open(jsonfile) as fp:
+                queue = json.load(fp)
+        except ValueError:
+            log.error('Could not parse JSON from {0} for queue '
+                    'migration'.format(jsonfile))
+            raise
+        with self.lock, self.db:
+            for key, entry in queue.items():
+                self._write(key, entry)
+        os.rename(jsonfile, '{0}.migrated'.format(jsonfile))
+        log.info('Migrated {0} queue entries from {1} to {2}'.format(
+            len(queue), jsonfile, self.dbfile))
+
+    def _write(self, key, entry):
+        self.db.execute('INSERT OR REPLACE INTO queue (key, status, updated, '
+                'entry) VALUES (?, ?, ?, ?)', (encode(key),
+                    entry.get('status'), time.time(), encode(entry)))
+
+    def load(self):
+        """Returns the queue as {key: entry}"""
+        queue = {}
+        with self.lock:
+            for key, entry in self.db.execute('SELECT key, entry FROM queue'):
+                queue[decode(key)] = decode(entry)
+        log.info('Got queue from {0}'.format(self.dbfile))
+        return queue
+
+    def save(self, queue):
+        """Writes entries of a filequeue.FileQueue that changed since the
+        last save, deletes removed ones and writes state changes, in one
+        transaction"""
+        changed, removed = queue.pop_changes()
+        with self.lock, self.db:
+            for key, entry in changed.items():
+                self._write(key, entry)
+            for key in removed:
+                self.db.execute('DELETE FROM queue WHERE key=?', (encode(key),))
+            self.state.write()
+        log.info('Queue written to {0}, {1} entries changed, {2} '
+                'removed.'.format(self.dbfile, len(changed), len(removed)))
+
+
+class StateStore(object):
+    """Sections of {key: value} state. Values can contain dates. Changes
+    are kept until write() is called, which QueueStore.save does."""
+    def __init__(self, db, lock):
+        self.db = db
+        self.lock = lock
+        self.sections = {}
+        self.pending = []
+        with self.lock, self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS state_snapshot '
+                    '(section TEXT PRIMARY KEY, version INTEGER, data TEXT)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS state_journal (seq '
+                    'INTEGER PRIMARY KEY AUTOINCREMENT, section TEXT, key '
+                    'TEXT, value TEXT)')
+            self.journaled = self.db.execute('SELECT COUNT(*) FROM '
+                    'state_journal').fetchone()[0]
+
+    def section(self, name):
+        """Returns the dict of section name, read on first use. Change it
+        only with set and delete."""
+        with self.lock:
+            if name not in self.sections:
+                self.sections[name] = self._read(name)
+            return self.sections[name]
+
+    def _read(self, name):
+        row = self.db.execute('SELECT version, data FROM state_snapshot WHERE '
+                'section=?', (name,)).fetchone()
+        if row is None:
+            data = {}
+        elif row[0] != STATE_VERSION:
+            log.warning('State snapshot {0} has version {1} instead of {2}, '
+                    'starting it empty'.format(name, row[0], STATE_VERSION))
+            with self.db:
+                self.db.execute('DELETE FROM state_snapshot WHERE section=?',
+                        (name,))
+                self.db.execute('DELETE FROM state_journal WHERE section=?',
+                        (name,))
+            return {}
+        else:
+            data = decode(row[1])
+        for key, value in self.db.execute('SELECT key, value FROM '
+                'state_journal WHERE section=? ORDER BY seq', (name,)):
+            if value is None:
+                data.pop(key, None)
+            else:
+                data[key] = decode(value)
+        return data
+
+    def set(self, name, key, value):
+        section = self.section(name)
+        with self.lock:
+            section[key] = value
+            self.pending.append((name, key, encode(value)))
+
+    def delete(self, name, key):
+        section = self.section(name)
+        with self.lock:
+            if section.pop(key, None) is not None:
+                self.pending.append((name, key, None))
+
+    def write(self):
+        """Appends changes to the journal, or writes new snapshots when the
+        journal has grown. Call with lock held in a transaction."""
+        if not self.pending:
+            return
+        self.db.executemany('INSERT INTO state_journal (section, key, value) '
+                'VALUES (?, ?, ?)', self.pending)
+        self.journaled += len(self.pending)
+        self.pending = []
+        if self.journaled >= COMPACT_EVERY:
+            self._compact()
+
+    def _compact(self):
+        """Folds the journal into snapshots. Only sections that have been
+        read are in memory, others keep their journal."""
+        for name, data in self.sections.items():
+            self.db.execute('INSERT OR REPLACE INTO state_snapshot (section, '
+                    'version, data) VALUES (?, ?, ?)', (name, STATE_VERSION,
+                        encode(data)))
+            self.db.execute('DELETE FROM state_journal WHERE section=?',
+                    (name,))
+        self.journaled = self.db.execute('SELECT COUNT(*) FROM '
+                'state_journal').fetchone()[0]
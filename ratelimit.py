@@ -0,0 +1,106 @@
+"""
+Token bucket limiting the bytes per second sent by the in-process transfer
+backends (chunked and sftp). One bucket can be shared by all backends and
+threads to give them a common bandwidth budget, and a bucket with a parent
+is limited by both. The rate can be changed while transfers run, e.g. by a
+ThrottlePolicy when an acquisition starts. pscp runs as a separate program
+and cannot be limited this way.
+"""
+
+import time, threading
+
+MAX_WAIT = 1 # seconds, waiting transfers notice rate changes this often
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst=None, parent=None):
+        """rate in bytes per second, None is unlimited and 0 pauses
+        transfers until the rate is changed. burst is the
+        number of bytes that may be sent at once after being idle, by
+        default one second worth."""
+        self.rate = rate
+        self.burst = burst
+        self.parent = parent
+        self.tokens = 0
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        """Call with self.lock held"""
+        now = time.time()
+        if self.rate is None:
+            self.tokens = 0
+        else:
+            capacity = self.burst if self.burst is not None else self.rate
+            self.tokens = min(capacity, self.tokens +
+                    (now - self.last) * self.rate)
+        self.last = now
+
+    def set_rate(self, rate):
+        with self.lock:
+            self._refill()
+            self.rate = rate
+            if rate is None:
+                self.tokens = 0
+
+    def consume(self, nbytes):
+        """Blocks until nbytes may be sent. Larger amounts than the burst
+        are allowed, the bucket then goes into debt and later callers
+        wait until it is paid off."""
+        if self.parent is not None:
+            self.parent.consume(nbytes)
+        with self.lock:
+            self._refill()
+            self.tokens -= nbytes
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 0:
+                    return
+                wait = MAX_WAIT if not self.rate else min(
+                        -self.tokens / float(self.rate), MAX_WAIT)
+            time.sleep(wait)
+
+
+def _minutes(clock):
+    """'HH:MM' -> minutes after midnight"""
+    hour, minute = clock.split(':')
+    return int(hour) * 60 + int(minute)
+
+
+class ThrottlePolicy(object):
+    """Decides the transfer rate of an instrument. rate is the normal
+    rate, profiles [{'start': 'HH:MM', 'end': 'HH:MM', 'rate': r}] replace
+    it during parts of the day (the first matching one counts, end may be
+    past midnight), and acquiring is a ceiling while an acquisition is
+    running. All rates in bytes per second, None is unlimited and 0
+    pauses transfers."""
+    def __init__(self, rate=None, acquiring=None, profiles=()):
+        self.rate = rate
+        self.acquiring = acquiring
+        self.profiles = [(_minutes(x['start']), _minutes(x['end']), x['rate'])
+                for x in profiles]
+
+    @property
+    def enabled(self):
+        return self.rate is not None or self.acquiring is not None or \
+                bool(self.profiles)
+
+    def rate_at(self, now, acquiring):
+        rate = self.rate
+        minute = now.hour * 60 + now.minute
+        for start, end, profile_rate in self.profiles:
+            if start <= minute < end or (end < start and (minute >= start or
+                    minute < end)):
+                rate = profile_rate
+                break
+        if acquiring and self.acquiring is not None:
+            rate = self.acquiring if rate is None else min(rate,
+                    self.acquiring)
+        return rate
+
+
+def policy_from_config(config):
+    """ThrottlePolicy from the throttle section of a transferconfig"""
+    return ThrottlePolicy(config['rate'], config['acquiring'],
+            config['profiles'])
@@ -0,0 +1,130 @@
+"""
+Order in which the transfer pool takes pending files. Files are put in
+priority classes by filename pattern (e.g. QC runs before project files),
+and within a class taken smallest-first, oldest-first or in submission
+order. Files gain priority while they wait, so large or low priority files
+are not starved, and an operator can bump a file to the front. Wait times
+per class are recorded to see what the policy does to time-to-server.
+"""
+
+import os, re, math, time, threading, collections
+
+SMALLEST, OLDEST, FIFO = 'smallest', 'oldest', 'fifo'
+DEFAULT_CLASS = 'default'
+DEFAULT_PRIORITY = 10 # lower is earlier
+BUMPED_PRIORITY = -1000
+AGING = 3600 # seconds of waiting that raise priority by one
+SAMPLES = 1000 # wait times kept per class
+
+
+class PendingTransfer(object):
+    def __init__(self, fn, backend, callback, owner, cls, priority):
+        self.fn = fn
+        self.backend = backend
+        self.callback = callback
+        self.owner = owner
+        self.cls = cls
+        self.priority = priority
+        self.submitted = time.time()
+        self.started = None
+        try:
+            stat = os.stat(fn)
+        except OSError:
+            self.size, self.mtime = 0, self.submitted
+        else:
+            self.size, self.mtime = stat.st_size, stat.st_mtime
+
+
+def percentile(values, fraction):
+    """Nearest rank percentile of sorted values"""
+    index = int(math.ceil(fraction * len(values))) - 1
+    return values[min(max(index, 0), len(values) - 1)]
+
+
+class PriorityPolicy(object):
+    def __init__(self, order=OLDEST, classes=(), aging=AGING):
+        """classes: [{'name': 'qc', 'pattern': 'QC', 'priority': 0}],
+        patterns are regexes searched for in the filename, the first
+        matching class counts. Files without a class get DEFAULT_PRIORITY.
+        aging: seconds of waiting after which a file's priority goes up by
+        one, None disables aging."""
+        if order not in (SMALLEST, OLDEST, FIFO):
+            raise ValueError('Unknown transfer order {0}'.format(order))
+        self.order = order
+        self.classes = [(x['name'], re.compile(x['pattern']), x['priority'])
+                for x in classes]
+        self.aging = aging
+        self.bumped = set()
+        self.waits = collections.defaultdict(lambda: collections.deque(
+            maxlen=SAMPLES))
+        self.lock = threading.Lock()
+
+    def classify(self, fn):
+        """Returns (class name, priority) of a file"""
+        name = os.path.basename(fn)
+        for cls, pattern, priority in self.classes:
+            if pattern.search(name):
+                return cls, priority
+        return DEFAULT_CLASS, DEFAULT_PRIORITY
+
+    def job(self, fn, backend, callback, owner):
+        cls, priority = self.classify(fn)
+        return PendingTransfer(fn, backend, callback, owner, cls, priority)
+
+    def bump(self, fn):
+        """Transfer fn before anything else, also when it is submitted
+        later"""
+        with self.lock:
+            self.bumped.add(os.path.basename(fn))
+
+    def key(self, job, now):
+        """Sort key, the pending job with the lowest key goes first"""
+        with self.lock:
+            bumped = os.path.basename(job.fn) in self.bumped
+        priority = BUMPED_PRIORITY if bumped else job.priority
+        if self.aging:
+            # in whole steps, so files submitted around the same time are
+            # still ordered by size or mtime
+            priority -= int((now - job.submitted) // self.aging)
+        if self.order == SMALLEST:
+            return priority, job.size, job.submitted
+        elif self.order == OLDEST:
+            return priority, job.mtime, job.submitted
+        return priority, job.submitted
+
+    def choose(self, jobs):
+        """Best of the pending jobs, or None"""
+        now = time.time()
+        best, bestkey = None, None
+        for job in jobs:
+            key = self.key(job, now)
+            if best is None or key < bestkey:
+                best, bestkey = job, key
+        return best
+
+    def started(self, job):
+        job.started = time.time()
+        with self.lock:
+            self.bumped.discard(os.path.basename(job.fn))
+            self.waits[job.cls].append(job.started - job.submitted)
+
+    def wait_stats(self):
+        """{class: {'count', 'mean', 'p50', 'p95', 'max'}} of the queue wait
+        times in seconds of recently started transfers"""
+        stats = {}
+        with self.lock:
+            for cls, waits in self.waits.items():
+                if not waits:
+                    continue
+                values = sorted(waits)
+                stats[cls] = {'count': len(values),
+                        'mean': sum(values) / len(values),
+                        'p50': percentile(values, 0.5),
+                        'p95': percentile(values, 0.95),
+                        'max': values[-1]}
+        return stats
+
+
+def policy_from_config(config):
+    """PriorityPolicy from the priority section of a transferconfig"""
+    return PriorityPolicy(config['order'], config['classes'], config['aging'])
@@ -0,0 +1,97 @@
+"""
+Persistent cache of rawstatus answers from the metadata server, so files
+whose status is already known are not asked about again on every run.
+Answers expire per state: archived ('done') files do not change anymore and
+are kept until evicted, other states are asked again after a short time.
+When the cache grows beyond its maximum size, expired and then least
+recently used answers are evicted.
+"""
+
+import json, time, logging, sqlite3, threading
+
+log = logging.getLogger(__name__)
+
+CACHE_DB = 'rawstatus_cache.sqlite'
+TTLS = {'done': None} # seconds per state, None is permanent
+DEFAULT_TTL = 600
+MAX_ENTRIES = 100000
+SQL_VARIABLES = 500 # sqlite limits number of ? in a query
+
+
+def answer_state(answer):
+    """rawstatus answers are [state, date] or a bare state"""
+    if isinstance(answer, list):
+        return answer[0] if answer else None
+    return answer
+
+
+class StatusCache(object):
+    def __init__(self, dbfile=CACHE_DB, ttls=TTLS, default_ttl=DEFAULT_TTL,
+            max_entries=MAX_ENTRIES):
+        self.dbfile = dbfile
+        self.ttls = ttls
+        self.default_ttl = default_ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(dbfile, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS status (fn TEXT '
+                    'PRIMARY KEY, answer TEXT, expires REAL, used REAL)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS status_expires ON '
+                    'status (expires)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS status_used ON '
+                    'status (used)')
+
+    def _expiry(self, answer, now):
+        ttl = self.ttls.get(answer_state(answer), self.default_ttl)
+        return None if ttl is None else now + ttl
+
+    def get(self, files):
+        """Returns {fn: answer} for the files with an unexpired answer"""
+        now = time.time()
+        files = list(files)
+        hits = {}
+        with self.lock, self.db:
+            for i in range(0, len(files), SQL_VARIABLES):
+                chunk = files[i:i + SQL_VARIABLES]
+                rows = self.db.execute('SELECT fn, answer FROM status WHERE '
+                        '(expires IS NULL OR expires > ?) AND fn IN ({0})'.format(
+                            ','.join('?' * len(chunk))), [now] + chunk)
+                found = dict((fn, json.loads(answer)) for fn, answer in rows)
+                if not found:
+                    continue
+                self.db.execute('UPDATE status SET used=? WHERE fn IN '
+                        '({0})'.format(','.join('?' * len(found))),
+                        [now] + found.keys())
+                hits.update(found)
+        return hits
+
+    def put(self, answers):
+        """Stores {fn: answer} from the server"""
+        now = time.time()
+        with self.lock, self.db:
+            self.db.executemany('INSERT OR REPLACE INTO status (fn, answer, '
+                    'expires, used) VALUES (?, ?, ?, ?)', [(fn,
+                        json.dumps(answer), self._expiry(answer, now), now)
+                        for fn, answer in answers.items()])
+        self.evict()
+
+    def evict(self):
+        """Removes expired answers, then least recently used ones until at
+        most max_entries are left"""
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM status WHERE expires <= ?',
+                    (time.time(),))
+            count = self.db.execute('SELECT COUNT(*) FROM status').fetchone()[0]
+            if count > self.max_entries:
+                self.db.execute('DELETE FROM status WHERE fn IN (SELECT fn '
+                        'FROM status ORDER BY used LIMIT ?)',
+                        (count - self.max_entries,))
+                log.info('Evicted {0} least recently used answers from status '
+                        'cache'.format(count - self.max_entries))
+
+    def forget(self, files):
+        with self.lock, self.db:
+            self.db.executemany('DELETE FROM status WHERE fn=?',
+                    [(fn,) for fn in files])
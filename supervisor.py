@@ -0,0 +1,109 @@
+"""
+Runs the file transferrers of several instruments in one process, e.g. on
+a transfer box that gathers their files. Each instrument keeps its queue
+and log positions in its own state directory. All instruments share one
+transfer pool, which takes their files in turns, one metadata client and
+an optional bandwidth budget for the in-process transfer backends.
+
+Usage:
+    python supervisor.py [supervisor_config.json]
+
+Config, transfer settings per instrument override those of
+transfer_config.json:
+
+{"statedir": "state", "bandwidth": 50000000, "workers": 6, "per_host": 4,
+ "instruments": [
+    {"name": "orbi", "type": "orbi", "interval": 1800, "watch": true,
+     "logdir": "/mnt/instruments/orbi/logs",
+     "transfer": {"backend": "sftp", "destination": "orbi@box:/mnt/incoming/"}},
+    {"name": "qe1", "type": "qexactive", "logdir": "/mnt/instruments/qe1/log"}
+ ]}
+"""
+
+import os, sys, json, logging, threading
+
+import metadata_querying, transferconfig, scheduler
+from ms_filetransfer import (OrbiFileTransferrer, QExactiveFileTransferrer,
+        TRANSFER_DEFAULTS, URL, LOGIN)
+from transferpool import TransferPool
+from statuscache import StatusCache
+from ratelimit import TokenBucket
+
+log = logging.getLogger(__name__)
+
+CONFIG_FILE = 'supervisor_config.json'
+INTERVAL = 1800
+TRANSFERRERS = {
+    'orbi': OrbiFileTransferrer,
+    'qexactive': QExactiveFileTransferrer,
+    }
+
+
+class Supervisor(object):
+    def __init__(self, config):
+        self.config = config
+        self.statedir = config.get('statedir', 'state')
+        if not os.path.isdir(self.statedir):
+            os.makedirs(self.statedir)
+        transfer = transferconfig.load_config(defaults=TRANSFER_DEFAULTS)
+        self.pool = TransferPool(config.get('workers', transfer['workers']),
+                config.get('per_host', transfer['per_host']),
+                scheduler.policy_from_config(transfer['priority']))
+        self.metadata = metadata_querying.MetadataClient(URL, LOGIN,
+                cache=StatusCache(os.path.join(self.statedir,
+                    'rawstatus_cache.sqlite')))
+        self.limiter = None
+        if config.get('bandwidth'):
+            self.limiter = TokenBucket(config['bandwidth'])
+        self.transferrers = []
+        for instrument in config['instruments']:
+            self.transferrers.append(self.create(instrument, transfer))
+
+    def create(self, instrument, transfer):
+        name = instrument['name']
+        try:
+            cls = TRANSFERRERS[instrument['type']]
+        except KeyError:
+            raise ValueError('Unknown instrument type {0} for {1}'.format(
+                instrument['type'], name))
+        return cls(name, instrument.get('interval', INTERVAL),
+                instrument['logdir'], watch=instrument.get('watch', False),
+                config=transferconfig.merge(transfer,
+                    instrument.get('transfer', {})),
+                statedir=os.path.join(self.statedir, name), pool=self.pool,
+                metadata=self.metadata, limiter=self.limiter)
+
+    def run(self):
+        """Runs all transferrers until one of them fails, its error is
+        raised"""
+        failed = []
+        stopped = threading.Event()
+        def run(transferrer):
+            try:
+                transferrer.run()
+            except Exception:
+                log.exception('Transferrer {0} failed'.format(
+                    transferrer.name))
+                failed.append(sys.exc_info())
+                stopped.set()
+        for transferrer in self.transferrers:
+            thread = threading.Thread(target=run, args=(transferrer,),
+                    name=transferrer.name)
+            thread.daemon = True
+            thread.start()
+        log.info('Supervising {0} instruments'.format(len(self.transferrers)))
+        # timeout keeps the main thread responsive to interrupts
+        while not stopped.wait(1):
+            pass
+        raise failed[0][0], failed[0][1], failed[0][2]
+
+
+def load_config(fn=CONFIG_FILE):
+    with open(fn) as fp:
+        return json.load(fp)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - '
+            'PID:%(process)d - %(name)s - %(levelname)s - %(message)s')
+    Supervisor(load_config(*sys.argv[1:2])).run()
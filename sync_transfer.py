@@ -6,11 +6,16 @@ occur if the sync is slower than the crontab time.
 Therefore detached running or start from init script is advisable.
 
 Usage:
-    python sync_to_mount sourcefolder destinationfolder
+    python sync_to_mount sourcefolder destinationfolder [metricsport]
+
+With metricsport, counters and timings of the sync are served on
+http://127.0.0.1:metricsport/metrics
 
 """
 
 import os, sys, logging, time
+import metrics
+from syncengine import SyncEngine, NotMounted
 
 log = logging.getLogger('sync_to_mount')
 log.setLevel(10)
@@ -19,21 +24,30 @@ formatter = logging.Formatter('%(asctime)s - PID:%(process)d - %(name)s - '
                                 '%(levelname)s - %(message)s')
 fh.setFormatter(formatter)
 log.addHandler(fh)
+logging.getLogger('syncengine').addHandler(fh)
+logging.getLogger('syncengine').setLevel(10)
 
-if len(sys.argv) != 3:
+if len(sys.argv) not in (3, 4):
     print __doc__
     sys.exit()
 
 src = sys.argv[1]
 dst = sys.argv[2]
+if len(sys.argv) == 4:
+    metrics.enable()
+    metrics.serve(int(sys.argv[3]))
+engine = SyncEngine(src, dst)
 
 while True:
-    # check mounts
+    # check mounts, also done by the engine before every file
     if not os.path.ismount(dst):
         log.warning('Destination folder is not a mount point. Will not sync now.')
     else:
         log.info('Syncing {0} folder to destination {1}'.format(src, dst))
-        os.system('rsync -lts -r /mnt/datadrive/ /mnt/kalevalatmp/')
+        try:
+            engine.sync()
+        except NotMounted:
+            log.warning('Destination folder was unmounted during sync. Will '
+                    'continue at next iteration.')
     
     time.sleep(900)
-
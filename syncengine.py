@@ -0,0 +1,222 @@
+"""
+Copies new and changed files from a source to a destination folder, which
+is usually a mounted share. A manifest of synced files (path, size, mtime,
+checksum) is kept, so an unchanged tree costs a directory walk with one
+stat per file and no work on the destination. Files are copied in
+parallel, written to a temporary name and renamed into place, and the
+destination is checked to still be mounted before every file.
+"""
+
+import os, stat, time, hashlib, logging, sqlite3, threading, Queue
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+MANIFEST = 'sync_manifest.sqlite'
+WORKERS = 4
+BUFFER_SIZE = 4 * 1024 * 1024
+TMP_PREFIX = '.synctmp.'
+COMMIT_EVERY = 500 # files, manifest writes are batched
+
+SYNC_SECONDS = metrics.histogram('sync_seconds', 'Duration of syncing a tree '
+        'to the archive')
+SYNCED_FILES = metrics.counter('sync_files_total', 'Files copied to the '
+        'archive')
+SYNCED_BYTES = metrics.counter('sync_bytes_total', 'Bytes copied to the '
+        'archive')
+
+
+class NotMounted(Exception):
+    pass
+
+
+def walk_files(top):
+    """Generator of (relative path, size, mtime, is_symlink) for all files
+    below top. Uses scandir when available, which saves a stat call per
+    directory entry."""
+    stack = ['']
+    while stack:
+        reldir = stack.pop()
+        directory = os.path.join(top, reldir)
+        if scandir is not None:
+            for entry in scandir(directory):
+                relpath = os.path.join(reldir, entry.name)
+                if entry.is_symlink():
+                    st = entry.stat(follow_symlinks=False)
+                    yield relpath, st.st_size, st.st_mtime, True
+                elif entry.is_dir():
+                    stack.append(relpath)
+                elif not entry.name.startswith(TMP_PREFIX):
+                    st = entry.stat()
+                    yield relpath, st.st_size, st.st_mtime, False
+        else:
+            for name in os.listdir(directory):
+                relpath = os.path.join(reldir, name)
+                st = os.lstat(os.path.join(top, relpath))
+                if stat.S_ISLNK(st.st_mode):
+                    yield relpath, st.st_size, st.st_mtime, True
+                elif stat.S_ISDIR(st.st_mode):
+                    stack.append(relpath)
+                elif not name.startswith(TMP_PREFIX):
+                    yield relpath, st.st_size, st.st_mtime, False
+
+
+class SyncEngine(object):
+    def __init__(self, src, dst, manifest=MANIFEST, workers=WORKERS,
+            buffer_size=BUFFER_SIZE, require_mount=True):
+        self.src = src
+        self.dst = dst
+        self.workers = workers
+        self.buffer_size = buffer_size
+        self.require_mount = require_mount
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(manifest, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.pending = []
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS synced (path TEXT '
+                    'PRIMARY KEY, size INTEGER, mtime REAL, checksum TEXT)')
+        # manifest is kept in memory between runs, it is only read once
+        self.synced = dict((path, (size, mtime)) for path, size, mtime in
+                self.db.execute('SELECT path, size, mtime FROM synced'))
+
+    def check_mount(self):
+        if self.require_mount and not os.path.ismount(self.dst):
+            raise NotMounted('Destination folder {0} is not a mount '
+                    'point'.format(self.dst))
+
+    def changed_files(self):
+        """Files in src that are not in the manifest or have another size
+        or mtime than when they were synced"""
+        for relpath, size, mtime, symlink in walk_files(self.src):
+            if self.synced.get(relpath) != (size, mtime):
+                yield relpath, size, mtime, symlink
+
+    def _destination(self, relpath):
+        """Returns destination and temporary path, creates directories"""
+        dst = os.path.join(self.dst, relpath)
+        dstdir = os.path.dirname(dst)
+        if not os.path.isdir(dstdir):
+            try:
+                os.makedirs(dstdir)
+            except OSError:
+                if not os.path.isdir(dstdir): # made by another worker
+                    raise
+        return dst, os.path.join(dstdir, TMP_PREFIX + os.path.basename(dst))
+
+    def copy_file(self, relpath, mtime):
+        """Copies src file to a temporary file next to its destination,
+        hashing it on the way, and renames it into place. Returns the
+        checksum."""
+        src = os.path.join(self.src, relpath)
+        dst, tmp = self._destination(relpath)
+        digest = hashlib.sha1()
+        try:
+            with open(src, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+                for data in iter(lambda: fsrc.read(self.buffer_size), ''):
+                    digest.update(data)
+                    fdst.write(data)
+            os.utime(tmp, (mtime, mtime))
+            os.rename(tmp, dst)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return digest.hexdigest()
+
+    def copy_symlink(self, relpath):
+        dst, tmp = self._destination(relpath)
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        os.symlink(os.readlink(os.path.join(self.src, relpath)), tmp)
+        os.rename(tmp, dst)
+        return None
+
+    def _record(self, relpath, size, mtime, checksum):
+        with self.lock:
+            self.pending.append((relpath, size, mtime, checksum))
+            if len(self.pending) >= COMMIT_EVERY:
+                self._commit()
+
+    def _commit(self):
+        """Write synced files to the manifest, call with self.lock held. A
+        crash before commit only means those files are copied again."""
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO synced (path, size, '
+                    'mtime, checksum) VALUES (?, ?, ?, ?)', self.pending)
+        for relpath, size, mtime, checksum in self.pending:
+            self.synced[relpath] = (size, mtime)
+        self.pending = []
+
+    def sync_file(self, relpath, size, mtime, symlink):
+        self.check_mount()
+        if symlink:
+            checksum = self.copy_symlink(relpath)
+        else:
+            checksum = self.copy_file(relpath, mtime)
+        self._record(relpath, size, mtime, checksum)
+        SYNCED_FILES.inc()
+        SYNCED_BYTES.inc(size)
+
+    def flush(self):
+        """Writes recorded files to the manifest now, for callers syncing
+        single files with sync_file"""
+        with self.lock:
+            self._commit()
+
+    @metrics.timed(SYNC_SECONDS)
+    def sync(self):
+        """Syncs all new and changed files, returns number of files
+        copied. Raises NotMounted when the destination is (or becomes)
+        unmounted."""
+        self.check_mount()
+        start = time.time()
+        jobs = Queue.Queue(maxsize=self.workers * 4)
+        errors = []
+        copied = [0]
+        def work():
+            while True:
+                job = jobs.get()
+                if job is None:
+                    return
+                if errors:
+                    continue
+                try:
+                    self.sync_file(*job)
+                except NotMounted as e:
+                    errors.append(e)
+                except (IOError, OSError) as e:
+                    log.error('Could not sync {0}: {1}'.format(job[0], e))
+                else:
+                    with self.lock:
+                        copied[0] += 1
+        threads = [threading.Thread(target=work) for x in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            for job in self.changed_files():
+                if errors:
+                    break
+                jobs.put(job)
+        finally:
+            for thread in threads:
+                jobs.put(None)
+            for thread in threads:
+                thread.join()
+            with self.lock:
+                self._commit()
+        if errors:
+            raise errors[0]
+        log.info('Synced {0} files from {1} to {2} in {3:.2f} seconds'.format(
+            copied[0], self.src, self.dst, time.time() - start))
+        return copied[0]
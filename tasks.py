@@ -0,0 +1,110 @@
+"""
+Runs the parts of a transfer daemon (log reading, transfers, metadata
+queries, saving state) as separate tasks in their own threads, so a slow
+one does not hold up the others. A task is called every interval or as soon
+as it is triggered by another task, and a call taking longer than its
+timeout is given up on: the task is called again once the call in
+progress has finished. An unexpected error in any task stops the runtime
+and is raised from Runtime.run.
+"""
+
+import threading, logging, sys
+
+log = logging.getLogger(__name__)
+
+
+class TaskTimeout(Exception):
+    pass
+
+
+class Task(object):
+    def __init__(self, name, func, interval, timeout=None, wait=None):
+        """wait(interval) replaces waiting for interval or a trigger, e.g.
+        to wait for changes in logfiles. It should return when
+        triggered."""
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.timeout = timeout
+        self.wait = wait
+        self.event = threading.Event()
+        self.call = None # thread of the call in progress
+        self.error = None
+
+    def trigger(self):
+        """Call the task now instead of when its interval has passed"""
+        self.event.set()
+
+    def _call(self):
+        try:
+            self.func()
+        except Exception:
+            self.error = sys.exc_info()
+
+    def run_once(self):
+        """Calls func in its own thread and waits at most timeout for it.
+        Raises TaskTimeout when it did not finish, it then keeps running in
+        the background and is not called again until it has finished."""
+        if self.call is not None and self.call.is_alive():
+            log.warning('Task {0} is still running from last time, '
+                    'skipping'.format(self.name))
+            return
+        self.call = threading.Thread(target=self._call, name=self.name)
+        self.call.daemon = True
+        self.call.start()
+        self.call.join(self.timeout)
+        if self.call.is_alive():
+            raise TaskTimeout('Task {0} did not finish within {1} '
+                    'seconds'.format(self.name, self.timeout))
+
+    def pause(self):
+        if self.wait is not None:
+            self.wait(self.interval)
+        else:
+            self.event.wait(self.interval)
+        self.event.clear()
+
+
+class Runtime(object):
+    def __init__(self, tasks):
+        self.tasks = dict((task.name, task) for task in tasks)
+        self.stopped = threading.Event()
+        self.failed = None
+
+    def trigger(self, name):
+        self.tasks[name].trigger()
+
+    def _loop(self, task):
+        while not self.stopped.is_set():
+            try:
+                task.run_once()
+            except TaskTimeout as e:
+                log.warning(str(e))
+            if task.error is not None:
+                self.failed = task.error
+                self.stopped.set()
+                return
+            task.pause()
+
+    def run(self):
+        """Runs the tasks until one of them raises an error, which is
+        re-raised here"""
+        threads = []
+        for task in self.tasks.values():
+            thread = threading.Thread(target=self._loop, args=(task,),
+                    name='{0}-loop'.format(task.name))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        # timeout keeps the main thread responsive to interrupts
+        while not self.stopped.wait(1):
+            pass
+        failed = self.failed
+        if failed is None:
+            return
+        raise failed[0], failed[1], failed[2]
+
+    def stop(self):
+        self.stopped.set()
+        for task in self.tasks.values():
+            task.trigger()
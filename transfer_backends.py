@@ -0,0 +1,407 @@
+"""
+Ways of getting a raw file from the instrument computer to the transfer box.
+A backend has a host attribute (used to limit concurrent transfers per
+destination) and a transfer(fn) method which raises TransferError when
+copying fails and may be retried, and other exceptions on fatal errors.
+The in-process backends take an optional ratelimit.TokenBucket limiter.
+The chunked backend can compress what it sends, see compression.py.
+"""
+
+import os, posixpath, subprocess, logging, hashlib, pipes, socket, threading
+import time, zlib
+
+import compression
+from fingerprint import full_hash
+
+try:
+    import paramiko
+except ImportError:
+    paramiko = None
+
+log = logging.getLogger(__name__)
+
+PSCP = os.path.join('C:\\', 'Program Files', 'ssh', 'pscp.exe')
+PLINK = os.path.join('C:\\', 'Program Files', 'ssh', 'plink.exe')
+CHUNKSIZE = 64 * 1024 * 1024
+PARTIAL_SUFFIX = '.part'
+
+
+class TransferError(Exception):
+    pass
+
+
+def host_from_destination(destination):
+    """user@host:/path -> host"""
+    return destination.split(':')[0].split('@')[-1]
+
+
+class PscpBackend(object):
+    """Copies files by calling PuTTY's pscp.exe, one process per file"""
+    def __init__(self, keyfile, destination, pscp=PSCP):
+        self.keyfile = keyfile
+        self.destination = destination
+        self.pscp = pscp
+        self.host = host_from_destination(destination)
+
+    def transfer(self, fn):
+        try:
+            subprocess.check_call([self.pscp, '-i', self.keyfile, fn,
+                self.destination])
+        except OSError:
+            log.error('Could not call {0}. Exiting'.format(self.pscp))
+            raise
+        except subprocess.CalledProcessError as e:
+            raise TransferError('pscp exited with {0}'.format(e.returncode))
+
+
+class LocalDirectoryRemote(object):
+    """Receiving side of ChunkedBackend in a directory on this computer,
+    e.g. a mounted share"""
+    def __init__(self, directory):
+        self.directory = directory
+        self.host = 'localhost'
+
+    def _partial(self, name):
+        return os.path.join(self.directory, name + PARTIAL_SUFFIX)
+
+    def arrived(self, name):
+        try:
+            return os.path.getsize(self._partial(name))
+        except OSError:
+            return 0
+
+    def codecs(self):
+        return compression.available()
+
+    def append(self, name, data, codec=None):
+        try:
+            if codec is not None:
+                data = compression.decompress(data, codec)
+            with open(self._partial(name), 'ab') as fp:
+                fp.write(data)
+        except (IOError, zlib.error) as e:
+            raise TransferError('Could not write to {0}: {1}'.format(
+                self.directory, e))
+
+    def checksum(self, name):
+        digest = hashlib.sha1()
+        try:
+            with open(self._partial(name), 'rb') as fp:
+                for data in iter(lambda: fp.read(CHUNKSIZE), ''):
+                    digest.update(data)
+        except IOError as e:
+            raise TransferError('Could not read from {0}: {1}'.format(
+                self.directory, e))
+        return digest.hexdigest()
+
+    def discard(self, name):
+        try:
+            if os.path.exists(self._partial(name)):
+                os.remove(self._partial(name))
+        except OSError as e:
+            raise TransferError('Could not remove from {0}: {1}'.format(
+                self.directory, e))
+
+    def commit(self, name):
+        # fails on Windows when name already exists
+        try:
+            os.rename(self._partial(name), os.path.join(self.directory, name))
+        except OSError as e:
+            raise TransferError('Could not rename in {0}: {1}'.format(
+                self.directory, e))
+
+    def final_size(self, name):
+        """Size of the finished file name, None if it is not there"""
+        path = os.path.join(self.directory, name)
+        try:
+            return os.path.getsize(path) if os.path.isfile(path) else None
+        except OSError as e:
+            raise TransferError('Could not read from {0}: {1}'.format(
+                self.directory, e))
+
+    def final_checksum(self, name):
+        try:
+            return full_hash(os.path.join(self.directory, name))
+        except IOError as e:
+            raise TransferError('Could not read from {0}: {1}'.format(
+                self.directory, e))
+
+
+class SSHRemote(object):
+    """Receiving side of ChunkedBackend on a host reached with plink (or
+    another ssh client). Only needs a POSIX shell and sha1sum there. For
+    testing without a server, pass ssh=['sh', '-c'] to run the commands
+    locally. Compressed chunks are only sent when helper, the command to
+    run compression.py on the host, is given."""
+    def __init__(self, destination, keyfile=None, ssh=None, helper=None):
+        userhost, self.directory = destination.split(':', 1)
+        self.host = host_from_destination(destination)
+        if ssh is None:
+            ssh = [PLINK, '-batch', '-i', keyfile, userhost]
+        self.ssh = ssh
+        self.helper = helper
+
+    def _partial(self, name):
+        return pipes.quote(posixpath.join(self.directory, name) +
+                PARTIAL_SUFFIX)
+
+    def _run(self, command, data=None):
+        try:
+            proc = subprocess.Popen(self.ssh + [command],
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE)
+        except OSError:
+            log.error('Could not call {0}. Exiting'.format(self.ssh[0]))
+            raise
+        out, err = proc.communicate(data)
+        if proc.returncode:
+            raise TransferError('Remote command {0} failed: {1}'.format(
+                command, err.strip()))
+        return out
+
+    def arrived(self, name):
+        out = self._run('if [ -f {0} ]; then wc -c < {0}; else echo 0; '
+                'fi'.format(self._partial(name)))
+        return int(out.strip())
+
+    def codecs(self):
+        if self.helper is None:
+            return []
+        try:
+            return self._run('{0} codecs'.format(self.helper)).split()
+        except TransferError as e:
+            log.warning('Could not ask {0} for compression codecs, sending '
+                    'uncompressed: {1}'.format(self.host, e))
+            return []
+
+    def append(self, name, data, codec=None):
+        if codec is None:
+            self._run('cat >> {0}'.format(self._partial(name)), data)
+        else:
+            self._run('{0} append {1} {2}'.format(self.helper, codec,
+                self._partial(name)), data)
+
+    def checksum(self, name):
+        return self._run('sha1sum {0}'.format(self._partial(name))).split()[0]
+
+    def discard(self, name):
+        self._run('rm -f {0}'.format(self._partial(name)))
+
+    def commit(self, name):
+        self._run('mv {0} {1}'.format(self._partial(name),
+            pipes.quote(posixpath.join(self.directory, name))))
+
+    def final_size(self, name):
+        out = self._run('if [ -f {0} ]; then wc -c < {0}; fi'.format(
+            pipes.quote(posixpath.join(self.directory, name)))).strip()
+        return int(out) if out else None
+
+    def final_checksum(self, name):
+        return self._run('sha1sum {0}'.format(pipes.quote(posixpath.join(
+            self.directory, name)))).split()[0]
+
+
+class ChunkedBackend(object):
+    """Sends files in chunks to a remote (LocalDirectoryRemote, SSHRemote),
+    which keeps a partial file. After a failure, the next transfer resumes
+    where the partial file ends. The file is hashed while it is read, and
+    the partial file is only renamed to its final name when the checksum
+    computed by the receiving side matches. Files that are already on the
+    receiving side with the same content are not sent again. With a
+    compression.Compressor, chunks are compressed with a codec both sides
+    support, and decompressed by the receiving side before the checksum
+    is compared."""
+    def __init__(self, remote, chunksize=CHUNKSIZE, limiter=None,
+            compressor=None):
+        self.remote = remote
+        self.chunksize = chunksize
+        self.limiter = limiter
+        self.compressor = compressor
+        self.codec = None
+        self.negotiated = compressor is None
+        self.host = remote.host
+
+    def _codec(self):
+        """Negotiated on the first transfer"""
+        if not self.negotiated:
+            self.codec = compression.negotiate(self.compressor.codec,
+                    self.remote.codecs())
+            self.negotiated = True
+            log.info('Compressing transfers to {0} with {1}'.format(self.host,
+                self.codec or 'nothing, no common codec'))
+        return self.codec
+
+    def _send(self, name, data):
+        codec = self._codec()
+        if codec is not None:
+            start = time.time()
+            data = self.compressor.compress(data, codec)
+            compress_seconds = time.time() - start
+        start = time.time()
+        if self.limiter is not None:
+            self.limiter.consume(len(data))
+        self.remote.append(name, data, codec)
+        if codec is not None:
+            self.compressor.account(compress_seconds, time.time() - start)
+
+    def transfer(self, fn):
+        # fn may have been renamed or deleted while waiting in the pool,
+        # that is retried or marked by the caller like a failed copy.
+        # Errors of the ssh program (OSError) are still fatal.
+        name = os.path.basename(fn)
+        try:
+            size = os.path.getsize(fn)
+        except OSError as e:
+            raise TransferError('Could not read {0}: {1}'.format(fn, e))
+        if self.remote.final_size(name) == size:
+            try:
+                digest = full_hash(fn)
+            except IOError as e:
+                raise TransferError('Could not read {0}: {1}'.format(fn, e))
+            if self.remote.final_checksum(name) == digest:
+                log.info('{0} is already on {1}, not sending it again'.format(
+                    fn, self.host))
+                return digest
+        arrived = self.remote.arrived(name)
+        if arrived > size:
+            log.warning('Partial upload of {0} is larger than the file, '
+                    'starting over'.format(fn))
+            self.remote.discard(name)
+            arrived = 0
+        elif arrived:
+            log.info('Resuming transfer of {0} at byte {1}'.format(fn,
+                arrived))
+        digest = hashlib.sha1()
+        position = 0
+        try:
+            with open(fn, 'rb') as fp:
+                for data in iter(lambda: fp.read(self.chunksize), ''):
+                    # parts that already arrived are hashed, but not sent
+                    # again
+                    digest.update(data)
+                    if position + len(data) > arrived:
+                        self._send(name, data[max(arrived - position, 0):])
+                    position += len(data)
+        except IOError as e:
+            raise TransferError('Could not read {0}: {1}'.format(fn, e))
+        if self.remote.checksum(name) != digest.hexdigest():
+            self.remote.discard(name)
+            raise TransferError('Checksum of {0} on receiving side does not '
+                    'match, transfer will start over'.format(fn))
+        self.remote.commit(name)
+        return digest.hexdigest()
+
+
+class SFTPBackend(object):
+    """Copies files in-process over SFTP (needs paramiko). A single
+    authenticated SSH connection per destination is kept open and shared
+    by all transfer threads, each transfer is a channel on it. The key has
+    to be in OpenSSH format, paramiko does not read PuTTY .ppk files."""
+    def __init__(self, destination, keyfile, port=22, window_size=None,
+            max_packet_size=None, buffer_size=1024 * 1024, limiter=None):
+        if paramiko is None:
+            raise ImportError('The sftp transfer backend needs paramiko')
+        userhost, self.directory = destination.split(':', 1)
+        self.user = userhost.split('@')[0] if '@' in userhost else None
+        self.host = host_from_destination(destination)
+        self.port = port
+        self.keyfile = keyfile
+        self.window_size = window_size
+        self.max_packet_size = max_packet_size
+        self.buffer_size = buffer_size
+        self.limiter = limiter
+        self.transport = None
+        self.lock = threading.Lock()
+
+    def _load_key(self):
+        for keytype in [paramiko.RSAKey, paramiko.ECDSAKey,
+                getattr(paramiko, 'Ed25519Key', None), paramiko.DSSKey]:
+            if keytype is None:
+                continue
+            try:
+                return keytype.from_private_key_file(self.keyfile)
+            except paramiko.SSHException:
+                continue
+        raise paramiko.SSHException('Could not read key {0}'.format(
+            self.keyfile))
+
+    def _transport(self):
+        """Returns the shared connection, (re)connecting when needed"""
+        with self.lock:
+            if self.transport is None or not self.transport.is_active():
+                kwargs = {}
+                if self.window_size:
+                    kwargs['default_window_size'] = self.window_size
+                if self.max_packet_size:
+                    kwargs['default_max_packet_size'] = self.max_packet_size
+                transport = paramiko.Transport((self.host, self.port), **kwargs)
+                transport.connect(username=self.user, pkey=self._load_key())
+                log.info('Opened SFTP connection to {0}'.format(self.host))
+                self.transport = transport
+            return self.transport
+
+    def transfer(self, fn):
+        name = os.path.basename(fn)
+        remote = posixpath.join(self.directory, name)
+        partial = remote + PARTIAL_SUFFIX
+        sftp = None
+        try:
+            sftp = paramiko.SFTPClient.from_transport(self._transport(),
+                    window_size=self.window_size,
+                    max_packet_size=self.max_packet_size)
+            with open(fn, 'rb') as src:
+                dst = sftp.open(partial, 'wb', self.buffer_size)
+                # do not wait for the server to acknowledge every write
+                dst.set_pipelined(True)
+                try:
+                    for data in iter(lambda: src.read(self.buffer_size), ''):
+                        if self.limiter is not None:
+                            self.limiter.consume(len(data))
+                        dst.write(data)
+                finally:
+                    dst.close()
+            sftp.posix_rename(partial, remote)
+        except (paramiko.SSHException, socket.error, IOError) as e:
+            raise TransferError('SFTP transfer of {0} failed: {1}'.format(fn,
+                e))
+        finally:
+            if sftp is not None:
+                sftp.close()
+
+    def close(self):
+        with self.lock:
+            if self.transport is not None:
+                self.transport.close()
+                self.transport = None
+
+
+def get_compressor(config):
+    """compression.Compressor as set in a transferconfig config, or None"""
+    settings = config['compression']
+    if settings['codec'] in (None, 'none'):
+        return None
+    return compression.Compressor(settings['codec'], settings['level'],
+            settings['threads'], settings['block_size'], settings['adaptive'])
+
+
+def get_backend(config, limiter=None):
+    """Backend as set in a transferconfig config"""
+    backend = config['backend']
+    if backend == 'pscp':
+        if limiter is not None:
+            log.warning('Bandwidth of the pscp backend cannot be limited')
+        return PscpBackend(config['keyfile'], config['destination'])
+    elif backend == 'sftp':
+        sftp = config['sftp']
+        return SFTPBackend(config['destination'], config['keyfile'],
+                port=sftp['port'], window_size=sftp['window_size'],
+                max_packet_size=sftp['max_packet_size'],
+                buffer_size=sftp['buffer_size'], limiter=limiter)
+    elif backend == 'chunked-ssh':
+        return ChunkedBackend(SSHRemote(config['destination'],
+            config['keyfile'], helper=config['compression']['helper']),
+            config['chunksize'], limiter, get_compressor(config))
+    elif backend == 'chunked-local':
+        return ChunkedBackend(LocalDirectoryRemote(config['destination']),
+                config['chunksize'], limiter, get_compressor(config))
+    raise ValueError('Unknown transfer backend {0}'.format(backend))
@@ -1,35 +1,210 @@
-import os, logging, datetime
-import metadata_querying
+"""
+Deletes raw files from the transfer box once they are archived. The data
+directory is walked lazily and the metadata server is asked about the
+files in batches while walking, so memory use and request size do not grow
+with the number of files. Deletion runs in parallel.
+
+By default all files archived more than 7 days ago are deleted. With
+--free-target, nothing is deleted while more than --low-water percent of
+the disk is free (by default the target itself); below that, archived
+files are deleted oldest first until the target percentage is free, see
+eviction.py.
+
+Usage:
+    python transferbox_cleanup.py [--dry-run] [--workers N] [--batch N]
+        [--min-age DAYS] [--free-target PERCENT] [--low-water PERCENT]
+
+"""
+
+import os, sys, logging, datetime, argparse, itertools, threading, Queue
+import metadata_querying, eviction
+from statuscache import StatusCache
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 DATADIR = '/mnt/datadrive'
 LOGIN = 'http://localhost:8000/kantele/login'
 URL = 'http://localhost:8000/kantele/rawstatus'
+MIN_AGE_DAYS = 7
+WORKERS = 4
+BATCH_SIZE = 500
+DATE_FORMATS = [('%Y%m%d', 8), ('%Y-%m-%d', 10)]
+
+log = logging.getLogger(__name__)
 
-logging.basicConfig(filename='transfer_cleaning.log',level=logging.DEBUG, 
-	format='%(asctime)s - %(levelname)s - %(message)s')
-logging.info('Checking files to delete on transfer box...')
 
-files = os.listdir(DATADIR)
-response = metadata_querying.query_rawfiles(files, URL, LOGIN)
+def iter_files(directory):
+    """Generator of (name, size, mtime) of the files in directory"""
+    if scandir is not None:
+        for entry in scandir(directory):
+            if entry.is_file(follow_symlinks=False):
+                st = entry.stat(follow_symlinks=False)
+                yield entry.name, st.st_size, st.st_mtime
+    else:
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if os.path.isfile(path) and not os.path.islink(path):
+                st = os.stat(path)
+                yield name, st.st_size, st.st_mtime
 
-todelete = []
-for fn in response:
-    if response[fn][0] == 'done':
+
+def archive_date(answer):
+    """Date of a rawstatus answer [state, date], None when unknown"""
+    if not isinstance(answer, list) or len(answer) < 2 or not answer[1]:
+        return None
+    for dateformat, length in DATE_FORMATS:
         try:
-            td = datetime.datetime.now() - datetime.datetime.strptime(response[fn][1],
-                '%Y%m%d')
-        except:
-            td = datetime.datetime.now() - datetime.datetime.strptime(response[fn][1][:10],
-                '%Y-%m-%d')
-        if td.days > 7:
-            todelete.append(fn)
-if todelete:
-    logging.info('Found {0} files archived in Kalevala older than 7 days. Deleting them.'.format(len(todelete)))
-else:
-    logging.info('No archived files found. Not deleting')
-for fn in todelete:
-    logging.info('Deleting {0}'.format(fn))
-    os.remove(os.path.join(DATADIR, fn))
-
-
-        
+            return datetime.datetime.strptime(answer[1][:length], dateformat)
+        except ValueError:
+            continue
+    log.warning('Could not read archive date {0}'.format(answer[1]))
+    return None
+
+
+def archived_files(client, files, batchsize=BATCH_SIZE):
+    """Generator of (name, size, mtime, archive date) for the files that
+    are archived, from an iterable of (name, size, mtime). Queries one
+    batch at a time."""
+    files = iter(files)
+    while True:
+        batch = list(itertools.islice(files, batchsize))
+        if not batch:
+            return
+        response = client.query([x[0] for x in batch])
+        for name, size, mtime in batch:
+            answer = response.get(name)
+            if answer and answer[0] == 'done':
+                yield name, size, mtime, archive_date(answer)
+
+
+def delete_files(directory, names, workers=WORKERS, dry_run=False):
+    """Deletes files in parallel, names is an iterable of (name, size).
+    Returns number and total size of deleted files."""
+    jobs = Queue.Queue(maxsize=workers * 4)
+    lock = threading.Lock()
+    deleted = [0, 0]
+    def work():
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            name, size = job
+            if dry_run:
+                log.info('Would delete {0}'.format(name))
+            else:
+                try:
+                    os.remove(os.path.join(directory, name))
+                except OSError as e:
+                    log.error('Could not delete {0}: {1}'.format(name, e))
+                    continue
+                log.info('Deleted {0}'.format(name))
+            with lock:
+                deleted[0] += 1
+                deleted[1] += size
+    threads = [threading.Thread(target=work) for x in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        for job in names:
+            jobs.put(job)
+    finally:
+        for thread in threads:
+            jobs.put(None)
+        for thread in threads:
+            thread.join()
+    return deleted[0], deleted[1]
+
+
+def older_than(archived, days):
+    limit = datetime.datetime.now() - datetime.timedelta(days)
+    for name, size, mtime, date in archived:
+        if date is None:
+            date = datetime.datetime.fromtimestamp(mtime)
+        if date < limit:
+            yield name, size, date
+
+
+def cleanup_by_age(directory, client, days, workers, batchsize, dry_run):
+    """Deletes archived files while the directory is walked"""
+    candidates = older_than(archived_files(client, iter_files(directory),
+        batchsize), days)
+    return delete_files(directory, ((name, size) for name, size, date in
+        candidates), workers, dry_run)
+
+
+def archived_names(client):
+    """Archive check for eviction.select"""
+    def archived(names):
+        response = client.query(names)
+        return [fn for fn in names if response.get(fn) and
+                response[fn][0] == 'done']
+    return archived
+
+
+def cleanup_to_free_space(directory, client, watermarks, days, workers,
+        batchsize, dry_run):
+    """Deletes oldest archived files when the disk is below the low
+    watermark, until the high watermark is free. Only name, size and
+    mtime of the files are kept in memory, to sort them, and only the
+    oldest files are asked about."""
+    needed = watermarks.to_free(directory)
+    if not needed:
+        log.info('Disk is above low watermark, not deleting')
+        return 0, 0
+    candidates = [eviction.Candidate(name, name, size,
+        datetime.datetime.fromtimestamp(mtime)) for name, size, mtime in
+        iter_files(directory)]
+    selected = eviction.select(candidates, needed, archived_names(client),
+            days, batchsize)
+    return delete_files(directory, ((x.path, x.size) for x in selected),
+            workers, dry_run)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Delete archived files from '
+            'the transfer box')
+    parser.add_argument('--dry-run', action='store_true',
+            help='only report what would be deleted')
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    parser.add_argument('--batch', type=int, default=BATCH_SIZE,
+            help='files per metadata query')
+    parser.add_argument('--min-age', type=float, default=None,
+            help='days since archiving before a file may be deleted, default '
+            '{0}, or 0 with --free-target'.format(MIN_AGE_DAYS))
+    parser.add_argument('--free-target', type=float, default=None,
+            help='percentage of disk to free, oldest archived files first')
+    parser.add_argument('--low-water', type=float, default=None,
+            help='only delete when less than this percentage of disk is '
+            'free, default the free target')
+    options = parser.parse_args(argv)
+    log.info('Checking files to delete on transfer box...')
+    client = metadata_querying.MetadataClient(URL, LOGIN, cache=StatusCache())
+    if options.free_target is None:
+        days = MIN_AGE_DAYS if options.min_age is None else options.min_age
+        count, size = cleanup_by_age(DATADIR, client, days, options.workers,
+                options.batch, options.dry_run)
+    else:
+        days = 0 if options.min_age is None else options.min_age
+        low = options.free_target if options.low_water is None else \
+                options.low_water
+        count, size = cleanup_to_free_space(DATADIR, client,
+                eviction.Watermarks(low, options.free_target), days,
+                options.workers, options.batch, options.dry_run)
+    report = '{0} {1} archived files, {2:.1f} GB'.format('Would delete' if
+            options.dry_run else 'Deleted', count, size / 1e9)
+    log.info(report)
+    if options.dry_run:
+        print report
+
+
+if __name__ == '__main__':
+    logging.basicConfig(filename='transfer_cleaning.log', level=logging.DEBUG,
+            format='%(asctime)s - %(levelname)s - %(message)s')
+    main(sys.argv[1:])
@@ -0,0 +1,129 @@
+"""
+Settings of the transfer daemons. Defaults are given by each daemon and can
+be overridden in a JSON file in the working directory, e.g.
+
+{"backend": "sftp", "keyfile": "C:\\\\ssh\\\\orbi_rsa",
+ "destination": "orbi@130.229.48.246:/mnt/datadrive/",
+ "sftp": {"window_size": 16777216}}
+
+Nested dicts are merged, so only changed settings need to be given.
+"""
+
+import json, copy, logging
+
+log = logging.getLogger(__name__)
+
+CONFIG_FILE = 'transfer_config.json'
+
+DEFAULTS = {
+    'backend': 'pscp', # pscp, sftp, chunked-ssh or chunked-local
+    'keyfile': None,
+    'destination': None, # user@host:/path, or a directory for chunked-local
+    'workers': 4,
+    'per_host': 4,
+    'chunksize': 64 * 1024 * 1024,
+    # do not send a file whose content (by full hash) was already sent
+    # under another name
+    'skip_duplicates': True,
+    'sftp': {
+        'port': 22,
+        'window_size': 8 * 1024 * 1024,
+        'max_packet_size': 32768,
+        'buffer_size': 1024 * 1024,
+        },
+    # compression of the chunked backends, see compression.py. codec is
+    # none, auto (fastest both sides have), zstd, lz4, zlib or bz2. helper
+    # is the command running compression.py on the transfer box, e.g.
+    # "python /home/orbi/scripts/compression.py", chunked-ssh sends
+    # uncompressed without it. adaptive stops compressing while it is
+    # slower than sending.
+    'compression': {
+        'codec': 'none',
+        'level': 1,
+        'threads': 4,
+        'block_size': 1024 * 1024,
+        'adaptive': True,
+        'helper': None,
+        },
+    # bytes per second for the chunked and sftp backends, None is
+    # unlimited. acquiring is a ceiling while the instrument acquires,
+    # profiles are [{"start": "08:00", "end": "18:00", "rate": 10000000}]
+    'throttle': {
+        'rate': None,
+        'acquiring': None,
+        'profiles': [],
+        },
+    # order of transfers: smallest, oldest or fifo, within priority classes
+    # [{"name": "qc", "pattern": "QC", "priority": 0}], lower goes first and
+    # unmatched files have priority 10. Waiting aging seconds raises
+    # priority by one.
+    'priority': {
+        'order': 'oldest',
+        'classes': [],
+        'aging': 3600,
+        },
+    # instead of deleting archived files after a fixed number of days,
+    # delete them oldest first when less than low percent of the disk is
+    # free, until high percent is free, see eviction.py. directory is the
+    # raw file folder, by default that of the queued files.
+    'eviction': {
+        'enabled': False,
+        'low': 10,
+        'high': 20,
+        'min_age_days': 1,
+        'directory': None,
+        },
+    # counters and timings, served on http://127.0.0.1:port/metrics and
+    # written to the dump file every dump_interval seconds, see metrics.py
+    'metrics': {
+        'enabled': False,
+        'port': None,
+        'dump': None,
+        'dump_interval': 60,
+        },
+    # on start, queue closed files from all logs that were not read to the
+    # end, back to the last closed file or at most days ago, parsing them
+    # in processes (None is one per CPU), see backfill.py
+    'backfill': {
+        'enabled': False,
+        'processes': None,
+        'days': 14,
+        },
+    # with a pipeline, closed files are transferred, verified, synced to
+    # the archive and cleaned up straight away, see pipeline.py. Needs the
+    # transfer box incoming folder and the archive mounted locally.
+    'pipeline': {
+        'enabled': False,
+        'incoming': None,
+        'archive': None,
+        'manifest': 'sync_manifest.sqlite',
+        'remove_incoming': False, # delete transfer box copy once archived
+        },
+    }
+
+
+def merge(base, override):
+    merged = copy.deepcopy(base)
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def load_config(fn=CONFIG_FILE, defaults=None):
+    """Returns DEFAULTS, updated with defaults and the settings in fn"""
+    config = merge(DEFAULTS, defaults or {})
+    try:
+        with open(fn) as fp:
+            config = merge(config, json.load(fp))
+    except IOError:
+        log.info('No config file {0} found, using default '
+                'settings'.format(fn))
+    except ValueError:
+        log.error('Could not parse JSON from config file {0}'.format(fn))
+        raise
+    else:
+        log.info('Read settings from {0}'.format(fn))
+    return config
@@ -0,0 +1,143 @@
+"""
+Runs file transfers in a number of worker threads, so one large or failing
+file does not hold up the others. Concurrency is limited globally (number
+of workers) and per destination host. Files of different owners (e.g. the
+instruments of a supervisor) are taken in turns, so one instrument with a
+long queue does not hold up the others. Among the files of an owner, a
+scheduler.PriorityPolicy decides which goes first.
+"""
+
+import threading, collections, logging, sys, time
+
+import metrics
+
+from transfer_backends import TransferError
+from scheduler import PriorityPolicy
+
+log = logging.getLogger(__name__)
+
+WORKERS = 4
+PER_HOST = 4
+
+TRANSFER_SECONDS = metrics.histogram('transfer_seconds', 'Duration of '
+        'transfers', ['host'])
+TRANSFER_BYTES = metrics.counter('transfer_bytes_total', 'Bytes of finished '
+        'transfers', ['host'])
+PENDING = metrics.gauge('transfers_pending', 'Files waiting for a transfer '
+        'worker')
+
+
+class TransferPool(object):
+    def __init__(self, workers=WORKERS, per_host=PER_HOST, policy=None):
+        self.workers = workers
+        self.per_host = per_host
+        self.policy = policy or PriorityPolicy()
+        self.cond = threading.Condition()
+        # callbacks are called one at a time, but not with cond held: they
+        # take locks of their callers, which may hold them while submitting
+        self.callback_lock = threading.Lock()
+        self.pending = collections.defaultdict(list) # per owner
+        self.owners = collections.deque() # owners with pending jobs, in turn
+        self.active = collections.defaultdict(int)
+        self.unfinished = 0
+        self.fatal = None
+        self.threads = []
+
+    def _start_workers(self):
+        while len(self.threads) < self.workers:
+            thread = threading.Thread(target=self._work,
+                    name='transfer-{0}'.format(len(self.threads)))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, fn, backend, callback, owner=None):
+        """Queue fn for transfer by backend. callback(fn, error) is called
+        when the transfer finishes, error is None on success or the
+        TransferError. Callbacks are called one at a time, so they can
+        safely update a shared queue."""
+        with self.cond:
+            self._start_workers()
+            if owner not in self.pending:
+                self.owners.append(owner)
+            self.pending[owner].append(self.policy.job(fn, backend, callback,
+                owner))
+            self.unfinished += 1
+            PENDING.set(self.unfinished - sum(self.active.values()))
+            self.cond.notify()
+
+    def _next_job(self):
+        """Pending job with the highest priority whose host has capacity
+        left, of the owner whose turn it is. Call with self.cond held."""
+        for turn in range(len(self.owners)):
+            owner = self.owners[0]
+            self.owners.rotate(-1)
+            pending = self.pending[owner]
+            job = self.policy.choose(x for x in pending
+                    if self.active[x.backend.host] < self.per_host)
+            if job is not None:
+                pending.remove(job)
+                if not pending:
+                    del self.pending[owner]
+                    self.owners.remove(owner)
+                self.policy.started(job)
+                return job
+        return None
+
+    def bump(self, fn):
+        """Transfer fn as soon as a worker is free"""
+        with self.cond:
+            self.policy.bump(fn)
+
+    def _work(self):
+        while True:
+            with self.cond:
+                job = self._next_job()
+                while job is None:
+                    self.cond.wait()
+                    job = self._next_job()
+                fn, backend, callback = job.fn, job.backend, job.callback
+                self.active[backend.host] += 1
+            error = None
+            start = time.time()
+            try:
+                backend.transfer(fn)
+            except TransferError as e:
+                error = e
+            except Exception as e:
+                error = e
+                self.fatal = sys.exc_info()
+            else:
+                TRANSFER_SECONDS.labels(backend.host).observe(
+                        time.time() - start)
+                TRANSFER_BYTES.labels(backend.host).inc(job.size)
+            with self.cond:
+                self.active[backend.host] -= 1
+                self.cond.notify_all()
+            with self.callback_lock:
+                try:
+                    callback(fn, error)
+                except Exception:
+                    log.exception('Error updating queue after transfer of '
+                            '{0}'.format(fn))
+            with self.cond:
+                self.unfinished -= 1
+                PENDING.set(self.unfinished - sum(self.active.values()))
+                self.cond.notify_all()
+
+    def join(self):
+        """Wait until all submitted transfers are finished. Re-raises fatal
+        errors (e.g. transfer program not found) from the workers."""
+        with self.cond:
+            while self.unfinished:
+                # timeout keeps the main thread responsive to interrupts
+                self.cond.wait(1)
+        self.raise_fatal()
+
+    def raise_fatal(self):
+        """Re-raises a fatal error from the workers without waiting for
+        unfinished transfers"""
+        with self.cond:
+            fatal, self.fatal = self.fatal, None
+        if fatal:
+            raise fatal[0], fatal[1], fatal[2]
@@ -0,0 +1,179 @@
+"""
+Waits for changes in logfile and raw file directories, so files can be
+transferred seconds after the instrument closes them instead of at the next
+fixed iteration. Uses change notification of the OS when available
+(pywin32 on the instrument PCs, pyinotify on Linux) and otherwise an
+adaptive poll of the watched paths.
+"""
+
+import os, time, logging
+
+try:
+    import win32file, win32event, win32con
+except ImportError:
+    win32file = None
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+log = logging.getLogger(__name__)
+
+DEBOUNCE = 2 # seconds without changes before a burst is considered over
+MAX_DEBOUNCE = 30 # never postpone a wakeup longer than this
+MIN_POLL = 0.5
+MAX_POLL = 30
+
+
+class PollWatcher(object):
+    """Stats the watched paths, polling quickly right after a change and
+    backing off to MAX_POLL when nothing happens."""
+    def __init__(self, paths, min_poll=MIN_POLL, max_poll=MAX_POLL):
+        self.paths = list(paths)
+        self.min_poll = min_poll
+        self.max_poll = max_poll
+        self.poll = min_poll
+        self.signature = self._signature()
+
+    def _stat(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if os.path.isdir(path):
+            # directory mtime does not change on appends in Windows, so
+            # include the files in it
+            return (stat.st_mtime, tuple(self._stat(os.path.join(path, fn))
+                for fn in sorted(os.listdir(path))
+                if not os.path.isdir(os.path.join(path, fn))))
+        return (stat.st_size, stat.st_mtime)
+
+    def _signature(self):
+        return [self._stat(path) for path in self.paths]
+
+    def changed(self, timeout):
+        """Returns True when a watched path changes within timeout"""
+        end = time.time() + timeout
+        while True:
+            signature = self._signature()
+            if signature != self.signature:
+                self.signature = signature
+                self.poll = self.min_poll
+                return True
+            remaining = end - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(self.poll, remaining))
+            self.poll = min(self.poll * 2, self.max_poll)
+
+    def close(self):
+        pass
+
+
+class WindowsWatcher(object):
+    """Change notification handles on directories, waits in the kernel"""
+    def __init__(self, paths):
+        flags = win32con.FILE_NOTIFY_CHANGE_FILE_NAME | \
+                win32con.FILE_NOTIFY_CHANGE_SIZE | \
+                win32con.FILE_NOTIFY_CHANGE_LAST_WRITE
+        self.handles = [win32file.FindFirstChangeNotification(path, False,
+            flags) for path in watched_directories(paths)]
+
+    def changed(self, timeout):
+        result = win32event.WaitForMultipleObjects(self.handles, False,
+                int(timeout * 1000))
+        if result == win32event.WAIT_TIMEOUT:
+            return False
+        # rearm all handles that fired
+        for handle in self.handles:
+            if win32event.WaitForSingleObject(handle, 0) == \
+                    win32event.WAIT_OBJECT_0:
+                win32file.FindNextChangeNotification(handle)
+        return True
+
+    def close(self):
+        for handle in self.handles:
+            win32file.FindCloseChangeNotification(handle)
+
+
+class InotifyWatcher(object):
+    def __init__(self, paths):
+        self.wm = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.wm, default_proc_fun=lambda
+                event: None)
+        mask = pyinotify.IN_MODIFY | pyinotify.IN_CLOSE_WRITE | \
+                pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO
+        for path in watched_directories(paths):
+            self.wm.add_watch(path, mask)
+
+    def changed(self, timeout):
+        if not self.notifier.check_events(int(timeout * 1000)):
+            return False
+        self.notifier.read_events()
+        self.notifier.process_events()
+        return True
+
+    def close(self):
+        self.notifier.stop()
+
+
+def watched_directories(paths):
+    dirs = set()
+    for path in paths:
+        if not os.path.isdir(path):
+            path = os.path.dirname(path)
+        if os.path.isdir(path):
+            dirs.add(path)
+    return sorted(dirs)
+
+
+class Watcher(object):
+    """Picks the best available way of watching paths (files or
+    directories). Use wait() instead of time.sleep() in the main loops."""
+    def __init__(self, paths, debounce=DEBOUNCE, max_debounce=MAX_DEBOUNCE):
+        self.debounce = debounce
+        self.max_debounce = max_debounce
+        self.watch(paths)
+
+    def watch(self, paths):
+        """(Re)starts watching paths, e.g. when new raw file directories
+        are found in the queue"""
+        paths = sorted(set(paths))
+        if getattr(self, 'paths', None) == paths:
+            return
+        if hasattr(self, 'backend'):
+            self.backend.close()
+        self.paths = paths
+        # change notification needs an existing directory, until one is
+        # created the paths are polled
+        self.waiting_for_directory = not watched_directories(paths)
+        if self.waiting_for_directory:
+            self.backend = PollWatcher(paths)
+        elif win32file is not None:
+            self.backend = WindowsWatcher(paths)
+        elif pyinotify is not None:
+            self.backend = InotifyWatcher(paths)
+        else:
+            self.backend = PollWatcher(paths)
+        log.info('Watching {0} for changes using {1}'.format(
+            ', '.join(paths), self.backend.__class__.__name__))
+
+    def wait(self, timeout):
+        """Blocks until watched paths change or timeout seconds have passed.
+        Changes are debounced: return happens when no new change came in
+        for self.debounce seconds, so a burst of log lines causes a single
+        wakeup. Returns True if something changed."""
+        if self.waiting_for_directory and watched_directories(self.paths):
+            paths, self.paths = self.paths, None
+            self.watch(paths)
+        if not self.backend.changed(timeout):
+            return False
+        start = time.time()
+        while time.time() - start < self.max_debounce:
+            if not self.backend.changed(self.debounce):
+                break
+        return True
+
+    def close(self):
+        self.backend.close()